@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+# Keeps the latest of the counts saved twice for a channel and day
+REMOVE_DUPLICATES = """
+DELETE FROM bots_usercount
+WHERE id IN (
+    SELECT id FROM (
+        SELECT id, row_number() OVER (PARTITION BY channel_id, dt
+                                      ORDER BY id DESC) AS position
+        FROM bots_usercount) AS counts
+    WHERE position > 1)
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0006_auto_20151030_1406'),
+    ]
+
+    operations = [
+        migrations.RunSQL(REMOVE_DUPLICATES, migrations.RunSQL.noop),
+        migrations.AlterUniqueTogether(
+            name='usercount',
+            unique_together=set([('channel', 'dt')]),
+        ),
+    ]
@@ -13,6 +13,7 @@ from djorm_pgarray.fields import ArrayField
 
 from botbot.apps.plugins import models as plugins_models
 from botbot.apps.plugins.models import Plugin, ActivePlugin
+from botbot.apps.plugins.utils import current_occupancy, publish_invalidation
 from botbot.core.models import TimeStampedModel
 
 
@@ -83,7 +84,9 @@ class ChatBot(models.Model):
             server = self.server.split(':')[0]
             self.slug = pretty_slug(server)
 
-        return super(ChatBot, self).save(*args, **kwargs)
+        obj = super(ChatBot, self).save(*args, **kwargs)
+        publish_invalidation('chatbot', self.pk)
+        return obj
 
     @classmethod
     def allocate_bot(cls, slug):
@@ -128,7 +131,8 @@ class Channel(TimeStampedModel):
     )
 
     # These are the default plugin slugs.
-    DEFAULT_PLUGINS = ["logger", "ping", "last_seen", "help", "bangmotivate"]
+    DEFAULT_PLUGINS = ["logger", "ping", "last_seen", "help", "bangmotivate",
+                       "occupancy"]
 
     chatbot = models.ForeignKey(ChatBot)
     name = models.CharField(max_length=250,
@@ -295,9 +299,12 @@ class Channel(TimeStampedModel):
 
     def current_size(self):
         """Number of users in this channel.
-        We only log hourly, so can be a bit off.
+        Counted live by the occupancy plugin, or its last hourly count.
         None if we don't have a record yet.
         """
+        count = current_occupancy(self.pk)
+        if count is not None:
+            return count
         try:
             usercount = UserCount.objects.get(channel=self,
                                               dt=datetime.date.today())
@@ -305,16 +312,12 @@ class Channel(TimeStampedModel):
             return None
 
         hour = datetime.datetime.now().hour
-
-        try:
-            # Postgres arrays are 1 based, but here become 0 based, so shift
-            count = usercount.counts[hour - 2]
-            if not count:
-                # Try one hour ago in case not logged this hour yet
-                count = usercount.counts[hour - 3]
-        except IndexError:
-            return None
-        return count
+        counts = usercount.counts or []
+        # Try one hour ago in case not counted this hour yet
+        for index in (hour, hour - 1):
+            if 0 <= index < len(counts) and counts[index] is not None:
+                return counts[index]
+        return None
 
     def save(self, *args, **kwargs):
         """
@@ -330,10 +333,14 @@ class Channel(TimeStampedModel):
         self.fingerprint = uuid.uuid4()
 
         super(Channel, self).save(*args, **kwargs)
+        publish_invalidation('channel', self.pk)
 
 
 class UserCount(models.Model):
-    """Number of users in a channel, per hour."""
+    """
+    Number of users in a channel, per hour: ``counts[hour]`` (local time),
+    None for hours nobody counted.
+    """
 
     channel = models.ForeignKey(Channel)
     dt = models.DateField()
@@ -341,3 +348,8 @@ class UserCount(models.Model):
 
     def __unicode__(self):
         return "{} on {}: {}".format(self.channel, self.dt, self.counts)
+
+    class Meta:
+        unique_together = (
+            ('channel', 'dt'),
+        )
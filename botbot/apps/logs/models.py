@@ -1,8 +1,9 @@
+import logging
 import socket
 
 from djorm_pgfulltext.models import SearchManager
 from djorm_pgfulltext.fields import VectorField
-from django.db import models
+from django.db import connections, models, transaction
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.core.urlresolvers import reverse
@@ -11,8 +12,13 @@ from botbot.apps.bots.utils import channel_url_kwargs
 
 from . import utils
 
+LOG = logging.getLogger(__name__)
+
 REDACTED_TEXT = '[redacted]'
 
+# Full text search configuration of Log.text
+SEARCH_CONFIG = 'pg_catalog.english'
+
 MSG_TMPL = {
         u"JOIN": u"{nick} joined the channel",
         u"NICK": u"{nick} is now known as {text}",
@@ -23,6 +29,61 @@ MSG_TMPL = {
         }
 
 
+class LogManager(SearchManager):
+
+    def ingest(self, logs):
+        """
+        Saves a batch of new logs the way ``save()`` would (redaction,
+        search index and realtime notification) but in a single INSERT.
+        When it fails none of them is saved, and the caller's transaction
+        can carry on.
+        """
+        for log in logs:
+            log.redact_excluded()
+        with transaction.atomic(using=self.db):
+            self.insert_many(logs)
+        for log in logs:
+            try:
+                log.notify()
+            except Exception:
+                LOG.error("Notify failed", exc_info=True)
+
+    def insert_many(self, logs):
+        """
+        Inserts unsaved logs with one statement, computing their
+        ``search_index`` in the database and setting their primary keys.
+        """
+        if not logs:
+            return
+        model = self.model
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        fields = [field for field in model._meta.concrete_fields
+                  if not field.primary_key and
+                  field.name != self.search_field]
+        # Same expression djorm_pgfulltext uses to update the index
+        vector = "setweight(to_tsvector('{0}', coalesce(%s, '')), 'D')".format(
+            SEARCH_CONFIG)
+        row = u'({0}, {1})'.format(u', '.join([u'%s'] * len(fields)), vector)
+
+        params = []
+        for log in logs:
+            params.extend(field.get_db_prep_save(getattr(log, field.attname),
+                                                 connection)
+                          for field in fields)
+            params.append(log.text)
+        sql = u'INSERT INTO {0} ({1}, {2}) VALUES {3} RETURNING {4}'.format(
+            qn(model._meta.db_table),
+            u', '.join(qn(field.column) for field in fields),
+            qn(model._meta.get_field(self.search_field).column),
+            u', '.join([row] * len(logs)),
+            qn(model._meta.pk.column))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for log, (pk,) in zip(logs, cursor.fetchall()):
+                log.pk = pk
+
+
 class Log(models.Model):
     bot = models.ForeignKey('bots.ChatBot', null=True)
     channel = models.ForeignKey('bots.Channel', null=True)
@@ -41,9 +102,9 @@ class Log(models.Model):
 
     search_index = VectorField()
 
-    objects = SearchManager(
+    objects = LogManager(
         fields=('text',),
-        config='pg_catalog.english',   # this is default
+        config=SEARCH_CONFIG,   # this is default
         search_field='search_index',   # this is default
         auto_update_search_field=True
     )
@@ -72,13 +133,8 @@ class Log(models.Model):
 
 
     def notify(self):
-        """Send update to Nginx to be sent out via SSE"""
-        utils.send_event_with_id(
-            "log",
-            self.as_html(),
-            self.timestamp.isoformat(),
-            self.get_cleaned_host(),
-            channel=self.channel_id)
+        """Queue update to Nginx to be sent out via SSE"""
+        utils.publish_log(self)
 
     def get_nick_color(self):
         return hash(self.nick) % 32
@@ -97,12 +153,16 @@ class Log(models.Model):
 
         return text
 
+    def redact_excluded(self):
+        """Hide the text of nicks that asked not to be logged"""
+        if self.nick in settings.EXCLUDE_NICKS:
+            self.text = REDACTED_TEXT
+
     def save(self, *args, **kwargs):
         is_new = False
         if not self.pk:
             is_new = True
-        if self.nick in settings.EXCLUDE_NICKS:
-            self.text = REDACTED_TEXT
+        self.redact_excluded()
 
         obj = super(Log, self).save(*args, **kwargs)
         if is_new:
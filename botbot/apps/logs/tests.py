@@ -11,6 +11,7 @@ import pytz
 from botbot.apps.accounts import models as account_models
 from botbot.apps.bots import models as bot_models
 from botbot.apps.logs import models as log_models
+from botbot.apps.logs import utils as log_utils
 from .management.commands import redact as redact_cmd
 from botbot.apps.bots.models import ChatBot, Channel
 from botbot.apps.bots.utils import reverse_channel
@@ -117,6 +118,22 @@ class SearchTestCase(TestCase):
         self.assertTrue(a in results)
         self.assertTrue(b in results)
 
+    @override_settings(EXCLUDE_NICKS=['redact'])
+    def test_ingest(self):
+        logs = [log_models.Log(
+            bot=self.chatbot, channel=self.public_channel,
+            timestamp=timezone.now(), nick=nick, text=text, command='PRIVMSG')
+            for nick, text in [("Nick", "Hello World"),
+                               ("redact", "Hello secret")]]
+        log_models.Log.objects.ingest(logs)
+
+        self.assertTrue(all(log.pk for log in logs))
+        self.assertEqual(log_models.Log.objects.get(pk=logs[1].pk).text,
+                         log_models.REDACTED_TEXT)
+        # the search index is filled in by the insert itself
+        results = log_models.Log.objects.search("World")
+        self.assertEqual(list(results), [logs[0]])
+
     def test_nick_search_front(self):
         a = self._add_log_line("Hello World", nick="Foo")
         b = self._add_log_line("Hello World", nick="Bar")
@@ -294,6 +311,54 @@ class RedactTests(TestCase):
         self.assertEqual(redacted.text, log_models.REDACTED_TEXT)
 
 
+class RecordingSession(object):
+    def __init__(self):
+        self.posts = []
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        self.posts.append((url, headers, data))
+
+
+@override_settings(PUSH_STREAM_URL='http://push/pub?id={id}')
+class PublisherTests(BaseTestCase):
+
+    def setUp(self):
+        super(PublisherTests, self).setUp()
+        self.other_channel = Channel.objects.create(
+            chatbot=self.chatbot, name="#Other", slug="other",
+            is_public=True)
+        self.publisher = log_utils.LogPublisher(maxsize=2, batch_size=10)
+        self.publisher.session = RecordingSession()
+
+    def _log(self, channel, text):
+        return log_models.Log.objects.create(
+            channel=channel, command='PRIVMSG', nick='Nick', text=text,
+            timestamp=timezone.now())
+
+    def test_coalesce_per_channel(self):
+        logs = [self._log(self.public_channel, 'one'),
+                self._log(self.other_channel, 'two'),
+                self._log(self.public_channel, 'three')]
+        self.publisher.send(logs)
+
+        posts = [post for post in self.publisher.session.posts
+                 if 'glob' not in post[0]]
+        self.assertEqual(len(posts), 2)
+        url, headers, data = posts[0]
+        self.assertEqual(url, 'http://push/pub?id={0}'.format(
+            self.public_channel.pk))
+        self.assertEqual(headers['Event-Id'], logs[2].timestamp.isoformat())
+        self.assertIn('one', data)
+        self.assertIn('three', data)
+        self.assertNotIn('two', data)
+
+    def test_drop_when_full(self):
+        self.publisher.start = lambda: None
+        for _ in range(3):
+            self.publisher.publish(self.log)
+        self.assertEqual(self.publisher.queue.qsize(), 2)
+
+
 class KudosTests(BaseTestCase):
 
     def setUp(self):
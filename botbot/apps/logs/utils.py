@@ -1,9 +1,17 @@
+import Queue
 import json
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
 
 from django.conf import settings
 from django.core.cache import cache
+from django.template.loader import render_to_string
+from django_statsd.clients import statsd
 import requests
+from requests.adapters import HTTPAdapter
 import geoip2.database, geoip2.errors
 
 LOG = logging.getLogger(__name__)
@@ -29,19 +37,145 @@ def ip_lookup(ip):
     return coords
 
 
-def _send_event_with_id(event_name, data, event_id, ip, channel):
+def push_session():
+    """A session keeping a few connections to Nginx alive"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _send_event_with_id(event_name, data, event_id, ip, channel,
+                        session=requests):
     """HTTP POST to Nginx which manages the Server-Sent Events"""
-    requests.post(settings.PUSH_STREAM_URL.format(id=channel),
-                  headers={'Event-Id': event_id, 'Event-Type': event_name},
-                  data=data.encode('utf-8'))
-    if GEOIP:
-        requests.post(settings.PUSH_STREAM_URL.format(id='glob'),
-                      headers={'Event-Id': event_id, 'Event-Type': 'loc'},
-                      data=json.dumps(ip_lookup(ip)))
+    session.post(settings.PUSH_STREAM_URL.format(id=channel),
+                 headers={'Event-Id': event_id, 'Event-Type': event_name},
+                 data=data.encode('utf-8'),
+                 timeout=settings.PUSH_STREAM_TIMEOUT)
+    if GEOIP and ip:
+        send_location(event_id, ip, session=session)
+
+
+def send_location(event_id, ip, session=requests):
+    """HTTP POST of the coordinates of ``ip`` to the map stream"""
+    session.post(settings.PUSH_STREAM_URL.format(id='glob'),
+                 headers={'Event-Id': event_id, 'Event-Type': 'loc'},
+                 data=json.dumps(ip_lookup(ip)),
+                 timeout=settings.PUSH_STREAM_TIMEOUT)
+
+
+class LogPublisher(object):
+    """
+    Pushes new logs to Nginx from a background thread, so saving a log
+    never waits on the push stream.
+
+    Logs waiting in the queue are sent together, one request per channel
+    with all of its lines, and the map stream gets each host once. When
+    the queue is full, or for ``PUSH_STREAM_BACKOFF`` seconds after a
+    failed request, new logs are not pushed at all: browsers fetch the
+    lines they missed on reload anyway.
+    """
+
+    def __init__(self, maxsize=None, batch_size=None):
+        self.maxsize = maxsize or settings.PUSH_STREAM_QUEUE_SIZE
+        self.batch_size = batch_size or settings.PUSH_STREAM_BATCH_SIZE
+        self.queue = Queue.Queue(self.maxsize)
+        self.session = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.down_until = 0
+
+    def publish(self, log):
+        if time.time() < self.down_until:
+            self.drop('backoff')
+            return
+        self.start()
+        try:
+            self.queue.put_nowait(log)
+        except Queue.Full:
+            self.drop('full')
+
+    def drop(self, reason):
+        statsd.incr(".".join(["push", "dropped", reason]))
+
+    def start(self):
+        """Starts the worker, again in a forked process"""
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            if self.pid != os.getpid():
+                # the parent's queue and connections are not ours
+                self.queue = Queue.Queue(self.maxsize)
+                self.session = push_session()
+            self.thread = threading.Thread(target=self.run,
+                                           name='log-publisher')
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def run(self):
+        while 1:
+            logs = [self.queue.get()]
+            while len(logs) < self.batch_size:
+                try:
+                    logs.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            statsd.gauge(".".join(["push", "queue"]), self.queue.qsize())
+            try:
+                self.send(logs)
+            except Exception:
+                LOG.error("Pushing %s logs failed", len(logs), exc_info=True)
+
+    def send(self, logs):
+        by_channel = OrderedDict()
+        for log in logs:
+            by_channel.setdefault(log.channel_id, []).append(log)
+        for channel_id, channel_logs in by_channel.iteritems():
+            html = render_to_string("logs/log_display.html",
+                                    {'message_list': channel_logs})
+            # the last id tells reconnecting browsers where we left off
+            event_id = channel_logs[-1].timestamp.isoformat()
+            self.post(channel_id, event_id, html)
+
+        if GEOIP:
+            hosts = OrderedDict()
+            for log in logs:
+                host = log.get_cleaned_host()
+                if host:
+                    hosts[host] = log.timestamp.isoformat()
+            for ip, event_id in hosts.iteritems():
+                self.post_location(event_id, ip)
+
+    def post(self, channel_id, event_id, html):
+        self._post(_send_event_with_id, "log", html, event_id, None,
+                   channel_id, session=self.session)
+
+    def post_location(self, event_id, ip):
+        self._post(send_location, event_id, ip, session=self.session)
+
+    def _post(self, func, *args, **kwargs):
+        if time.time() < self.down_until:
+            self.drop('backoff')
+            return
+        try:
+            with statsd.timer(".".join(["push", "post"])):
+                func(*args, **kwargs)
+        except requests.RequestException:
+            LOG.warn("Push stream unavailable, pausing realtime updates "
+                     "for %ss", settings.PUSH_STREAM_BACKOFF, exc_info=True)
+            statsd.incr(".".join(["push", "failed"]))
+            self.down_until = time.time() + settings.PUSH_STREAM_BACKOFF
+
 
 if settings.PUSH_STREAM_URL:
     send_event_with_id = _send_event_with_id
+    publish_log = LogPublisher().publish
 else:
     LOG.info('PUSH_STREAM_URL setting not defined. Realtime updates disabled.')
     send_event_with_id = lambda *a,**kw: None
-
+    publish_log = lambda log: None
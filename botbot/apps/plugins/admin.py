@@ -1,10 +1,25 @@
+import datetime
+
+import redis
 from django.contrib import admin
-from . import models
+from . import breaker, models
 
 class ActivePluginAdmin(admin.ModelAdmin):
-    list_display = ('__unicode__', 'configuration')
+    list_display = ('__unicode__', 'configuration', 'breaker_state')
     list_filter = ('channel', 'plugin')
     list_editable = ('configuration',)
 
+    def breaker_state(self, obj):
+        """State of the plugin's circuit breaker on the channel"""
+        try:
+            state, since = breaker.status(obj.plugin.slug, obj.channel_id)
+        except redis.RedisError:
+            return u'unknown'
+        if since is None:
+            return state
+        return u'{0} since {1:%Y-%m-%d %H:%M:%S} UTC'.format(
+            state, datetime.datetime.utcfromtimestamp(since))
+    breaker_state.short_description = 'Breaker'
+
 admin.site.register(models.Plugin)
 admin.site.register(models.ActivePlugin, ActivePluginAdmin)
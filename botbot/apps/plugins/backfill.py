@@ -0,0 +1,215 @@
+"""
+Replays the stored logs of channels through plugins, so a plugin enabled
+on a channel today can catch up on its history (``manage.py
+replay_logs``).
+
+Logs are read per channel in ``(timestamp, id)`` order, a batch at a time
+with keyset pagination on the ``(channel, timestamp)`` index, and are
+dispatched to the given plugins only. Replies are dropped, plugin storage
+writes go through as usual. The position of every channel is checkpointed
+in the ``plugins:backfill:<name>`` Redis hash after each batch, an
+interrupted backfill picks up where it stopped.
+
+Plugins are called without circuit breakers, every line is replayed. A
+channel whose plugin calls were rejected (their plugin was hung) stops at
+the end of the batch and isn't checkpointed past the last complete one,
+running the backfill again retries it.
+
+Only logs older than the moment the backfill first started are replayed,
+the plugin runner has been handling the ones after that.
+"""
+import logging
+import multiprocessing
+import time
+
+import redis
+from django.conf import settings
+from django.db import connections
+from django.utils.dateparse import parse_datetime
+
+from botbot.apps.bots.models import Channel
+from botbot.apps.logs.models import Log
+from .breaker import NoBreakers
+from .runner import Line, PluginRunner, all_plugins
+
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+# Field of the checkpoint hash holding the end of the backfill
+UNTIL = 'until'
+# Position of a channel that has been replayed completely
+DONE = 'done'
+
+# Log fields a Line is made of, in the order they are read
+FIELDS = ('id', 'timestamp', 'nick', 'text', 'command', 'host', 'raw')
+
+# BackfillRunner of a worker process
+_runner = None
+
+
+def checkpoint_key(name):
+    return 'plugins:backfill:{0}'.format(name)
+
+
+class BackfillRunner(PluginRunner):
+    """A PluginRunner that drops what plugins write back to channels"""
+
+    def __init__(self, slugs, **kwargs):
+        super(BackfillRunner, self).__init__(transport='list', **kwargs)
+        # every line has to reach the plugins, and the live runners'
+        # breakers aren't this one's to report on
+        self.executor.breakers = NoBreakers()
+        self.dropped_replies = 0
+        self.registry.load()
+        for plugin in all_plugins():
+            if plugin.slug in slugs:
+                self.register(plugin)
+
+    def write(self, commands, buffered=True):
+        self.dropped_replies += len(commands)
+
+    def send_outbox(self):
+        self.outbox = []
+
+
+class Backfill(object):
+    """Replays the logs of channels for ``runner``'s plugins"""
+
+    def __init__(self, runner, name, connection, batch_size=5000):
+        self.runner = runner
+        self.key = checkpoint_key(name)
+        self.connection = connection
+        self.batch_size = batch_size
+
+    def until(self, default):
+        """End of the backfill, set by the first run"""
+        self.connection.hsetnx(self.key, UNTIL, default.isoformat())
+        return parse_datetime(self.connection.hget(self.key, UNTIL))
+
+    def position(self, channel_id):
+        """``(timestamp, id)`` of the last log replayed, DONE or None"""
+        value = self.connection.hget(self.key, channel_id)
+        if not value or value == DONE:
+            return value
+        timestamp, pk = value.rsplit(' ', 1)
+        return parse_datetime(timestamp), int(pk)
+
+    def save_position(self, channel_id, value):
+        if value != DONE:
+            value = u'{0} {1}'.format(value[0].isoformat(), value[1])
+        self.connection.hset(self.key, channel_id, value)
+
+    def batches(self, channel, after, until):
+        """Yields the channel's logs as lists of FIELDS tuples"""
+        table = Log._meta.db_table
+        while 1:
+            logs = Log.objects.filter(channel=channel, timestamp__lt=until)
+            if after is not None:
+                # row comparison, so the (channel, timestamp) index is used
+                logs = logs.extra(
+                    where=['("{0}"."timestamp", "{0}"."id") > (%s, %s)'.format(
+                        table)],
+                    params=list(after))
+            rows = list(logs.order_by('timestamp', 'id').values_list(
+                *FIELDS)[:self.batch_size])
+            if not rows:
+                return
+            yield rows
+            after = rows[-1][1], rows[-1][0]
+
+    def line(self, channel, row):
+        pk, timestamp, nick, text, command, host, raw = row
+        line = Line({
+            'ChatBotId': channel.chatbot_id,
+            'Channel': channel.name,
+            'Command': command or u'PRIVMSG',
+            'Content': text,
+            'User': nick,
+            'Host': host,
+            'Raw': raw,
+            'Received': None,
+        }, self.runner)
+        # no need to go through the bot's timestamp format
+        line._received_cache = timestamp
+        return line
+
+    def run(self, channel_id, until):
+        """
+        Replays a channel, returns the number of lines replayed, or None
+        when plugin calls were rejected and it has to be run again.
+        """
+        position = self.position(channel_id)
+        if position == DONE:
+            return 0
+        channel = Channel.objects.get(pk=channel_id)
+        replayed = 0
+        rejected = self.runner.executor.rejected
+        for rows in self.batches(channel, position, until):
+            for row in rows:
+                line = self.line(channel, row)
+                if not line.is_valid():
+                    continue
+                try:
+                    self.runner.dispatch(line)
+                except Exception:
+                    LOG.error("Line Dispatch Failed", exc_info=True, extra={
+                        "line": row[0]
+                    })
+            self.runner.executor.check()
+            self.runner.send_storage_writes()
+            self.runner.flush()
+            if self.runner.executor.rejected != rejected:
+                LOG.error('Plugin calls were rejected, channel %s stopped '
+                          'after %s lines', channel_id, replayed)
+                return None
+            # checkpointed once the batch's storage writes went out
+            self.save_position(channel_id, (rows[-1][1], rows[-1][0]))
+            replayed += len(rows)
+        self.runner.executor.drain()
+        self.runner.send_storage_writes()
+        self.runner.flush(force=True)
+        self.save_position(channel_id, DONE)
+        return replayed
+
+
+def connect():
+    return redis.StrictRedis.from_url(settings.REDIS_PLUGIN_STORAGE_URL)
+
+
+def start_worker(slugs, executor):
+    global _runner
+    _runner = BackfillRunner(slugs, executor=executor)
+
+
+def replay_channel(args):
+    """Replays a channel in a worker, returns ``(channel id, lines, s)``"""
+    channel_id, name, until, batch_size = args
+    start = time.time()
+    backfill = Backfill(_runner, name, connect(), batch_size)
+    try:
+        replayed = backfill.run(channel_id, until)
+    except Exception:
+        LOG.error('Backfill of channel %s failed', channel_id, exc_info=True)
+        replayed = None
+    return channel_id, replayed, time.time() - start
+
+
+def replay_channels(channel_ids, slugs, name, until, workers=1,
+                    batch_size=5000, executor='inline'):
+    """
+    Replays channels on ``workers`` processes, yields ``(channel id,
+    lines, seconds)`` as channels are done (lines is None if it failed).
+    """
+    until = Backfill(None, name, connect()).until(until)
+    tasks = [(channel_id, name, until, batch_size)
+             for channel_id in channel_ids]
+    # Children must not inherit the parent's database connections
+    connections.close_all()
+    pool = multiprocessing.Pool(workers, start_worker, (slugs, executor))
+    try:
+        for result in pool.imap_unordered(replay_channel, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
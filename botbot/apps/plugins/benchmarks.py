@@ -0,0 +1,354 @@
+"""
+Micro-benchmarks for the plugin runner hot path.
+
+Each benchmark compares the previous implementation with the current one
+and returns ``{label: lines per second}`` (or whatever else it measures).
+Run them with::
+
+    manage.py bench_plugins [name ...]
+"""
+import datetime
+import gc
+import json
+import re
+import subprocess
+import sys
+import time
+
+import redis
+from django.conf import settings
+from django.utils.timezone import utc
+
+from . import codec
+from .plans import real_plugin_class
+from .plugin import RealPluginMixin
+from .routing import RouteTable, plugin_routes
+from .runner import Line, all_plugins
+from .storage import HashLayout, KeyLayout
+
+
+SAMPLE_LINES = [
+    u'hello everyone',
+    u'does anybody know why my migrations are not applied?',
+    u'help',
+    u'help images',
+    u'ping',
+    u'lol',
+    u'see https://github.com/BotBotMe/botbot-web/issues/12',
+    u'what is the time in Napier, New Zealand?',
+    u'thanks!',
+    u'!motivate botbot',
+    u'karma++',
+    u'brb',
+]
+
+
+def lines_per_second(func, lines, iterations):
+    start = time.time()
+    for _ in xrange(iterations):
+        for text in lines:
+            func(text)
+    return iterations * len(lines) / (time.time() - start)
+
+
+def bench_routing(iterations=2000):
+    """Route matching with every plugin active on the channel"""
+    legacy = {}
+    tables = {}
+    slugs = set()
+    for plugin in all_plugins():
+        for router, rule, attr in plugin_routes(plugin):
+            if router == 'firehose':
+                continue
+            slugs.add(plugin.slug)
+            legacy.setdefault(router, {}).setdefault(
+                plugin.slug, []).append(rule)
+            tables.setdefault(router, RouteTable()).add(
+                plugin.slug, rule, attr, plugin)
+
+    def legacy_matches(text):
+        matched = []
+        for router in legacy.values():
+            for slug in slugs.intersection(router.viewkeys()):
+                for rule in router[slug]:
+                    if re.match(rule, text, re.IGNORECASE):
+                        matched.append(rule)
+        return matched
+
+    def compiled_matches(text):
+        return [route.rule for table in tables.values()
+                for route, _ in table.matches(text, slugs)]
+
+    for text in SAMPLE_LINES:
+        assert (sorted(legacy_matches(text)) ==
+                sorted(compiled_matches(text))), text
+
+    return {
+        'routes': sum(len(table.routes) for table in tables.values()),
+        're.match per rule': lines_per_second(legacy_matches, SAMPLE_LINES,
+                                              iterations),
+        'compiled table': lines_per_second(compiled_matches, SAMPLE_LINES,
+                                           iterations),
+    }
+
+
+class StubChannel(object):
+    """Just enough of a Channel for RealPluginMixin"""
+    pk = 1
+    name = u'#bench'
+    fingerprint = 'bench'
+
+
+class StubApp(object):
+    """Just enough of a PluginRunner for RealPluginMixin"""
+
+    def plugin_config(self, channel, slug):
+        return {}
+
+
+def garbage_per_line(func, iterations):
+    """
+    Objects left for the cyclic garbage collector per call, e.g. the
+    classes (always part of a reference cycle) created per line.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        for _ in xrange(iterations):
+            func()
+        return (len(gc.get_objects()) - before) / float(iterations)
+    finally:
+        gc.enable()
+        gc.collect()
+
+
+def bench_plugin_setup(iterations=2000):
+    """
+    Getting the channel's instance of every plugin, as for a line matching
+    all of them. Rates are plugin calls per second.
+    """
+    channel = StubChannel()
+    app = StubApp()
+    plugins = list(all_plugins())
+
+    def class_per_line():
+        for fake_plugin in plugins:
+            class RealPlugin(RealPluginMixin, fake_plugin.__class__):
+                pass
+            RealPlugin(slug=fake_plugin.slug, channel=channel,
+                       chatbot_id=1, app=app)
+
+    plan = dict((fake_plugin.slug, real_plugin_class(fake_plugin.__class__)(
+        slug=fake_plugin.slug, channel=channel, chatbot_id=1, app=app))
+        for fake_plugin in plugins)
+
+    def plan_lookup():
+        for fake_plugin in plugins:
+            plan[fake_plugin.slug]
+
+    def calls_per_second(func):
+        return len(plugins) * lines_per_second(lambda _: func(), [None],
+                                               iterations)
+
+    return {
+        'plugins': len(plugins),
+        'class per line': calls_per_second(class_per_line),
+        'class per line, gc objects per call': garbage_per_line(
+            class_per_line, iterations) / len(plugins),
+        'dispatch plan': calls_per_second(plan_lookup),
+        'dispatch plan, gc objects per call': garbage_per_line(
+            plan_lookup, iterations) / len(plugins),
+    }
+
+
+def bench_storage_memory(iterations=50):
+    """
+    Redis memory used by a synthetic plugin storage dataset in the 'keys'
+    and 'hash' layouts: 3 plugins on 200 channels with ``iterations``
+    values each (nicks with counters and timestamps). Runs against
+    REDIS_PLUGIN_STORAGE_URL under chatbot id 0, which is cleaned up.
+    """
+    connection = redis.StrictRedis.from_url(settings.REDIS_PLUGIN_STORAGE_URL)
+    namespaces = [(0, channel_id, slug) for channel_id in range(1, 201)
+                  for slug in ('karma', 'seen', 'last')]
+    values = dict((u'nick{0}'.format(i), str(1400000000 + i * 7919))
+                  for i in range(iterations))
+    results = {'values': len(namespaces) * len(values)}
+
+    def used_memory():
+        return connection.info('memory')['used_memory']
+
+    for layout in (KeyLayout(connection),
+                   HashLayout(connection, max_fields=0, namespace_ttl=0)):
+        before = used_memory()
+        pipe = connection.pipeline(transaction=False)
+        for namespace in namespaces:
+            layout.set_many(pipe, namespace, values)
+        pipe.execute()
+        used = used_memory() - before
+        results['{0} bytes'.format(layout.name)] = used
+        results['{0} bytes per value'.format(layout.name)] = (
+            used / float(results['values']))
+
+        pipe = connection.pipeline(transaction=False)
+        for namespace in namespaces:
+            if layout.name == 'keys':
+                pipe.delete(*[layout.key(namespace, key) for key in values])
+            else:
+                pipe.delete(*layout.keys(namespace))
+        pipe.execute()
+    return results
+
+
+def legacy_convert_nano_timestamp(nano_timestamp):
+    """convert_nano_timestamp as it was, with strptime"""
+    rfc3339, nano_part = nano_timestamp.split('.')
+    micro = nano_part[:-1]
+    if len(nano_part) > 6:
+        micro = micro[:6]
+    rfc3339micro = ''.join([rfc3339, '.', micro, 'Z'])
+    return datetime.datetime.strptime(
+        rfc3339micro, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=utc)
+
+
+class LegacyLine(object):
+    """Line as it was: a __dict__ and every field decoded up front"""
+    _chatbot = Line.__dict__['_chatbot']
+    check_direct_message = Line.__dict__['check_direct_message']
+
+    def __init__(self, packet, app):
+        self.full_text = packet['Content']
+        self.text = packet['Content']
+        self.user = packet['User']
+        self._registry = app.registry
+        self._chatbot_id = packet['ChatBotId']
+        self._raw = packet['Raw']
+        self._channel_name = packet['Channel'].strip()
+        self._command = packet['Command']
+        self._is_message = packet['Command'] == 'PRIVMSG'
+        self._host = packet['Host']
+        self._received = legacy_convert_nano_timestamp(packet['Received'])
+        self.is_direct_message = self.check_direct_message()
+
+
+class StubChatBot(object):
+    nick = u'botbot'
+
+
+class StubRegistry(object):
+    def chatbot(self, chatbot_id):
+        return StubChatBot()
+
+
+class StubRunner(object):
+    registry = StubRegistry()
+
+
+def sample_packets():
+    return [{
+        'ChatBotId': 1,
+        'Channel': u'#botbot ',
+        'Command': u'PRIVMSG',
+        'Content': text,
+        'User': u'someone',
+        'Host': u'~someone@192.0.2.1',
+        'Raw': u':someone!~someone@192.0.2.1 PRIVMSG #botbot :' + text,
+        'Received': u'2014-01-27T16:35:53.{0:09d}Z'.format(i * 7919),
+    } for i, text in enumerate(SAMPLE_LINES)]
+
+
+def line_size(line):
+    """Bytes of a Line beyond the strings it shares with its packet"""
+    size = sys.getsizeof(line)
+    if hasattr(line, '__dict__'):
+        size += sys.getsizeof(line.__dict__)
+        received = line.__dict__.get('_received')
+    else:
+        received = getattr(line, '_received_cache', None)
+    if received is not None:
+        size += sys.getsizeof(received)
+    return size
+
+
+def bench_line(iterations=2000):
+    """
+    Turning decoded packets into Lines, with and without the timestamp
+    being used, and the memory a Line takes.
+    """
+    app = StubRunner()
+    packets = sample_packets()
+    results = {}
+    for label, cls in (('legacy', LegacyLine), ('slotted', Line)):
+        results[label] = lines_per_second(lambda packet: cls(packet, app),
+                                          packets, iterations)
+        results[label + ', timestamp used'] = lines_per_second(
+            lambda packet: cls(packet, app)._received, packets, iterations)
+        results[label + ', bytes per line'] = line_size(
+            cls(packets[0], app))
+    return results
+
+
+def bench_codec(iterations=2000):
+    """
+    Decoding packets from the bus with the standard json module, the fast
+    JSON library installed and msgpack (if installed), with and without
+    the Raw field, and the size of a packet in each encoding.
+    """
+    packets = sample_packets()
+    encoded = [json.dumps(packet) for packet in packets]
+    results = {
+        'json bytes per packet': sum(map(len, encoded)) / len(encoded),
+        'json': lines_per_second(json.loads, encoded, iterations),
+        'codec.decode ({0})'.format(codec.fast_json.__name__): (
+            lines_per_second(
+                codec.decode, encoded, iterations)),
+    }
+    if codec.msgpack is not None:
+        for label, transform in (('msgpack', lambda packet: packet),
+                                 ('msgpack lean', codec.lean)):
+            encoded = [codec.encode(transform(packet), 'msgpack')
+                       for packet in packets]
+            results[label + ' bytes per packet'] = (
+                sum(map(len, encoded)) / len(encoded))
+            results[label] = lines_per_second(codec.decode, encoded,
+                                              iterations)
+    return results
+
+
+# Starts a plugin runner as run_plugins does, prints seconds and max RSS
+STARTUP_SCRIPT = """
+import resource, sys, time
+start = time.time()
+import django
+django.setup()
+from botbot.apps.plugins.runner import PluginRunner
+app = PluginRunner(executor='inline')
+app.register_all_plugins(lazy=sys.argv[1] == 'lazy')
+print time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+"""
+
+
+def bench_startup(iterations=3):
+    """
+    Seconds and max RSS (kB) for a fresh process to register the plugins,
+    importing them all or lazily from the manifest, best of ``iterations``.
+    """
+    results = {}
+    for mode in ('eager', 'lazy'):
+        runs = [map(float, subprocess.check_output(
+            [sys.executable, '-c', STARTUP_SCRIPT, mode]).split()[-2:])
+            for _ in range(iterations)]
+        results[mode + ' seconds'] = min(seconds for seconds, _ in runs)
+        results[mode + ' max rss'] = min(rss for _, rss in runs)
+    return results
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'line': bench_line,
+    'plugin_setup': bench_plugin_setup,
+    'startup': bench_startup,
+    'routing': bench_routing,
+    'storage_memory': bench_storage_memory,
+}
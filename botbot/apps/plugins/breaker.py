@@ -0,0 +1,238 @@
+"""
+Circuit breakers for plugin calls, one per plugin and channel.
+
+A breaker opens when, over a PLUGIN_BREAKER_WINDOW, at least
+PLUGIN_BREAKER_MIN_CALLS calls were made and PLUGIN_BREAKER_ERROR_RATE of
+them failed. A call fails when it raises, times out or takes longer than
+PLUGIN_BREAKER_SLOW_CALL seconds. While the breaker is open the plugin
+isn't called on that channel. After PLUGIN_BREAKER_COOLDOWN seconds it
+half-opens: a single call is let through as a probe, and it closes the
+breaker if it succeeds or opens it again if it fails.
+
+Breakers that aren't closed are listed in the ``plugins:breakers`` Redis
+hash, for the admin, along with the runner they belong to and the end of
+their cooldown. An entry is only good until then, past it the breaker is
+due to let a call through, or its runner is gone. A runner that starts
+removes the entries of its previous run and the expired ones, and only
+removes its own when a breaker closes.
+"""
+import json
+import logging
+import socket
+import threading
+import time
+
+import redis
+from django.conf import settings
+from django_statsd.clients import statsd
+
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+# Hash of '<slug>:<channel id>' -> JSON status of breakers not closed
+STATUS_KEY = 'plugins:breakers'
+
+# Removes field ARGV[1] of KEYS[1] if it's the status of runner ARGV[2]
+CLOSE_SCRIPT = """
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+if value and cjson.decode(value)['runner'] == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+_status_bus = None
+
+
+class Breaker(object):
+    """Breaker of one plugin on one channel, see BreakerBoard"""
+
+    def __init__(self, window, min_calls, error_rate, slow_call, cooldown):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.since = time.time()
+        # calls and failures since window_start, a fixed window
+        self.window_start = self.since
+        self.calls = 0
+        self.failures = 0
+        # a half-open breaker has let its probe through
+        self.probing = False
+
+    def allow(self, now):
+        """Whether a call may be made, half-opens the breaker when due"""
+        if self.state == OPEN and now - self.since >= self.cooldown:
+            self.move(HALF_OPEN, now)
+        if self.state == OPEN:
+            return False
+        if self.state == HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+
+    def record(self, failed, elapsed, now):
+        """Counts a finished call, returns the new state if it changed"""
+        failed = failed or elapsed > self.slow_call
+        if self.state == HALF_OPEN:
+            return self.move(OPEN if failed else CLOSED, now)
+        if self.state == OPEN:
+            # a call made before the breaker opened
+            return None
+        if now - self.window_start > self.window:
+            self.window_start = now
+            self.calls = self.failures = 0
+        self.calls += 1
+        self.failures += failed
+        if (self.calls >= self.min_calls and
+                self.failures >= self.error_rate * self.calls):
+            return self.move(OPEN, now)
+        return None
+
+    def move(self, state, now):
+        self.state = state
+        self.since = now
+        self.probing = False
+        self.window_start = now
+        self.calls = self.failures = 0
+        return state
+
+
+class BreakerBoard(object):
+    """
+    The breakers of a runner. ``connection`` is the Redis the status of
+    breakers that aren't closed is written to, if any, as the runner
+    ``name``, which stays the same across its restarts.
+    """
+
+    def __init__(self, connection=None, window=None, min_calls=None,
+                 error_rate=None, slow_call=None, cooldown=None, name=None):
+        self.connection = connection
+        self.name = name or socket.gethostname()
+        self.settings = {
+            'window': window or settings.PLUGIN_BREAKER_WINDOW,
+            'min_calls': min_calls or settings.PLUGIN_BREAKER_MIN_CALLS,
+            'error_rate': error_rate or settings.PLUGIN_BREAKER_ERROR_RATE,
+            'slow_call': slow_call or settings.PLUGIN_BREAKER_SLOW_CALL,
+            'cooldown': cooldown or settings.PLUGIN_BREAKER_COOLDOWN,
+        }
+        # (slug, channel id) -> Breaker
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def allow(self, slug, channel_id):
+        """Whether the plugin may be called on the channel"""
+        with self.lock:
+            breaker = self.breakers.get((slug, channel_id))
+            if breaker is None:
+                return True
+            state = breaker.state
+            allowed = breaker.allow(time.time())
+            changed = breaker.state != state
+        if changed:
+            self.changed(slug, channel_id, breaker)
+        if not allowed:
+            statsd.incr(".".join(["plugins", slug, "breaker", "skipped"]))
+        return allowed
+
+    def record(self, slug, channel_id, failed, elapsed):
+        """Counts a finished (or timed out) call"""
+        with self.lock:
+            breaker = self.breakers.get((slug, channel_id))
+            if breaker is None:
+                breaker = self.breakers[(slug, channel_id)] = Breaker(
+                    **self.settings)
+            changed = breaker.record(failed, elapsed, time.time())
+        if changed:
+            self.changed(slug, channel_id, breaker)
+
+    def changed(self, slug, channel_id, breaker):
+        if breaker.state == OPEN:
+            LOG.warn('Plugin %s is failing on channel %s, not calling it '
+                     'for %ss', slug, channel_id, breaker.cooldown)
+            statsd.incr(".".join(["plugins", slug, "breaker", "opened"]))
+        else:
+            LOG.info('Breaker of plugin %s on channel %s is %s', slug,
+                     channel_id, breaker.state)
+        with self.lock:
+            opened = sum(1 for each in self.breakers.itervalues()
+                         if each.state != CLOSED)
+        statsd.gauge(".".join(["plugins", "breakers", "open"]), opened)
+        if self.connection is None:
+            return
+        field = '{0}:{1}'.format(slug, channel_id)
+        try:
+            if breaker.state == CLOSED:
+                # unless another runner has it open since
+                self.connection.eval(CLOSE_SCRIPT, 1, STATUS_KEY, field,
+                                     self.name)
+            else:
+                self.connection.hset(STATUS_KEY, field, json.dumps({
+                    'state': breaker.state,
+                    'since': breaker.since,
+                    'until': breaker.since + breaker.cooldown,
+                    'runner': self.name,
+                }))
+        except redis.RedisError:
+            LOG.warn('Could not save the status of breaker %s', field,
+                     exc_info=True)
+
+    def clear(self):
+        """
+        Removes the statuses left by the previous run of the runner, and
+        the expired ones, when it starts.
+        """
+        if self.connection is None:
+            return
+        now = time.time()
+        try:
+            stale = [field for field, value
+                     in self.connection.hscan_iter(STATUS_KEY)
+                     if is_stale(json.loads(value), self.name, now)]
+            if stale:
+                self.connection.hdel(STATUS_KEY, *stale)
+        except redis.RedisError:
+            LOG.warn('Could not clear the status of breakers', exc_info=True)
+
+
+def is_stale(value, runner, now):
+    """Whether a status is past its cooldown or ``runner``'s"""
+    # statuses without 'until' were written by older runners
+    return value.get('until', 0) < now or value.get('runner') == runner
+
+
+class NoBreakers(object):
+    """A BreakerBoard letting every call through, e.g. for a backfill"""
+    connection = None
+
+    def clear(self):
+        pass
+
+    def allow(self, slug, channel_id):
+        return True
+
+    def record(self, slug, channel_id, failed, elapsed):
+        pass
+
+
+def status(slug, channel_id):
+    """
+    ``(state, since)`` of the breaker of a plugin on a channel, as last
+    reported by a runner and until the end of its cooldown.
+    """
+    global _status_bus
+    if _status_bus is None:
+        _status_bus = redis.StrictRedis.from_url(
+            settings.REDIS_PLUGIN_QUEUE_URL)
+    value = _status_bus.hget(STATUS_KEY, '{0}:{1}'.format(slug, channel_id))
+    if not value:
+        return CLOSED, None
+    value = json.loads(value)
+    if value.get('until', 0) < time.time():
+        return CLOSED, None
+    return value['state'], value['since']
@@ -0,0 +1,72 @@
+"""
+Encoding of the packets on the plugin bus.
+
+The bot writes JSON. Packets may also be msgpack, prefixed with a version
+byte so consumers tell them apart from JSON (which starts with ``{``);
+``decode`` handles both, so producers can switch formats one at a time.
+
+JSON is decoded with the fastest library installed: ujson, simplejson
+(with its C speedups) or the standard library. msgpack is optional too,
+it is only needed to write or read binary packets.
+"""
+import json
+
+try:
+    import ujson as fast_json
+except ImportError:
+    try:
+        import simplejson as fast_json
+    except ImportError:
+        fast_json = json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+# First byte of a version 1 binary (msgpack) packet
+BINARY_V1 = '\x01'
+
+# Fields plugins can live without, see lean()
+LEAN_FIELDS = ('Raw',)
+
+
+def _unpackb(data):
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except TypeError:
+        # msgpack < 0.5.2
+        return msgpack.unpackb(data, encoding='utf-8')
+
+
+def decode(data):
+    """A packet from the bus as a dict, whatever its encoding"""
+    if data[:1] == BINARY_V1:
+        if msgpack is None:
+            raise ImproperlyConfigured('Binary packet on the plugin bus but '
+                                       'msgpack is not installed')
+        return _unpackb(data[1:])
+    if data[:1] < ' ' and data[:1] not in ('\t', '\n', '\r'):
+        raise ValueError('Unknown packet version {0!r}'.format(data[:1]))
+    return fast_json.loads(data)
+
+
+def encode(packet, kind=None):
+    """Encodes a packet as ``json`` or ``msgpack`` (PLUGIN_CODEC)"""
+    kind = kind or settings.PLUGIN_CODEC
+    if kind == 'msgpack':
+        if msgpack is None:
+            raise ImproperlyConfigured('PLUGIN_CODEC is msgpack but msgpack '
+                                       'is not installed')
+        return BINARY_V1 + msgpack.packb(packet, use_bin_type=True)
+    return json.dumps(packet)
+
+
+def lean(packet):
+    """The packet without the fields only some plugins (``needs_raw``) use"""
+    return dict((key, value) for key, value in packet.iteritems()
+                if key not in LEAN_FIELDS)
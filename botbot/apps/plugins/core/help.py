@@ -1,5 +1,7 @@
 # pylint: disable=W0212
 from botbot.apps.bots.utils import reverse_channel
+from botbot.apps.plugins.decorators import memoize
+from botbot.apps.plugins.models import Plugin as PluginModel
 from botbot_plugins.base import BasePlugin
 from botbot_plugins.decorators import listens_to_mentions
 
@@ -19,27 +21,28 @@ class Plugin(BasePlugin):
 
         {{ nick }}: help images
     """
+    @memoize()
     @listens_to_mentions(ur'^help$')
     def respond_to_help(self, line):
-        plugins = [plgn.slug for plgn in line._channel.plugins.all()]
+        # active plugins from the runner's registry, no query
+        plugins = sorted(line._active_plugin_slugs)
         help_url = get_help_url(line._channel)
         return u'Available plugins: {0} ({1})'.format(', '.join(plugins),
                                                       help_url)
 
+    @memoize()
     @listens_to_mentions(ur'^help (?P<command>.*)')
     def respond_to_plugin_help(self, line, command):
         """Returns first line of docstring and link to more"""
         slug = command.strip()
-        try:
-            plugin = line._channel.plugins.filter(slug=slug)[0]
-            help_url = get_help_url(line._channel)
-            response = [
-                plugin.user_docs.strip().split('\n')[0],
-                'More details: {0}#{1}'.format(help_url, command)
-            ]
-            return '\n'.join(response)
-        except IndexError:
+        if slug not in line._active_plugin_slugs:
             return 'Sorry, that plugin is not available.'
+        help_url = get_help_url(line._channel)
+        response = [
+            PluginModel(slug=slug).user_docs.strip().split('\n')[0],
+            'More details: {0}#{1}'.format(help_url, slug)
+        ]
+        return '\n'.join(response)
 
 
 def get_help_url(channel):
@@ -1,8 +1,17 @@
+import logging
+import time
+
+from django.conf import settings
+from django_statsd.clients import statsd
+
 from botbot.apps.logs.models import Log
 from botbot.apps.plugins.utils import convert_nano_timestamp
 from botbot_plugins.base import BasePlugin
 import botbot_plugins.config as config
 
+LOG = logging.getLogger('botbot.plugin_runner')
+
+
 class Config(config.BaseConfig):
     ignore_prefix = config.Field(
         default="!-",
@@ -10,6 +19,59 @@ class Config(config.BaseConfig):
         help_text="Don't log lines starting with this string"
     )
 
+
+class LogBuffer(object):
+    """
+    Logs waiting to be written in one go, every ``LOGGER_BATCH_SIZE`` lines
+    or ``LOGGER_BATCH_INTERVAL`` ms, whichever comes first.
+    """
+
+    def __init__(self):
+        self.logs = []
+        self.started = None
+
+    def add(self, log):
+        if not self.logs:
+            self.started = time.time()
+        self.logs.append(log)
+        if len(self.logs) >= settings.LOGGER_BATCH_SIZE:
+            self.flush()
+
+    def is_due(self):
+        return bool(self.logs) and (
+            (time.time() - self.started) * 1000 >=
+            settings.LOGGER_BATCH_INTERVAL)
+
+    def flush(self):
+        logs, self.logs = self.logs, []
+        if not logs:
+            return
+        try:
+            with statsd.timer(".".join(["plugins", "logger", "flush"])):
+                Log.objects.ingest(logs)
+        except Exception:
+            LOG.warn("Logging %s lines at once failed, logging them one by "
+                     "one", len(logs), exc_info=True)
+            self.ingest_each(logs)
+
+    def ingest_each(self, logs):
+        """Saves logs one at a time, so one bad line only loses itself"""
+        failed = 0
+        for log in logs:
+            try:
+                Log.objects.ingest([log])
+            except Exception:
+                failed += 1
+                LOG.error("Logging a line failed", exc_info=True, extra={
+                    "line": log.text
+                })
+        if failed:
+            statsd.incr(".".join(["plugins", "logger", "dropped"]), failed)
+
+
+BUFFER = LogBuffer()
+
+
 class Plugin(BasePlugin):
     """
     Logs all activity.
@@ -18,6 +80,10 @@ class Plugin(BasePlugin):
     You can read and search them at {{ SITE }}{{ channel.get_absolute_url }}.
     """
     config_class = Config
+    # lines have to be logged in the order they came in
+    ordered = True
+    # the raw IRC line is logged too
+    needs_raw = True
 
     def logit(self, line):
         """Log a message to the database"""
@@ -32,8 +98,8 @@ class Plugin(BasePlugin):
                 text = text[7:]
             
             if not (ignore_prefix and text.startswith(ignore_prefix)):
-                Log.objects.create(
-                    channel_id=line._channel.pk,
+                log = Log(
+                    channel=line._channel,
                     timestamp=line._received,
                     nick=line.user,
                     text=line.full_text,
@@ -41,5 +107,17 @@ class Plugin(BasePlugin):
                     host=line._host,
                     command=line._command,
                     raw=line._raw)
+                if settings.LOGGER_BATCH_SIZE > 1:
+                    BUFFER.add(log)
+                else:
+                    log.save()
 
     logit.route_rule = ('firehose', ur'(.*)')
+
+    def flush(self, force=False):
+        """
+        Writes buffered lines once they are due, called by the plugin runner
+        between batches and (with ``force``) on shutdown.
+        """
+        if force or BUFFER.is_due():
+            BUFFER.flush()
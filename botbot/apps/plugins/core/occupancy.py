@@ -0,0 +1,266 @@
+"""
+Counts the users of channels from the lines the plugin runner sees.
+
+A channel's nicks come from the NAMES reply the bot gets when it joins,
+then follow JOIN, PART, QUIT, NICK and KICK lines (the bot sends QUIT and
+NICK lines to every channel the user is in). The count of the channels
+that changed goes to the ``plugins:occupancy`` Redis hash after every
+batch, that's what ``Channel.current_size`` reads. Every
+OCCUPANCY_INTERVAL seconds every count is saved to the hour of its
+channel's UserCount, with one statement for all the channels.
+
+The nicks are kept in Redis too, so a restarted runner carries on
+counting. A channel whose nicks were never seen isn't counted until the
+bot joins it again.
+"""
+import datetime
+import logging
+import time
+
+import redis
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django_statsd.clients import statsd
+
+from botbot.apps.bots.models import UserCount
+from botbot.apps.plugins.utils import OCCUPANCY_KEY
+from botbot_plugins.base import BasePlugin
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+RPL_NAMREPLY = u'353'
+RPL_ENDOFNAMES = u'366'
+COMMANDS = frozenset([u'JOIN', u'PART', u'QUIT', u'NICK', u'KICK',
+                      RPL_NAMREPLY, RPL_ENDOFNAMES])
+
+# Channel modes (op, voice...) prefixed to nicks in NAMES replies
+NICK_PREFIXES = u'~&@%+!'
+
+# Nicks of the channels last seen, for runner restarts
+NICKS_TTL = 24 * 60 * 60
+
+
+def nicks_key(channel_id):
+    return 'plugins:occupancy:{0}:nicks'.format(channel_id)
+
+
+def names(line):
+    """Nicks of a NAMES reply, without their modes"""
+    text = line.text
+    if not text and line._raw:
+        text = line._raw.rsplit(u' :', 1)[-1]
+    return [name.lstrip(NICK_PREFIXES).split(u'!')[0].lower()
+            for name in (text or u'').split()]
+
+
+def kicked_nick(line):
+    """``:op!user@host KICK #channel nick :reason``"""
+    parts = (line._raw or u'').split()
+    try:
+        return parts[parts.index(u'KICK') + 2].lower()
+    except (ValueError, IndexError):
+        return None
+
+
+def save_counts(counts, when):
+    """
+    Sets the hour of ``when`` to ``counts`` (channel id -> users) in the
+    channels' UserCount of the day, updating the existing ones and creating
+    the others in one statement. If another runner created one of them in
+    the meantime, the statement is run again and updates it.
+    """
+    if not counts:
+        return
+    hour = when.hour
+    table = connection.ops.quote_name(UserCount._meta.db_table)
+    params = []
+    for channel_id, users in counts.iteritems():
+        params.extend([channel_id, when.date(), users])
+    # Postgres arrays start at 1, counts[hour] in Python is [hour + 1] here
+    sql = u"""
+        WITH current (channel_id, dt, users) AS (VALUES {values}),
+        updated AS (
+            UPDATE {table} SET counts[%s] = current.users FROM current
+            WHERE {table}.channel_id = current.channel_id
+              AND {table}.dt = current.dt
+            RETURNING {table}.channel_id)
+        INSERT INTO {table} (channel_id, dt, counts)
+        SELECT channel_id, dt, array_fill(NULL::int, ARRAY[%s]) || users ||
+                               array_fill(NULL::int, ARRAY[%s])
+        FROM current
+        WHERE channel_id NOT IN (SELECT channel_id FROM updated)""".format(
+        values=u', '.join([u'(%s, %s::date, %s)'] * len(counts)),
+        table=table)
+    params.extend([hour + 1, hour, 23 - hour])
+    for attempt in (1, 2):
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(sql, params)
+            return
+        except IntegrityError:
+            if attempt == 2:
+                raise
+
+
+class Occupancy(object):
+    """The nicks in the channels of a runner process"""
+
+    def __init__(self):
+        # channel id -> lowercased nicks, for the channels being counted
+        self.members = {}
+        # channel id -> nicks of a NAMES reply coming in
+        self.names = {}
+        # channels looked up in Redis since the process started
+        self.restored = set()
+        # channels whose count changed since the last flush
+        self.changed = set()
+        # channels whose nicks changed since they were last saved
+        self.unsaved = set()
+        # channels the bot left
+        self.left = set()
+        self.saved = time.time()
+        self.connection = None
+
+    def redis(self):
+        if self.connection is None:
+            self.connection = redis.StrictRedis.from_url(
+                settings.REDIS_PLUGIN_STORAGE_URL)
+        return self.connection
+
+    def nicks(self, channel_id):
+        """The channel's nicks, None while they aren't known"""
+        if (channel_id not in self.members and
+                channel_id not in self.restored):
+            self.restored.add(channel_id)
+            try:
+                nicks = self.redis().smembers(nicks_key(channel_id))
+            except redis.RedisError:
+                LOG.warn('Could not restore the nicks of channel %s',
+                         channel_id, exc_info=True)
+                nicks = None
+            if nicks:
+                self.members[channel_id] = set(nick.decode('utf-8')
+                                               for nick in nicks)
+        return self.members.get(channel_id)
+
+    def touch(self, channel_id):
+        self.changed.add(channel_id)
+        self.unsaved.add(channel_id)
+
+    def see(self, line):
+        """Follows a line of the channel"""
+        command = line._command
+        if command not in COMMANDS:
+            return
+        channel_id = line._channel.pk
+        if command == RPL_NAMREPLY:
+            self.names.setdefault(channel_id, set()).update(names(line))
+            return
+        if command == RPL_ENDOFNAMES:
+            if channel_id in self.names:
+                self.members[channel_id] = self.names.pop(channel_id)
+                self.left.discard(channel_id)
+                self.touch(channel_id)
+            return
+
+        nick = (line.user or u'').lower()
+        if command == u'KICK':
+            nick = kicked_nick(line)
+        if nick == line._chatbot.nick.lower():
+            if command in (u'PART', u'QUIT', u'KICK'):
+                # not counted until the bot's back, with a NAMES reply
+                self.members.pop(channel_id, None)
+                self.names.pop(channel_id, None)
+                self.changed.discard(channel_id)
+                self.unsaved.discard(channel_id)
+                self.left.add(channel_id)
+                return
+            if command == u'JOIN':
+                # NAMES will follow
+                return
+
+        nicks = self.nicks(channel_id)
+        if nicks is None or not nick:
+            return
+        if command == u'JOIN':
+            nicks.add(nick)
+        elif command == u'NICK':
+            nicks.discard(nick)
+            nicks.add(line.text.lower())
+        else:
+            nicks.discard(nick)
+        self.touch(channel_id)
+
+    def flush(self, force=False):
+        """
+        Publishes the counts that changed, and every count and the nicks
+        that changed when OCCUPANCY_INTERVAL is up.
+        """
+        now = time.time()
+        due = force or now - self.saved >= settings.OCCUPANCY_INTERVAL
+        if not (due or self.changed or self.left):
+            return
+        if due:
+            self.saved = now
+            channel_ids = list(self.members)
+            unsaved, self.unsaved = self.unsaved, set()
+        else:
+            channel_ids = list(self.changed)
+            unsaved = ()
+        left, self.left = self.left, set()
+        self.changed = set()
+        counts = dict((channel_id, len(self.members[channel_id]))
+                      for channel_id in channel_ids)
+
+        writes = self.redis().pipeline(transaction=False)
+        for channel_id, users in counts.iteritems():
+            writes.hset(OCCUPANCY_KEY, channel_id,
+                        '{0} {1}'.format(users, int(now)))
+        for channel_id in unsaved:
+            key = nicks_key(channel_id)
+            writes.delete(key)
+            nicks = self.members.get(channel_id)
+            if nicks:
+                writes.sadd(key, *[nick.encode('utf-8') for nick in nicks])
+                writes.expire(key, NICKS_TTL)
+        for channel_id in left:
+            writes.hdel(OCCUPANCY_KEY, channel_id)
+            writes.delete(nicks_key(channel_id))
+        try:
+            writes.execute()
+        except redis.RedisError:
+            LOG.warn('Could not publish the occupancy of %s channels',
+                     len(counts), exc_info=True)
+
+        if due:
+            try:
+                with statsd.timer(".".join(["plugins", "occupancy", "save"])):
+                    save_counts(counts, datetime.datetime.now())
+            except Exception:
+                LOG.error('Saving the occupancy of %s channels failed',
+                          len(counts), exc_info=True)
+
+
+OCCUPANCY = Occupancy()
+
+
+class Plugin(BasePlugin):
+    """
+    Counts users.
+
+    I keep count of the people in `{{ channel.name }}`, it shows next to
+    the logs.
+    """
+    # joins and parts have to be followed in the order they came in
+    ordered = True
+    # kicked nicks are only in the raw IRC line
+    needs_raw = True
+
+    def count(self, line):
+        OCCUPANCY.see(line)
+
+    count.route_rule = ('firehose', ur'(.*)')
+
+    def flush(self, force=False):
+        """Called by the plugin runner between batches and on shutdown"""
+        OCCUPANCY.flush(force=force)
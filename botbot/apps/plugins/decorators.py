@@ -0,0 +1,90 @@
+"""
+Decorators for plugin handlers, to be used along with the route decorators
+of ``botbot_plugins``.
+"""
+from functools import wraps
+
+from django.conf import settings
+from django_statsd.clients import statsd
+
+from .utils import TTLCache
+
+
+MISSING = object()
+
+_memo_cache = None
+
+
+def cooperative(func):
+    """
+    Marks a handler as cooperative: it only does I/O gevent can switch on
+    (sockets, ``requests``, Redis, the database through psycogreen) and no
+    long computations.
+
+    With the gevent executor cooperative handlers run as greenlets on the
+    event loop, so a plugin waiting on a slow API ties up nothing but its
+    greenlet. Other handlers are run in a thread pool so code blocking
+    outside of gevent's knowledge can't stall the loop.
+
+        @cooperative
+        @listens_to_mentions(ur'^weather (?P<city>.+)')
+        def weather(self, line, city):
+            return requests.get(API_URL, params={'q': city}).text
+    """
+    func.cooperative = True
+    return func
+
+
+def normalize_group(value):
+    """Matched groups differing only in whitespace are the same input"""
+    if isinstance(value, basestring):
+        return u' '.join(value.split())
+    return value
+
+
+def memoize(ttl=None, normalize=normalize_group):
+    """
+    Caches what a handler returns for ``ttl`` seconds (PLUGIN_MEMOIZE_TTL
+    by default), per plugin, channel and matched groups passed through
+    ``normalize``. For handlers whose reply only depends on those: the
+    user and the rest of the line are not part of the key.
+
+    Replies are forgotten when the channel or its active plugins and their
+    configuration change, the key includes the channel's fingerprint and
+    its plugin state token from the runner's registry.
+
+        @memoize(ttl=3600)
+        @listens_to_mentions(ur'^help$')
+        def respond_to_help(self, line):
+            ...
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, line, **groups):
+            channel = line._channel
+            if channel is None:
+                return func(self, line, **groups)
+            key = (self.slug, channel.pk, channel.fingerprint,
+                   line._active_plugin_state[0], func.__name__,
+                   tuple(sorted((name, normalize(value))
+                                for name, value in groups.iteritems())))
+            cache = memo_cache()
+            result = cache.get(key, MISSING)
+            if result is not MISSING:
+                statsd.incr(".".join(["plugins", self.slug, "memo", "hit"]))
+                return result
+            statsd.incr(".".join(["plugins", self.slug, "memo", "miss"]))
+            result = func(self, line, **groups)
+            cache.set(key, result, ttl)
+            return result
+        return wrapper
+    return decorator
+
+
+def memo_cache():
+    """The cache of memoized replies of this process"""
+    global _memo_cache
+    if _memo_cache is None:
+        _memo_cache = TTLCache(settings.PLUGIN_MEMOIZE_SIZE,
+                               settings.PLUGIN_MEMOIZE_TTL)
+    return _memo_cache
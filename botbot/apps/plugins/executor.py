@@ -0,0 +1,372 @@
+"""
+Executors run the plugin calls of the PluginRunner.
+
+Calls to plugins marked ``ordered`` (the logger) always run inline, on the
+dispatch thread, so they see every line of a channel in order. Others may
+run on a bounded pool of threads or greenlets, limited per plugin to
+``max_concurrency`` calls in flight and ``call_timeout`` seconds each.
+InlineExecutor runs everything on the dispatch thread and enforces no
+timeout at all: a plugin call that hangs hangs the runner.
+
+A call over its plugin's limit waits in a queue of the plugin and takes
+the slot of the next of its calls to return, in the order they were
+submitted. When PLUGIN_MAX_WAITING calls of a plugin are waiting, submit()
+blocks the dispatcher until one starts, and the queue backs up in Redis.
+
+Python can't kill a thread, so a timed out thread call is abandoned: its
+result is discarded and its worker is replaced. It still counts towards
+its plugin's limit until it returns. Once every call a plugin may have in
+flight is hung past its timeout its new calls are rejected, instead of
+piling up behind calls that may never return.
+
+Calls to a plugin failing on a channel are skipped by its circuit
+breaker, see breaker.py.
+"""
+import Queue
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django_statsd.clients import statsd
+
+from .breaker import BreakerBoard
+
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+
+class Call(object):
+    """A plugin method call and what to do with its result"""
+
+    def __init__(self, slug, func, args, kwargs, callback, timeout,
+                 breakers=None, channel_id=None, after=None):
+        self.slug = slug
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.timeout = timeout
+        self.breakers = breakers
+        self.channel_id = channel_id
+        # called on the call's thread once it returns
+        self.after = after
+        self.started = None
+        self.timed_out = False
+        self.finished = False
+        self.reported = False
+
+    def run(self):
+        """Calls the plugin, timing the call itself (not its wait)"""
+        self.started = time.time()
+        failed = True
+        try:
+            result = self.func(*self.args, **self.kwargs)
+            failed = False
+            return result
+        except Exception:
+            LOG.error('Plugin call %s.%s failed', self.slug,
+                      self.func.__name__, exc_info=True)
+        finally:
+            statsd.timing(".".join(["plugins", self.slug]),
+                          (time.time() - self.started) * 1000)
+            self.report(failed)
+            if self.after is not None:
+                self.after()
+
+    def report(self, failed):
+        """Tells the breaker how the call went, once"""
+        if self.breakers is None or self.reported:
+            return
+        self.reported = True
+        self.breakers.record(self.slug, self.channel_id, failed,
+                             time.time() - self.started)
+
+    def is_overdue(self, now):
+        return (self.started is not None and
+                now - self.started > self.timeout)
+
+
+class InlineExecutor(object):
+    """
+    Runs every call right away, on the dispatch thread. Timeouts aren't
+    enforced, a call runs for as long as it takes.
+    """
+
+    def __init__(self, concurrency=None, timeout=None, breakers=None,
+                 after_call=None):
+        self.concurrency = concurrency or settings.PLUGIN_CONCURRENCY
+        self.timeout = timeout or settings.PLUGIN_TIMEOUT
+        self.breakers = breakers or BreakerBoard()
+        # called on a call's thread once it returns
+        self.after_call = after_call
+        # slug -> calls in flight
+        self.running = {}
+        # slug -> calls in flight that timed out
+        self.hung = {}
+        # slug -> calls waiting for one of the plugin's slots
+        self.waiting = {}
+        # calls dropped because their plugin was hung
+        self.rejected = 0
+        self.lock = threading.Lock()
+        # notified when a waiting call gets a slot
+        self.slot_freed = threading.Condition(self.lock)
+
+    def submit(self, slug, plugin, func, args, kwargs, callback):
+        """
+        Calls ``func(*args, **kwargs)`` and passes the result to
+        ``callback`` (the plugin's ``respond``), now or once one of the
+        plugin's calls in flight returns. Returns False when every call the
+        plugin may have in flight is hung or its breaker is open, and this
+        one is dropped.
+        """
+        timeout = getattr(plugin, 'call_timeout', None) or self.timeout
+        if getattr(plugin, 'ordered', False):
+            # every line has to reach them, no breaker
+            self.run_inline(Call(slug, func, args, kwargs, callback,
+                                 timeout, after=self.after_call))
+            return True
+        channel_id = getattr(plugin, 'channel_id', None)
+        call = Call(slug, func, args, kwargs, callback, timeout,
+                    self.breakers, channel_id, self.after_call)
+        limit = getattr(plugin, 'max_concurrency', None) or self.concurrency
+        with self.lock:
+            if self.hung.get(slug, 0) >= limit:
+                LOG.warn('Plugin %s has %s hung calls, dropped %s',
+                         slug, limit, func.__name__)
+                statsd.incr(".".join(["plugins", slug, "rejected"]))
+                self.rejected += 1
+                return False
+            # checked last, a half-open breaker lets a single call through
+            if not self.breakers.allow(slug, channel_id):
+                return False
+            if self.running.get(slug, 0) < limit:
+                self.running[slug] = self.running.get(slug, 0) + 1
+            else:
+                self.wait_for_slot(call, limit)
+                return True
+        self.start(call)
+        return True
+
+    def wait_for_slot(self, call, limit):
+        """Queues a call over its plugin's limit, with the lock held"""
+        waiting = self.waiting.setdefault(call.slug, deque())
+        waiting.append(call)
+        statsd.incr(".".join(["plugins", call.slug, "waiting"]))
+        while (len(waiting) > settings.PLUGIN_MAX_WAITING and
+               self.hung.get(call.slug, 0) < limit):
+            # back-pressure, until a call returns or they all hang
+            self.slot_freed.wait(1)
+            self.lock.release()
+            try:
+                self.check()
+            finally:
+                self.lock.acquire()
+
+    def run_inline(self, call):
+        # on the dispatch thread replies are sent with the batch
+        call.callback(call.run())
+
+    def start(self, call):
+        while call is not None:
+            call = self.finish(call, call.run(), buffered=True)
+
+    def finish(self, call, result, buffered=False):
+        """
+        Responds with the result of a call, returns the next call waiting
+        for its slot if any, it's the caller's to start.
+        """
+        with self.lock:
+            call.finished = True
+            timed_out = call.timed_out
+            if timed_out:
+                self.hung[call.slug] -= 1
+            waiting = self.waiting.get(call.slug)
+            if waiting:
+                following = waiting.popleft()
+                if not waiting:
+                    del self.waiting[call.slug]
+                self.slot_freed.notify_all()
+            else:
+                following = None
+                self.running[call.slug] -= 1
+        if not timed_out:
+            try:
+                call.callback(result, buffered=buffered)
+            except Exception:
+                LOG.error('Response of %s failed', call.slug, exc_info=True)
+        return following
+
+    def timed_out(self, call):
+        with self.lock:
+            if call.finished:
+                # returned in the meantime
+                return
+            call.timed_out = True
+            self.hung[call.slug] = self.hung.get(call.slug, 0) + 1
+        call.report(failed=True)
+        LOG.warn('Plugin call %s.%s timed out after %ss', call.slug,
+                 call.func.__name__, call.timeout)
+        statsd.incr(".".join(["plugins", call.slug, "timeout"]))
+
+    def check(self):
+        """Called by the runner between batches"""
+
+    def in_flight(self):
+        """Calls running or waiting to"""
+        with self.lock:
+            return (sum(self.running.itervalues()) +
+                    sum(len(calls) for calls in self.waiting.itervalues()))
+
+    def drain(self, timeout=5):
+        """Gives calls in flight some time to finish, on shutdown"""
+        deadline = time.time() + timeout
+        while self.in_flight() and time.time() < deadline:
+            self.check()
+            time.sleep(0.1)
+
+
+class ThreadExecutor(InlineExecutor):
+    """Runs calls on a fixed number of worker threads"""
+
+    def __init__(self, size=None, **kwargs):
+        super(ThreadExecutor, self).__init__(**kwargs)
+        self.size = size or settings.PLUGIN_POOL_SIZE
+        self.calls = Queue.Queue(self.size)
+        # worker thread -> Call it is running or None
+        self.workers = {}
+        for _ in range(self.size):
+            self.add_worker()
+
+    def add_worker(self):
+        thread = threading.Thread(target=self.work, name='plugin-worker')
+        thread.daemon = True
+        with self.lock:
+            self.workers[thread] = None
+        thread.start()
+
+    def start(self, call):
+        # Waits while every worker is busy, but keeps replacing hung ones
+        while 1:
+            try:
+                self.calls.put(call, timeout=1)
+                return
+            except Queue.Full:
+                self.check()
+
+    def work(self):
+        worker = threading.current_thread()
+        call = None
+        while 1:
+            if call is None:
+                call = self.calls.get()
+            with self.lock:
+                self.workers[worker] = call
+            result = call.run()
+            with self.lock:
+                abandoned = worker not in self.workers
+                if not abandoned:
+                    self.workers[worker] = None
+            # the next call waiting for the plugin runs on this worker
+            call = self.finish(call, result)
+            if abandoned:
+                if call is not None:
+                    self.start(call)
+                return
+
+    def check(self):
+        """Abandons the workers stuck on a call for too long"""
+        now = time.time()
+        with self.lock:
+            overdue = [(worker, call) for worker, call
+                       in self.workers.iteritems()
+                       if call is not None and call.is_overdue(now)]
+            for worker, _ in overdue:
+                del self.workers[worker]
+            busy = sum(1 for call in self.workers.itervalues() if call)
+        for _, call in overdue:
+            self.timed_out(call)
+            self.add_worker()
+        statsd.gauge(".".join(["plugins", "busy"]), busy)
+
+
+class GeventExecutor(InlineExecutor):
+    """
+    Runs calls in a pool of greenlets, timeouts are enforced.
+
+    Only handlers marked ``cooperative`` (see decorators.py) run on the
+    event loop itself, the others are handed to a thread pool and their
+    greenlet waits for the result. A timed out greenlet is interrupted,
+    but a thread keeps running and its call counts towards its plugin's
+    limit until it returns. The process has to be monkey patched
+    for the loop to switch on I/O, ``manage.py`` does that for
+    ``run_plugins --executor=gevent`` and ``PLUGIN_EXECUTOR=gevent``.
+    """
+
+    def __init__(self, size=None, **kwargs):
+        super(GeventExecutor, self).__init__(**kwargs)
+        import gevent
+        import gevent.monkey
+        import gevent.pool
+        import gevent.threadpool
+        if not gevent.monkey.is_module_patched('socket'):
+            LOG.warn('gevent executor without monkey patching, '
+                     'every plugin call will block the runner')
+        self.gevent = gevent
+        size = size or settings.PLUGIN_POOL_SIZE
+        self.pool = gevent.pool.Pool(size)
+        self.threadpool = gevent.threadpool.ThreadPool(size)
+
+    def start(self, call):
+        # waits for a free greenlet when the pool is full
+        self.pool.spawn(self.work, call)
+
+    def work(self, call):
+        # the next call waiting for the plugin runs in this greenlet
+        while call is not None:
+            call = self.run(call)
+
+    def run(self, call):
+        if getattr(call.func, 'cooperative', False):
+            result = None
+            try:
+                with self.gevent.Timeout(call.timeout):
+                    result = call.run()
+            except self.gevent.Timeout:
+                self.timed_out(call)
+            return self.finish(call, result)
+        pending = self.threadpool.spawn(call.run)
+        try:
+            result = pending.get(timeout=call.timeout)
+        except self.gevent.Timeout:
+            self.timed_out(call)
+            # frees the pool's greenlet, not the plugin's slot
+            self.gevent.spawn(self.abandon, call, pending)
+            return None
+        return self.finish(call, result)
+
+    def abandon(self, call, pending):
+        """Releases a timed out call's slot once its thread returns"""
+        pending.wait()
+        following = self.finish(call, None)
+        if following is not None:
+            self.start(following)
+
+    def check(self):
+        # let the greenlets catch up
+        self.gevent.sleep(0)
+        statsd.gauge(".".join(["plugins", "busy"]), len(self.pool))
+
+
+EXECUTORS = {
+    'inline': InlineExecutor,
+    'thread': ThreadExecutor,
+    'gevent': GeventExecutor,
+}
+
+
+def get_executor(kind=None, **kwargs):
+    """Executor named ``kind``, defaults to the PLUGIN_EXECUTOR setting"""
+    kind = kind or settings.PLUGIN_EXECUTOR
+    return EXECUTORS[kind](**kwargs)
@@ -1,5 +1,6 @@
 from django import forms
 from . import models
+from .utils import publish_invalidation
 
 class PluginsForm(forms.Form):
     plugins = forms.ModelMultipleChoiceField(required=False,
@@ -16,3 +17,5 @@ class PluginsForm(forms.Form):
         for plugin in self.cleaned_data['plugins']:
             models.ActivePlugin.objects.create(plugin=plugin,
                                                channel=self.channel)
+        # clear() does not go through ActivePlugin.save
+        publish_invalidation('channel', self.channel.pk)
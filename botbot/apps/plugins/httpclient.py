@@ -0,0 +1,121 @@
+"""
+HTTP client shared by the plugins of a runner process, as ``self.http``.
+
+It is a ``requests`` session, so connections to a host are kept alive and
+reused (up to PLUGIN_HTTP_POOL_SIZE per host) instead of being set up for
+every call. Calls get a PLUGIN_HTTP_TIMEOUT timeout unless they pass one,
+at most PLUGIN_HTTP_HOST_CONCURRENCY calls to a host run at once, and
+successful GETs are cached for PLUGIN_HTTP_CACHE_TTL seconds in a cache
+of PLUGIN_HTTP_CACHE_SIZE responses::
+
+    @listens_to_mentions(ur'^weather (?P<city>.+)')
+    def weather(self, line, city):
+        response = self.http.get(API_URL, params={'q': city}, ttl=600)
+        return response.json()['summary']
+"""
+import os
+import threading
+import time
+import urlparse
+
+import requests
+from django.conf import settings
+from django_statsd.clients import statsd
+
+from .utils import TTLCache
+
+
+_client = None
+_client_pid = None
+
+
+def freeze(value):
+    """Hashable version of params or headers, for cache keys"""
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return tuple(sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(value)
+    return value
+
+
+def metric_name(host):
+    return host.replace('.', '_').replace(':', '_')
+
+
+class HttpClient(object):
+
+    def __init__(self, timeout=None, pool_size=None, host_concurrency=None,
+                 cache_size=None, cache_ttl=None):
+        self.timeout = timeout or settings.PLUGIN_HTTP_TIMEOUT
+        self.host_concurrency = (host_concurrency or
+                                 settings.PLUGIN_HTTP_HOST_CONCURRENCY)
+        pool_size = pool_size or settings.PLUGIN_HTTP_POOL_SIZE
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if cache_ttl is None:
+            cache_ttl = settings.PLUGIN_HTTP_CACHE_TTL
+        self.cache = TTLCache(cache_size or settings.PLUGIN_HTTP_CACHE_SIZE,
+                              cache_ttl)
+        # host -> semaphore capping the calls in flight to it
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host_slots(self, url):
+        host = urlparse.urlsplit(url).netloc.lower()
+        with self.lock:
+            slots = self.hosts.get(host)
+            if slots is None:
+                slots = self.hosts[host] = threading.BoundedSemaphore(
+                    self.host_concurrency)
+        return host, slots
+
+    def request(self, method, url, **kwargs):
+        """Like ``requests.request``, never cached"""
+        kwargs.setdefault('timeout', self.timeout)
+        host, slots = self.host_slots(url)
+        metric = ".".join(["plugins", "http", metric_name(host)])
+        start = time.time()
+        with slots:
+            statsd.timing(metric + ".wait", (time.time() - start) * 1000)
+            response = self.session.request(method, url, **kwargs)
+            # reads the body, the connection goes back to the pool
+            response.content
+        statsd.timing(metric, (time.time() - start) * 1000)
+        return response
+
+    def get(self, url, params=None, ttl=None, **kwargs):
+        """
+        GETs ``url``. Responses with a 200 status are cached for ``ttl``
+        seconds (PLUGIN_HTTP_CACHE_TTL by default, 0 not to cache).
+        """
+        if ttl is None:
+            ttl = self.cache.ttl
+        key = None
+        if ttl:
+            key = (url, freeze(params), freeze(kwargs.get('headers')))
+            response = self.cache.get(key)
+            if response is not None:
+                statsd.incr(".".join(["plugins", "http", "cache", "hit"]))
+                return response
+            statsd.incr(".".join(["plugins", "http", "cache", "miss"]))
+        response = self.request('GET', url, params=params, **kwargs)
+        if key is not None and response.status_code == 200:
+            self.cache.set(key, response, ttl)
+        return response
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+
+def get_client():
+    """The HttpClient of this process, a forked process gets its own"""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = HttpClient()
+        _client_pid = os.getpid()
+    return _client
@@ -0,0 +1,318 @@
+"""
+Record and replay harness for the plugin runner.
+
+``manage.py record_plugin_bus`` saves the packets read off the plugin bus
+to a gzipped file, one JSON line ``[seconds since the first packet,
+packet]`` each. ``manage.py replay_plugin_bus`` feeds a recording, or
+synthetic traffic, through a PluginRunner at any multiple of its original
+pace and reports lines per second, dispatch latency and the time spent in
+each plugin.
+
+Replays go through the runner's own read, scheduling and dispatch code,
+only the queue is replaced (by ReplayTransport) and Redis is a separate
+one, so replies and plugin storage writes never reach the bot.
+"""
+import functools
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from botbot.apps.bots.models import ChatBot, Channel
+from . import codec
+from .benchmarks import SAMPLE_LINES
+from .registry import Registry
+from .runner import PluginRunner
+from .storage import get_layout
+
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+
+def record(transport, path, count=None, duration=None, forward=None):
+    """
+    Writes the packets read off ``transport`` to ``path`` until at least
+    ``count`` packets or ``duration`` seconds have been recorded.
+    ``forward`` is called with every batch, e.g. to put packets taken off
+    a list back where a runner reads them. Returns the packets recorded.
+    """
+    recorded = 0
+    start = None
+    deadline = duration and time.time() + duration
+    out = gzip.open(path, 'wb')
+    try:
+        while ((count is None or recorded < count) and
+               (not deadline or time.time() < deadline)):
+            packets, _ = transport.next_batch()
+            now = time.time()
+            for val in packets:
+                try:
+                    packet = codec.decode(val)
+                except Exception:
+                    LOG.error("Line Recording Failed", exc_info=True, extra={
+                        "line": val
+                    })
+                    continue
+                if start is None:
+                    start = now
+                out.write(json.dumps([round(now - start, 6), packet]))
+                out.write('\n')
+                recorded += 1
+            if packets and forward is not None:
+                forward(packets)
+            transport.ack()
+    finally:
+        out.close()
+    return recorded
+
+
+def read_recording(path):
+    """Yields the ``(offset, packet)`` items of a recording"""
+    recording = gzip.open(path, 'rb')
+    try:
+        for row in recording:
+            offset, packet = codec.fast_json.loads(row)
+            yield offset, packet
+    finally:
+        recording.close()
+
+
+def nano_timestamp(when):
+    """``when`` the way the bot timestamps packets"""
+    return when.strftime('%Y-%m-%dT%H:%M:%S.%f') + '000Z'
+
+
+def synthetic_packets(nick, channels, count, rate=100, messages=0.8,
+                      mentions=0.05, chatbot_id=1, seed=0):
+    """
+    Yields ``count`` ``(offset, packet)`` items of made up traffic: ``rate``
+    lines per second spread at random over ``channels``. A ``messages``
+    fraction of the lines are PRIVMSGs, the rest JOIN, PART and QUIT, and a
+    ``mentions`` fraction of the messages are addressed to ``nick``.
+    """
+    rand = random.Random(seed)
+    start = datetime.utcnow()
+    offset = 0.0
+    for _ in xrange(count):
+        offset += rand.expovariate(rate)
+        channel = rand.choice(channels)
+        user = u'user{0}'.format(rand.randint(1, 50))
+        host = u'~{0}@192.0.2.{1}'.format(user, rand.randint(1, 254))
+        if rand.random() < messages:
+            command = u'PRIVMSG'
+            content = rand.choice(SAMPLE_LINES)
+            if rand.random() < mentions:
+                content = u'{0}: {1}'.format(nick, content)
+            raw = u':{0}!{1} PRIVMSG {2} :{3}'.format(user, host, channel,
+                                                      content)
+        else:
+            command = rand.choice([u'JOIN', u'PART', u'QUIT'])
+            content = u''
+            raw = u':{0}!{1} {2} {3}'.format(user, host, command, channel)
+        yield offset, {
+            'ChatBotId': chatbot_id,
+            'Channel': channel,
+            'Command': command,
+            'Content': content,
+            'User': user,
+            'Host': host,
+            'Raw': raw,
+            'Received': nano_timestamp(start + timedelta(seconds=offset)),
+        }
+
+
+class SyntheticRegistry(Registry):
+    """
+    A chatbot and channels that only exist in memory, with the ``slugs``
+    plugins active everywhere, for synthetic traffic.
+    """
+
+    def __init__(self, nick, channel_names, slugs, chatbot_id=1):
+        super(SyntheticRegistry, self).__init__()
+        self.nick = nick
+        self.channel_names = channel_names
+        self.slugs = set(slugs)
+        self.chatbot_id = chatbot_id
+
+    def load(self):
+        chatbot = ChatBot(pk=self.chatbot_id, nick=self.nick)
+        self.chatbots = {chatbot.pk: chatbot}
+        self.channels = {}
+        self.channel_keys = {}
+        for pk, name in enumerate(self.channel_names, 1):
+            channel = Channel(pk=pk, chatbot_id=chatbot.pk, name=name,
+                              fingerprint='synthetic')
+            channel.chatbot = chatbot
+            key = (chatbot.pk, name)
+            self.channels[key] = channel
+            self.channel_keys[pk] = key
+        self.plugin_states = dict((pk, (next(self.tokens), self.slugs))
+                                  for pk in self.channel_keys)
+        self.plugin_configs = dict((pk, {}) for pk in self.channel_keys)
+        self.loaded_at = time.time()
+
+
+class ReplayTransport(object):
+    """
+    Hands out ``(offset, packet)`` items the way a transport hands out the
+    queue, ``speed`` times faster than they were recorded (0 for as fast
+    as the runner goes). Nothing waits in a queue, a runner that can't keep
+    up falls behind the recording and that shows in the latency.
+    """
+
+    def __init__(self, items, speed=1.0, batch_size=None, codec_kind='json'):
+        self.items = iter(items)
+        self.next_item = next(self.items, None)
+        self.speed = speed
+        self.batch_size = batch_size or settings.PLUGIN_BATCH_SIZE
+        self.codec = codec_kind
+        # time each packet handed out was due, in order
+        self.due = deque()
+        self.start = None
+
+    @property
+    def exhausted(self):
+        return self.next_item is None
+
+    def due_time(self, offset):
+        if not self.speed:
+            return self.start
+        return self.start + offset / self.speed
+
+    def next_batch(self, block=True):
+        if self.start is None:
+            self.start = time.time()
+        if self.next_item is None:
+            return [], 0
+        wait = self.due_time(self.next_item[0]) - time.time()
+        if wait > 0:
+            if not block:
+                return [], 0
+            time.sleep(wait)
+
+        now = time.time()
+        packets = []
+        while (self.next_item is not None and
+               len(packets) < self.batch_size and
+               self.due_time(self.next_item[0]) <= now):
+            offset, packet = self.next_item
+            packets.append(codec.encode(packet, self.codec))
+            # as fast as possible, lines are due when they are read
+            self.due.append(self.due_time(offset) if self.speed else now)
+            self.next_item = next(self.items, None)
+        return packets, 0
+
+    # no entry ids, see StreamTransport.entry_ids
+    entry_ids = None
+
+    def ack(self, ids=None):
+        """Nothing to acknowledge"""
+
+
+class TimedExecutor(object):
+    """Wraps an executor to add up the time spent in each plugin"""
+
+    def __init__(self, executor):
+        self.executor = executor
+        # slug -> [calls, seconds]
+        self.times = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.executor, name)
+
+    def timed(self, slug, func):
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                with self.lock:
+                    times = self.times.setdefault(slug, [0, 0.0])
+                    times[0] += 1
+                    times[1] += elapsed
+        return call
+
+    def submit(self, slug, plugin, func, args, kwargs, callback):
+        return self.executor.submit(slug, plugin, self.timed(slug, func),
+                                    args, kwargs, callback)
+
+
+class ReplayRunner(PluginRunner):
+    """
+    A PluginRunner reading a ReplayTransport and using ``connection`` for
+    its replies and plugin storage.
+    """
+
+    def __init__(self, connection, transport, registry, executor=None):
+        # 'list' as a stream transport would join a consumer group
+        super(ReplayRunner, self).__init__(transport='list',
+                                           executor=executor)
+        self.executor = TimedExecutor(self.executor)
+        self.executor.breakers.connection = connection
+        self.bot_bus = connection
+        self.storage = connection
+        self.storage_layout = get_layout(connection)
+        self.transport = transport
+        self.registry = registry
+        # line -> time it was due
+        self.due = {}
+        # seconds from due to dispatched, per line
+        self.latencies = []
+        self.dropped = 0
+
+    def decode(self, val):
+        due = self.transport.due.popleft()
+        line = super(ReplayRunner, self).decode(val)
+        if line is None:
+            self.dropped += 1
+        else:
+            self.due[line] = due
+        return line
+
+    def dispatch_batch(self, lines, depth=0):
+        super(ReplayRunner, self).dispatch_batch(lines, depth)
+        now = time.time()
+        for line in lines:
+            self.latencies.append(now - self.due.pop(line))
+
+    def replay(self):
+        """Runs until the transport is exhausted, returns the results"""
+        start = time.time()
+        while not self.transport.exhausted or self.scheduler.pending:
+            self.listen_once()
+        self.executor.drain()
+        self.send_storage_writes()
+        self.send_outbox()
+        self.flush(force=True)
+        return self.results(time.time() - start)
+
+    def results(self, elapsed):
+        latencies = sorted(self.latencies)
+        results = {
+            'lines': len(latencies),
+            'lines dropped': self.dropped,
+            'seconds': elapsed,
+            'lines per second': len(latencies) / elapsed if elapsed else 0,
+            'latency p50 ms': percentile(latencies, 0.5) * 1000,
+            'latency p99 ms': percentile(latencies, 0.99) * 1000,
+        }
+        for slug, (calls, seconds) in self.executor.times.iteritems():
+            results['plugin {0} calls'.format(slug)] = calls
+            results['plugin {0} ms'.format(slug)] = seconds * 1000
+        return results
+
+
+def percentile(values, fraction):
+    """The value ``fraction`` of the way into sorted ``values``"""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
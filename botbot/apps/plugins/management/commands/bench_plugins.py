@@ -0,0 +1,31 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from botbot.apps.plugins import benchmarks
+
+
+class Command(BaseCommand):
+    args = "[benchmark ...]"
+    help = "Runs the plugin runner micro-benchmarks"
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--iterations', type='int', default=None,
+            help='Passes over the sample data'),
+    )
+
+    def handle(self, *args, **options):
+        names = args or sorted(benchmarks.BENCHMARKS)
+        for name in names:
+            if name not in benchmarks.BENCHMARKS:
+                raise CommandError('Unknown benchmark: {0}'.format(name))
+        kwargs = {}
+        if options['iterations']:
+            kwargs['iterations'] = options['iterations']
+        for name in names:
+            self.stdout.write('{0}:'.format(name))
+            results = benchmarks.BENCHMARKS[name](**kwargs)
+            for label, value in sorted(results.items()):
+                if isinstance(value, float):
+                    value = '{0:,.0f}'.format(value)
+                self.stdout.write('  {0}: {1}'.format(label, value))
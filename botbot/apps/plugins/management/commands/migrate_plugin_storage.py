@@ -0,0 +1,100 @@
+import math
+import re
+from optparse import make_option
+
+import redis
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from botbot.apps.plugins.storage import HashLayout
+
+# <chatbot>:<channel>:<slug>:<key> as written by the 'keys' layout
+KEY_RE = re.compile(r'^(\d+):(\d+):([^:]+):(.+)$', re.DOTALL)
+
+
+def parse_key(key):
+    """``(namespace, key)`` of a 'keys' layout key, None for other keys"""
+    match = KEY_RE.match(key)
+    if not match:
+        return None
+    chatbot_id, channel_id, slug, name = match.groups()
+    return (int(chatbot_id), int(channel_id), slug), name
+
+
+class Command(NoArgsCommand):
+
+    help = ("Moves plugin storage from a key per value to a hash per "
+            "plugin and channel. Set PLUGIN_STORAGE_LAYOUT=hash first, "
+            "values already in a hash are not overwritten.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help='Keys per SCAN and per pipeline'),
+        make_option('--keep',
+            action='store_true',
+            dest='keep',
+            default=False,
+            help='Leave the old keys in place'),
+        make_option('--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Only count what would be migrated'),
+        )
+
+    def handle_noargs(self, **options):
+        connection = redis.StrictRedis.from_url(
+            settings.REDIS_PLUGIN_STORAGE_URL)
+        layout = HashLayout(connection)
+        migrated = skipped = 0
+        for keys in self.scan(connection, options['batch_size']):
+            parsed = [(key, parse_key(key.decode('utf-8', 'replace')))
+                      for key in keys]
+            parsed = [(key, info) for key, info in parsed if info]
+            skipped += len(keys) - len(parsed)
+            if not parsed or options['dry_run']:
+                migrated += len(parsed)
+                continue
+
+            pipe = connection.pipeline(transaction=False)
+            for key, _ in parsed:
+                pipe.get(key)
+                pipe.pttl(key)
+            replies = pipe.execute()
+
+            namespaces = {}
+            for (key, (namespace, name)), value, pttl in zip(
+                    parsed, replies[::2], replies[1::2]):
+                if value is None:
+                    # expired or deleted in the meantime
+                    continue
+                ttl = int(math.ceil(pttl / 1000.0)) if pttl > 0 else None
+                namespaces.setdefault(namespace, []).append(
+                    (name, value, ttl))
+
+            pipe = connection.pipeline(transaction=False)
+            for namespace, items in namespaces.iteritems():
+                layout.import_many(pipe, namespace, items)
+            if not options['keep']:
+                pipe.delete(*[key for key, _ in parsed])
+            pipe.execute()
+            migrated += len(parsed)
+            self.stdout.write('{0} keys migrated'.format(migrated))
+
+        self.stdout.write('Done: {0} keys {1}, {2} other keys left '
+                          'alone'.format(migrated, 'to migrate'
+                                         if options['dry_run'] else
+                                         'migrated', skipped))
+
+    def scan(self, connection, count):
+        """Yields batches of keys, SCAN doesn't block the server"""
+        cursor = 0
+        while 1:
+            cursor, keys = connection.scan(cursor, match='*:*:*:*',
+                                           count=count)
+            if keys:
+                yield keys
+            if int(cursor) == 0:
+                break
@@ -0,0 +1,79 @@
+from optparse import make_option
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from botbot.apps.plugins import loadtest
+from botbot.apps.plugins.transport import get_transport, QUEUE
+
+# Consumer group of the recorder on the stream transport
+RECORDER_GROUP = 'recorder'
+
+
+class Command(BaseCommand):
+    args = "<file.jsonl.gz>"
+    help = ("Records packets from the plugin bus to a gzipped file, for "
+            "replay_plugin_bus")
+    option_list = BaseCommand.option_list + (
+        make_option('--count',
+            type='int',
+            dest='count',
+            default=None,
+            help='Stop after this many packets'),
+        make_option('--duration',
+            type='int',
+            dest='duration',
+            default=None,
+            help='Stop after this many seconds'),
+        make_option('--transport',
+            choices=['list', 'stream'],
+            dest='transport',
+            default=None,
+            help='Queue transport, defaults to the PLUGIN_TRANSPORT '
+                 'setting. The stream is read through a consumer group '
+                 'of its own, packets read off the list are gone unless '
+                 'they are --forward-ed.'),
+        make_option('--forward',
+            dest='forward',
+            default=None,
+            help='List the packets read off the list transport are pushed '
+                 'to, e.g. the queue of a plugin runner started with it'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: record_plugin_bus {0}'.format(
+                self.args))
+        if not options['count'] and not options['duration']:
+            raise CommandError('Give a --count or a --duration')
+        kind = options['transport'] or settings.PLUGIN_TRANSPORT
+        connection = redis.StrictRedis.from_url(
+            settings.REDIS_PLUGIN_QUEUE_URL)
+        forward = None
+        if kind == 'stream':
+            stream = '{0}:stream'.format(QUEUE)
+            # only record what comes in from now on
+            connection.execute_command('XGROUP', 'CREATE', stream,
+                                       RECORDER_GROUP, '$', 'MKSTREAM')
+            transport = get_transport(connection, kind=kind,
+                                      group=RECORDER_GROUP)
+        else:
+            transport = get_transport(connection, kind=kind)
+            if options['forward']:
+                forward = lambda packets: connection.rpush(
+                    options['forward'], *packets)
+            else:
+                self.stderr.write('Packets recorded are taken off the queue, '
+                                  'plugin runners will miss them')
+        try:
+            recorded = loadtest.record(transport, args[0],
+                                       count=options['count'],
+                                       duration=options['duration'],
+                                       forward=forward)
+        finally:
+            if kind == 'stream':
+                connection.execute_command('XGROUP', 'DESTROY', stream,
+                                           RECORDER_GROUP)
+        self.stdout.write('Recorded {0} packets to {1}'.format(recorded,
+                                                              args[0]))
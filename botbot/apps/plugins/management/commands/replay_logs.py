@@ -0,0 +1,83 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import utc
+
+from botbot.apps.plugins import backfill
+from botbot.apps.plugins.models import ActivePlugin
+
+
+class Command(BaseCommand):
+    args = "<plugin slug> [plugin slug ...]"
+    help = ("Replays the logs of the channels the plugins are active on "
+            "through them, replies are dropped. Interrupted runs resume "
+            "where they stopped.")
+    option_list = BaseCommand.option_list + (
+        make_option('--channels',
+            dest='channels',
+            default=None,
+            help='Comma separated channel ids, defaults to every channel '
+                 'with one of the plugins active'),
+        make_option('--workers',
+            type='int',
+            dest='workers',
+            default=4,
+            help='Channels replayed at once, each in its own process'),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=5000,
+            help='Logs read per query'),
+        make_option('--executor',
+            choices=['inline', 'thread', 'gevent'],
+            dest='executor',
+            default='inline',
+            help='How plugins are called, inline keeps lines in order'),
+        make_option('--name',
+            dest='name',
+            default=None,
+            help='Name of the checkpoints, defaults to the plugin slugs'),
+        make_option('--restart',
+            action='store_true',
+            dest='restart',
+            default=False,
+            help='Forget the checkpoints and start over'),
+        )
+
+    def handle(self, *slugs, **options):
+        if not slugs:
+            raise CommandError('Usage: replay_logs {0}'.format(self.args))
+        if 'logger' in slugs:
+            raise CommandError('The logger would log every line again')
+        if 'occupancy' in slugs:
+            raise CommandError('Occupancy only counts users live')
+        name = options['name'] or ','.join(sorted(slugs))
+        if options['channels']:
+            channel_ids = [int(pk) for pk in options['channels'].split(',')]
+        else:
+            channel_ids = sorted(set(ActivePlugin.objects.filter(
+                plugin__slug__in=slugs).values_list('channel_id', flat=True)))
+        if options['restart']:
+            backfill.connect().delete(backfill.checkpoint_key(name))
+
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        total = failed = 0
+        seconds = 0.0
+        for channel_id, lines, elapsed in backfill.replay_channels(
+                channel_ids, slugs, name, now, workers=options['workers'],
+                batch_size=options['batch_size'],
+                executor=options['executor']):
+            if lines is None:
+                failed += 1
+                self.stderr.write('Channel {0} failed, see the logs'.format(
+                    channel_id))
+                continue
+            total += lines
+            seconds += elapsed
+            self.stdout.write('Channel {0}: {1} lines in {2:.1f}s'.format(
+                channel_id, lines, elapsed))
+        self.stdout.write('{0} lines from {1} channels, {2:,.0f} lines per '
+                          'minute per worker'.format(
+                              total, len(channel_ids) - failed,
+                              total / seconds * 60 if seconds else 0))
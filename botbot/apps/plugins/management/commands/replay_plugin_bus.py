@@ -0,0 +1,131 @@
+from optparse import make_option
+
+import redis
+from django.core.management.base import BaseCommand, CommandError
+
+from botbot.apps.plugins import loadtest
+from botbot.apps.plugins.registry import Registry
+from botbot.apps.plugins.runner import all_plugins
+
+
+class Command(BaseCommand):
+    args = "[file.jsonl.gz]"
+    help = ("Replays a recording of the plugin bus, or synthetic traffic, "
+            "through a plugin runner and reports its throughput")
+    option_list = BaseCommand.option_list + (
+        make_option('--speed',
+            type='float',
+            dest='speed',
+            default=1.0,
+            help='Multiple of the recorded pace, 0 for as fast as possible'),
+        make_option('--redis-url',
+            dest='redis_url',
+            default='redis://localhost:6379/15',
+            help='Redis for replies and plugin storage, never the one the '
+                 'bot uses'),
+        make_option('--fake-redis',
+            action='store_true',
+            dest='fake_redis',
+            default=False,
+            help='Use fakeredis (if installed) instead of --redis-url'),
+        make_option('--executor',
+            choices=['inline', 'thread', 'gevent'],
+            dest='executor',
+            default=None,
+            help='How plugins are called, defaults to the PLUGIN_EXECUTOR '
+                 'setting'),
+        make_option('--codec',
+            choices=['json', 'msgpack'],
+            dest='codec',
+            default='json',
+            help='Encoding of the packets handed to the runner'),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=None,
+            help='Max packets per batch'),
+        make_option('--plugins',
+            dest='plugins',
+            default=None,
+            help='Comma separated slugs of the plugins to run, defaults to '
+                 'all of them but the logger and occupancy (replays would '
+                 'log lines twice and count users wrong)'),
+        make_option('--synthetic',
+            type='int',
+            dest='synthetic',
+            default=None,
+            help='Replay this many lines of synthetic traffic instead of a '
+                 'recording, on channels that only exist in memory'),
+        make_option('--channels',
+            type='int',
+            dest='channels',
+            default=10,
+            help='Synthetic channels'),
+        make_option('--rate',
+            type='float',
+            dest='rate',
+            default=100,
+            help='Synthetic lines per second, before --speed'),
+        make_option('--messages',
+            type='float',
+            dest='messages',
+            default=0.8,
+            help='Fraction of the synthetic lines that are messages, the '
+                 'others are JOIN, PART and QUIT'),
+        make_option('--mentions',
+            type='float',
+            dest='mentions',
+            default=0.05,
+            help='Fraction of the synthetic messages addressed to the bot'),
+        make_option('--nick',
+            dest='nick',
+            default='botbot',
+            help='Nick of the synthetic bot'),
+        )
+
+    def handle(self, *args, **options):
+        if bool(args) == bool(options['synthetic']):
+            raise CommandError('Give a recording or --synthetic')
+        if options['fake_redis']:
+            try:
+                import fakeredis
+            except ImportError:
+                raise CommandError('--fake-redis needs fakeredis installed')
+            connection = fakeredis.FakeStrictRedis()
+        else:
+            connection = redis.StrictRedis.from_url(options['redis_url'])
+
+        plugins = list(all_plugins())
+        if options['plugins']:
+            slugs = set(options['plugins'].split(','))
+        else:
+            slugs = set(plugin.slug for plugin in plugins) - set(['logger', 'occupancy'])
+
+        if options['synthetic']:
+            channels = [u'#synthetic{0}'.format(i)
+                        for i in range(options['channels'])]
+            registry = loadtest.SyntheticRegistry(options['nick'], channels,
+                                                  slugs)
+            items = loadtest.synthetic_packets(
+                options['nick'], channels, options['synthetic'],
+                rate=options['rate'], messages=options['messages'],
+                mentions=options['mentions'])
+        else:
+            registry = Registry()
+            items = loadtest.read_recording(args[0])
+        registry.load()
+
+        transport = loadtest.ReplayTransport(
+            items, speed=options['speed'], batch_size=options['batch_size'],
+            codec_kind=options['codec'])
+        app = loadtest.ReplayRunner(connection, transport, registry,
+                                    executor=options['executor'])
+        for plugin in plugins:
+            if plugin.slug in slugs:
+                app.register(plugin)
+
+        results = app.replay()
+        for label, value in sorted(results.items()):
+            if isinstance(value, float):
+                value = '{0:,.2f}'.format(value)
+            self.stdout.write('{0}: {1}'.format(label, value))
@@ -12,7 +12,38 @@ class Command(NoArgsCommand):
             action='store_true',
             dest='with_gevent',
             default=False,
-            help='Use gevent for concurrency'),
+            help='Use gevent for concurrency, same as --executor=gevent'),
+        make_option('--executor',
+            choices=['inline', 'thread', 'gevent'],
+            dest='executor',
+            default=None,
+            help='How plugins are called, defaults to the PLUGIN_EXECUTOR '
+                 'setting'),
+        make_option('--transport',
+            choices=['list', 'stream'],
+            dest='transport',
+            default=None,
+            help='Queue transport, defaults to the PLUGIN_TRANSPORT setting'),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=None,
+            help='Max packets to drain from the queue per round trip'),
+        make_option('--batch-latency',
+            type='int',
+            dest='batch_latency',
+            default=None,
+            help='Milliseconds to let a batch fill up once the queue is empty'),
+        make_option('--workers',
+            type='int',
+            dest='workers',
+            default=1,
+            help='Number of plugin processes, sharded by channel'),
         )
     def handle_noargs(self, **options):
-        runner.start_plugins(use_gevent=options['with_gevent'])
+        runner.start_plugins(use_gevent=options['with_gevent'],
+                             executor=options['executor'],
+                             transport=options['transport'],
+                             batch_size=options['batch_size'],
+                             batch_latency=options['batch_latency'],
+                             workers=options['workers'])
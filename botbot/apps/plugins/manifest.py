@@ -0,0 +1,160 @@
+"""
+Cached manifest of the plugins, so the runner can start without importing
+them.
+
+The manifest lists the slug, module, routes and flags of every core and
+botbot_plugins plugin. It is kept in PLUGIN_MANIFEST and rebuilt, which
+imports every plugin once, whenever the plugin modules change: its
+fingerprint covers the list of modules and the size and modification time
+of their files.
+
+With PLUGIN_LAZY_LOADING the runner registers LazyPlugins from the
+manifest, a plugin's module is only imported the first time a channel
+with the plugin active sends a line.
+"""
+import hashlib
+import json
+import logging
+import os
+import pkgutil
+import time
+
+import botbot_plugins.plugins
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from .routing import plugin_routes
+
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+CORE_PLUGINS = ['help', 'logger', 'occupancy']
+
+# Plugin attributes kept in the manifest, see plans.DispatchPlan
+FLAGS = ('ordered', 'essential', 'needs_raw')
+
+
+def plugin_modules():
+    """Module names of the core and botbot_plugins plugins"""
+    return (['botbot.apps.plugins.core.{0}'.format(name)
+             for name in CORE_PLUGINS] +
+            ['botbot_plugins.plugins.{0}'.format(name)
+             for name in botbot_plugins.plugins.__all__])
+
+
+def fingerprint(modules):
+    """Changes when a module is added, removed or its file changes"""
+    files = []
+    for name in modules:
+        loader = pkgutil.get_loader(name)
+        if loader is None:
+            files.append([name, None])
+            continue
+        stat = os.stat(loader.get_filename(name))
+        files.append([name, stat.st_size, stat.st_mtime])
+    return hashlib.sha1(json.dumps(files)).hexdigest()
+
+
+def describe(plugin, module):
+    """The manifest entry of a plugin instance"""
+    entry = {
+        'slug': plugin.slug,
+        'module': module,
+        'routes': [(router, rule, attr.__name__)
+                   for router, rule, attr in plugin_routes(plugin)],
+        'flush': callable(getattr(plugin, 'flush', None)),
+    }
+    for flag in FLAGS:
+        entry[flag] = bool(getattr(plugin, flag, False))
+    return entry
+
+
+def build(modules):
+    """Imports every plugin to describe it"""
+    entries = []
+    for module in modules:
+        try:
+            plugin = import_module(module).Plugin()
+        except Exception:
+            LOG.error('Plugin %s failed to load', module, exc_info=True)
+            continue
+        entries.append(describe(plugin, module))
+    return entries
+
+
+def load(path=None):
+    """The manifest entries, rebuilt and saved when stale"""
+    path = path or settings.PLUGIN_MANIFEST
+    modules = plugin_modules()
+    current = fingerprint(modules)
+    try:
+        with open(path) as manifest:
+            cached = json.load(manifest)
+        if cached['fingerprint'] == current:
+            return cached['plugins']
+    except (IOError, ValueError, KeyError):
+        pass
+
+    start = time.time()
+    entries = build(modules)
+    LOG.info('Plugin manifest built in %.2fs', time.time() - start)
+    try:
+        # written aside and renamed so a runner never reads half of it
+        temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temporary, 'w') as manifest:
+            json.dump({'fingerprint': current, 'plugins': entries}, manifest)
+        os.rename(temporary, path)
+    except (IOError, OSError):
+        LOG.warn('Could not save the plugin manifest to %s', path,
+                 exc_info=True)
+    return entries
+
+
+class LazyMethod(object):
+    """A method of a LazyPlugin, known by its name"""
+
+    def __init__(self, plugin, name):
+        self.plugin = plugin
+        self.__name__ = name
+
+    def __call__(self, *args, **kwargs):
+        return getattr(self.plugin.load(), self.__name__)(*args, **kwargs)
+
+
+class LazyPlugin(object):
+    """
+    Stands in for a registered plugin until it is needed, see
+    PluginRunner.load_plugin.
+    """
+
+    def __init__(self, entry):
+        self.slug = entry['slug']
+        self.module = entry['module']
+        self.entry = entry
+        self.instance = None
+        self.failed = False
+
+    def load(self):
+        """The plugin instance, imported on first use (None if it fails)"""
+        if self.instance is None and not self.failed:
+            start = time.time()
+            try:
+                self.instance = import_module(self.module).Plugin()
+            except Exception:
+                self.failed = True
+                LOG.error('Plugin %s failed to load', self.module,
+                          exc_info=True)
+                return None
+            LOG.info('Loaded plugin %s in %.3fs', self.slug,
+                     time.time() - start)
+        return self.instance
+
+    def routes(self):
+        """``(router name, rule, method)`` like routing.plugin_routes"""
+        for router, rule, name in self.entry['routes']:
+            yield router, rule, LazyMethod(self, name)
+
+    def flush(self, force=False):
+        """Flushes the plugin, once it is loaded"""
+        if self.instance is not None and self.entry['flush']:
+            self.instance.flush(force=force)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def add_occupancy(apps, schema_editor):
+    Plugin = apps.get_model('plugins', 'Plugin')
+    ActivePlugin = apps.get_model('plugins', 'ActivePlugin')
+
+    occupancy = Plugin.objects.create(name='Occupancy', slug='occupancy')
+    # Counted wherever lines are logged
+    ActivePlugin.objects.bulk_create([
+        ActivePlugin(plugin=occupancy, channel_id=channel_id)
+        for channel_id in ActivePlugin.objects.filter(
+            plugin__slug='logger').values_list('channel_id', flat=True)])
+
+
+def remove_occupancy(apps, schema_editor):
+    Plugin = apps.get_model('plugins', 'Plugin')
+    ActivePlugin = apps.get_model('plugins', 'ActivePlugin')
+
+    ActivePlugin.objects.filter(plugin__slug='occupancy').delete()
+    Plugin.objects.filter(slug='occupancy').delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('plugins', '0002_auto_20140912_1656'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_occupancy, remove_occupancy)
+    ]
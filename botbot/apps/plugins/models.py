@@ -1,9 +1,13 @@
 from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.admindocs.utils import trim_docstring
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils.importlib import import_module
 
 from botbot.core.fields import JSONField
+from botbot.apps.plugins.utils import publish_invalidation
 
 
 class Plugin(models.Model):
@@ -40,7 +44,21 @@ class ActivePlugin(models.Model):
         # Let the plugin_runner auto-reload the new values
         cache.delete(self.channel.plugin_config_cache_key(self.plugin.slug))
         cache.delete(self.channel.active_plugin_slugs_cache_key)
+        publish_invalidation('channel', self.channel_id)
         return obj
 
     def __unicode__(self):
         return u'{0} for {1}'.format(self.plugin.name, self.channel.name)
+
+
+@receiver(post_delete, sender=ActivePlugin)
+def active_plugin_deleted(sender, instance, **kwargs):
+    """Stops the plugin_runner calling a plugin removed from a channel"""
+    publish_invalidation('channel', instance.channel_id)
+    try:
+        channel, slug = instance.channel, instance.plugin.slug
+    except ObjectDoesNotExist:
+        # deleted along with its channel or plugin
+        return
+    cache.delete(channel.plugin_config_cache_key(slug))
+    cache.delete(channel.active_plugin_slugs_cache_key)
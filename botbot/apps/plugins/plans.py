@@ -0,0 +1,83 @@
+"""
+Per-channel dispatch plans.
+
+A plan holds one long-lived instance of every active plugin of a channel,
+plus the routes of those plugins bound to the instances, so dispatching a
+line no longer creates plugin classes or instances.
+"""
+import logging
+
+from .plugin import RealPluginMixin
+
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+_real_plugin_classes = {}
+
+
+def real_plugin_class(fake_plugin_class):
+    """The RealPluginMixin version of a botbot_plugins class, made once"""
+    cls = _real_plugin_classes.get(fake_plugin_class)
+    if cls is None:
+        cls = type('RealPlugin', (RealPluginMixin, fake_plugin_class), {})
+        _real_plugin_classes[fake_plugin_class] = cls
+    return cls
+
+
+class DispatchPlan(object):
+    """
+    The plugins a channel's lines are dispatched to.
+
+    A plan is only valid for the channel ``fingerprint`` and active plugins
+    ``token`` it was built with, the registry hands out a new token each
+    time it reloads the channel's plugin settings.
+    """
+
+    def __init__(self, app, line, token, slugs):
+        self.channel_id = line._channel.pk
+        self.fingerprint = line._channel.fingerprint
+        self.token = token
+        # slug -> plugin instance for this channel
+        self.plugins = {}
+        for slug in slugs:
+            # imports lazily registered plugins on first use
+            plugin = app.load_plugin(slug)
+            if plugin is not None:
+                self.plugins[slug] = app.setup_plugin_for_channel(
+                    plugin.__class__, line)
+
+        # plugins needing every line in order, and the others
+        self.ordered_slugs = set(
+            slug for slug, plugin in self.plugins.iteritems()
+            if getattr(plugin, 'ordered', False))
+        self.unordered_slugs = set(self.plugins) - self.ordered_slugs
+        # plugins still called when the runner is overloaded
+        self.essential_slugs = set(
+            slug for slug in self.unordered_slugs
+            if getattr(self.plugins[slug], 'essential', False))
+
+        # (slug, method, plugin) of the active firehose plugins
+        self.firehose = []
+        for slug, routes in app.firehose_router.iteritems():
+            if slug in self.plugins:
+                for _, func, _ in routes:
+                    func, plugin = self.bind_method(slug, func)
+                    self.firehose.append((slug, func, plugin))
+        self.messages = app.messages_router.select(self.plugins,
+                                                   self.bind_route)
+        self.mentions = app.mentions_router.select(self.plugins,
+                                                   self.bind_route)
+
+    def bind_method(self, slug, func):
+        """
+        The channel plugin's version of a registered method. Its errors
+        are logged by the executor, which counts them, see breaker.py.
+        """
+        plugin = self.plugins[slug]
+        return getattr(plugin, func.__name__), plugin
+
+    def bind_route(self, route):
+        return route.bind(*self.bind_method(route.slug, route.func))
+
+    def is_current(self, fingerprint, token):
+        return self.fingerprint == fingerprint and self.token == token
@@ -1,6 +1,8 @@
 import logging
 from botbot_plugins.base import PrivateMessage
 
+from .httpclient import get_client
+
 LOG = logging.getLogger('botbot.plugin_runner')
 
 
@@ -19,7 +21,7 @@ class RealPluginMixin(object):
         # Configuration variables as a dictionary, from database
         if self.config_class:
             self.prod_config = self.config_class().fields
-            plugin_config = channel.plugin_config(self.slug)
+            plugin_config = app.plugin_config(channel, self.slug)
             self.prod_config.update(plugin_config)
 
     def unique_key(self, key):
@@ -27,32 +29,78 @@ class RealPluginMixin(object):
         return u'{0}:{1}:{2}:{3}'.format(self.chatbot_id, self.channel_id,
                                          self.slug, key.strip())
 
-    def store(self, key, value):
-        """Saves a key,value to Redis"""
-        ukey = self.unique_key(key)
-        LOG.info('Storing: %s=%s', ukey, value)
-        self.app.storage.set(ukey, value)
+    @property
+    def http(self):
+        """The runner process' HTTP client, see httpclient.py"""
+        return get_client()
+
+    @property
+    def storage_namespace(self):
+        """Where the plugin's values live, see storage.py"""
+        return (self.chatbot_id, self.channel_id, self.slug)
+
+    def _writer(self):
+        """
+        Where writes go: the batch's pipeline on the dispatch thread, sent
+        when the batch is done, or the call's pipeline on an executor's
+        thread, sent when the call returns.
+        """
+        return self.app.storage_pipeline()
+
+    def _before_read(self):
+        # reads have to see the writes of this batch, or call
+        self.app.send_storage_writes()
+
+    def _decode(self, value):
+        if value:
+            value = unicode(value, 'utf-8')
+        return value
+
+    def store(self, key, value, ttl=None):
+        """Saves a key,value to Redis, expiring after ``ttl`` seconds"""
+        self.store_many({key: value}, ttl=ttl)
+
+    def store_many(self, mapping, ttl=None):
+        """Saves a dict of key,values to Redis in one round trip"""
+        for key, value in mapping.iteritems():
+            LOG.debug('Storing: %s=%s', self.unique_key(key), value)
+        self.app.storage_layout.set_many(self._writer(),
+                                         self.storage_namespace, mapping, ttl)
 
     def retrieve(self, key):
         """Retrieves the value for a key from Redis"""
-        ukey = self.unique_key(key)
-        value = self.app.storage.get(ukey)
+        value = self.retrieve_many([key])[key]
         if value:
-            value = unicode(value, 'utf-8')
-            LOG.info('Retrieved: %s=%s', key, value)
+            LOG.debug('Retrieved: %s=%s', key, value)
         return value
 
+    def retrieve_many(self, keys):
+        """Retrieves the values of several keys at once, as a dict"""
+        self._before_read()
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.app.storage_layout.get_many(self.storage_namespace,
+                                                  keys)
+        return dict((key, self._decode(value))
+                    for key, value in zip(keys, values))
+
+    def incr(self, key, amount=1, ttl=None):
+        """
+        Atomically adds ``amount`` to a counter and returns the new value.
+        With ``ttl`` the counter expires that many seconds after its last
+        change.
+        """
+        self._before_read()
+        return self.app.storage_layout.incr(self.storage_namespace, key,
+                                            amount, ttl)
+
     def delete(self, key):
         """ Delete the value from Redis"""
-        ukey = self.unique_key(key)
-        return self.app.storage.delete(ukey) == 1
-
-    def greenlet_respond(self, grnlt):
-        """Callback for gevent return values"""
-        msg = grnlt.value
-        self.respond(msg)
+        self._before_read()
+        return self.app.storage_layout.delete(self.storage_namespace, key)
 
-    def respond(self, msg):
+    def respond(self, msg, buffered=True):
         """Writes message back to the channel the line was received on"""
         # Internal method, not part of public API
         if msg:
@@ -62,9 +110,9 @@ class RealPluginMixin(object):
                 nick = msg.nick
             else:
                 lines = msg.split('\n')
+            response_cmds = []
             for response_line in lines:
                 LOG.info('Write to %s: %s', nick, response_line)
-                response_cmd = u'WRITE {0} {1} {2}'.format(self.chatbot_id,
-                                                           nick,
-                                                           response_line)
-                self.app.bot_bus.lpush('bot', response_cmd)
+                response_cmds.append(u'WRITE {0} {1} {2}'.format(
+                    self.chatbot_id, nick, response_line))
+            self.app.write(response_cmds, buffered=buffered)
@@ -0,0 +1,274 @@
+"""
+Process-local registry of everything the plugin runner needs to resolve a
+line: chatbots, channels, and the active plugins and their configuration
+per channel.
+
+It is bulk-loaded at startup and kept current by the invalidation messages
+``Channel.save``, ``ChatBot.save`` and ``ActivePlugin.save`` publish on
+Redis, so resolving a line costs no cache or database round trip.
+"""
+import Queue
+import logging
+import threading
+import time
+from itertools import count
+
+from django.conf import settings
+
+from botbot.apps.bots.models import ChatBot, Channel
+from botbot.apps.plugins.models import ActivePlugin
+from botbot.apps.plugins.utils import INVALIDATION_CHANNEL, INVALIDATION_LOG
+
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+
+class Registry(object):
+    """
+    Chatbots, channels and plugin settings of the runner's process.
+
+    Lookups of things that do not exist are cached too (for
+    ``PLUGIN_REGISTRY_NEGATIVE_TTL`` seconds) so a channel the bot should
+    not be in does not cost a query per line.
+    """
+
+    def __init__(self):
+        # chatbot id -> ChatBot or None
+        self.chatbots = {}
+        # (chatbot id, channel name) -> Channel or None
+        self.channels = {}
+        # channel id -> (chatbot id, channel name)
+        self.channel_keys = {}
+        # key of a chatbots/channels None entry -> time it expires
+        self.negative_expiry = {}
+        # channel id -> (token, set of active plugin slugs)
+        self.plugin_states = {}
+        # channel id -> {plugin slug: configuration}
+        self.plugin_configs = {}
+        # tokens identify a version of a channel's plugin state
+        self.tokens = count(1)
+        self.loaded_at = 0
+        # invalidation messages received by the subscriber thread
+        self.pending = Queue.Queue()
+
+    def load(self):
+        """(Re)loads everything, in three queries"""
+        start = time.time()
+        chatbots = dict((chatbot.pk, chatbot)
+                        for chatbot in ChatBot.objects.all())
+        channels = {}
+        channel_keys = {}
+        for channel in Channel.objects.all():
+            # avoid a query when plugins reach for channel.chatbot
+            channel.chatbot = chatbots.get(channel.chatbot_id)
+            key = (channel.chatbot_id, channel.name)
+            channels[key] = channel
+            channel_keys[channel.pk] = key
+        slugs = dict((pk, set()) for pk in channel_keys)
+        configs = dict((pk, {}) for pk in channel_keys)
+        for active in ActivePlugin.objects.select_related('plugin'):
+            if active.channel_id in slugs:
+                slugs[active.channel_id].add(active.plugin.slug)
+                configs[active.channel_id][active.plugin.slug] = (
+                    active.configuration)
+
+        self.chatbots = chatbots
+        self.channels = channels
+        self.channel_keys = channel_keys
+        self.negative_expiry = {}
+        self.plugin_states = dict((pk, (next(self.tokens), slug_set))
+                                  for pk, slug_set in slugs.iteritems())
+        self.plugin_configs = configs
+        self.loaded_at = time.time()
+        LOG.info('Registry loaded %s chatbots and %s channels in %.2fs',
+                 len(chatbots), len(channels), self.loaded_at - start)
+
+    def dump(self):
+        """What restore() needs, without the lookups that found nothing"""
+        return {
+            'chatbots': dict((pk, chatbot) for pk, chatbot
+                             in self.chatbots.iteritems()
+                             if chatbot is not None),
+            'channels': [channel for channel in self.channels.itervalues()
+                         if channel is not None],
+            'plugin_configs': self.plugin_configs,
+            'loaded_at': self.loaded_at,
+        }
+
+    def restore(self, state):
+        """
+        Picks up where the registry dump()ed, see revalidate(). The full
+        reload is still due PLUGIN_REGISTRY_REFRESH after the last one.
+        """
+        self.chatbots = state['chatbots']
+        self.channels = dict(((channel.chatbot_id, channel.name), channel)
+                             for channel in state['channels'])
+        self.channel_keys = dict((channel.pk, key) for key, channel
+                                 in self.channels.iteritems())
+        self.negative_expiry = {}
+        self.plugin_configs = state['plugin_configs']
+        self.plugin_states = dict(
+            (pk, (next(self.tokens), set(configs)))
+            for pk, configs in self.plugin_configs.iteritems())
+        self.loaded_at = state['loaded_at']
+
+    def revalidate(self, connection, since):
+        """
+        Catches up with the changes made after ``since``: chatbots are
+        reloaded, and channels whose fingerprint changed or that were
+        invalidated since (from the INVALIDATION_LOG).
+        """
+        start = time.time()
+        chatbots = dict((chatbot.pk, chatbot)
+                        for chatbot in ChatBot.objects.all())
+        self.chatbots = chatbots
+        for channel in self.channels.itervalues():
+            channel.chatbot = chatbots.get(channel.chatbot_id)
+
+        stale = set()
+        fingerprints = dict(Channel.objects.values_list('pk', 'fingerprint'))
+        for pk in set(fingerprints) | set(self.channel_keys):
+            key = self.channel_keys.get(pk)
+            if (key is None or pk not in fingerprints or
+                    self.channels[key].fingerprint != fingerprints[pk]):
+                stale.add(pk)
+        for message in connection.zrangebyscore(INVALIDATION_LOG, since,
+                                                '+inf'):
+            kind, _, pk = message.partition(':')
+            if kind == 'channel':
+                stale.add(int(pk))
+            elif kind == 'all':
+                self.load()
+                return
+
+        if len(stale) > len(fingerprints) / 2:
+            self.load()
+            return
+        for pk in stale:
+            self.reload_channel(pk)
+        LOG.info('Registry revalidated in %.2fs, %s channels reloaded',
+                 time.time() - start, len(stale))
+
+    def _cache_miss(self, mapping, key, value):
+        mapping[key] = value
+        if value is None:
+            self.negative_expiry[key] = (
+                time.time() + settings.PLUGIN_REGISTRY_NEGATIVE_TTL)
+
+    def _is_cached(self, mapping, key):
+        if key not in mapping:
+            return False
+        if mapping[key] is None:
+            return self.negative_expiry.get(key, 0) > time.time()
+        return True
+
+    def chatbot(self, chatbot_id):
+        if not self._is_cached(self.chatbots, chatbot_id):
+            chatbot = ChatBot.objects.filter(pk=chatbot_id).first()
+            if chatbot is None:
+                LOG.warn('Chatbot %s does not exist. Lines dropped.',
+                         chatbot_id)
+            self._cache_miss(self.chatbots, chatbot_id, chatbot)
+        return self.chatbots[chatbot_id]
+
+    def channel(self, chatbot_id, name):
+        key = (chatbot_id, name)
+        if not self._is_cached(self.channels, key):
+            channel = Channel.objects.filter(chatbot_id=chatbot_id,
+                                             name=name).first()
+            if channel is not None:
+                self.reload_channel(channel.pk)
+            else:
+                LOG.warn('Chatbot %s should not be listening to %s. '
+                         'Lines dropped.', chatbot_id, name)
+                self._cache_miss(self.channels, key, None)
+        return self.channels[key]
+
+    def active_plugin_state(self, channel_id):
+        """``(token, slugs)``, the token changes with the plugin settings"""
+        return self.plugin_states.get(channel_id, (None, set()))
+
+    def plugin_config(self, channel_id, slug):
+        return self.plugin_configs.get(channel_id, {}).get(slug, {})
+
+    def reload_chatbot(self, chatbot_id):
+        chatbot = ChatBot.objects.filter(pk=chatbot_id).first()
+        self._cache_miss(self.chatbots, chatbot_id, chatbot)
+        for channel in self.channels.itervalues():
+            if channel is not None and channel.chatbot_id == chatbot_id:
+                channel.chatbot = chatbot
+
+    def reload_channel(self, channel_id):
+        old_key = self.channel_keys.pop(channel_id, None)
+        if old_key:
+            self.channels.pop(old_key, None)
+        self.plugin_states.pop(channel_id, None)
+        self.plugin_configs.pop(channel_id, None)
+
+        channel = Channel.objects.filter(pk=channel_id).first()
+        if channel is None:
+            return
+        channel.chatbot = self.chatbot(channel.chatbot_id)
+        key = (channel.chatbot_id, channel.name)
+        self.channels[key] = channel
+        self.negative_expiry.pop(key, None)
+        self.channel_keys[channel_id] = key
+        configs = dict(
+            (active.plugin.slug, active.configuration) for active in
+            channel.activeplugin_set.all().select_related('plugin'))
+        self.plugin_states[channel_id] = (next(self.tokens), set(configs))
+        self.plugin_configs[channel_id] = configs
+
+    def invalidate(self, message):
+        """Applies a ``<kind>:<pk>`` invalidation message"""
+        kind, _, pk = message.partition(':')
+        LOG.debug('Invalidating %s %s', kind, pk)
+        if kind == 'chatbot':
+            self.reload_chatbot(int(pk))
+        elif kind == 'channel':
+            self.reload_channel(int(pk))
+        elif kind == 'all':
+            self.load()
+
+    def refresh(self):
+        """
+        Applies the invalidations received since the last call, and reloads
+        everything every ``PLUGIN_REGISTRY_REFRESH`` seconds in case a
+        message got lost.
+        """
+        if time.time() - self.loaded_at > settings.PLUGIN_REGISTRY_REFRESH:
+            self.load()
+        while 1:
+            try:
+                message = self.pending.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                self.invalidate(message)
+            except Exception:
+                LOG.error('Invalidation failed', exc_info=True,
+                          extra={'message': message})
+
+    def subscribe(self, connection):
+        """Starts a thread queueing invalidation messages for refresh()"""
+        thread = threading.Thread(target=self._subscriber, args=(connection,),
+                                  name='registry-invalidations')
+        thread.daemon = True
+        thread.start()
+
+    def _subscriber(self, connection):
+        reconnecting = False
+        while 1:
+            try:
+                pubsub = connection.pubsub()
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                if reconnecting:
+                    # anything could have changed while we were away
+                    self.pending.put('all')
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.pending.put(message['data'])
+            except Exception:
+                LOG.error('Invalidation subscriber failed', exc_info=True)
+            reconnecting = True
+            time.sleep(1)
@@ -0,0 +1,230 @@
+"""
+Precompiled plugin routes.
+
+Route rules are compiled once at registration and indexed by the literal
+text they start with (most mention routes look like ``^help``), so a line is
+only matched against the rules that can possibly apply to it.
+"""
+import copy
+import re
+
+
+# Rules are always matched with ``re.match`` so they are anchored anyway
+ANCHORS = (u'\\A', u'^')
+# Characters with a special meaning in a pattern
+META = frozenset(u'.^$*+?{}[]\\|()')
+# What may follow a literal for it to end on a word boundary
+WORD_ENDS = frozenset([u'$', u'\\s', u'\\b', u'\\W', u'\\Z'])
+# Leading token of a line, ASCII like ``\w`` in the (non-unicode) rules
+TOKEN_RE = re.compile(r'[A-Za-z0-9_]+')
+# Inline verbose flag, whitespace in the rule is not literal then
+VERBOSE_RE = re.compile(r'\(\?[a-zA-Z]*x')
+
+_nick_matchers = {}
+
+
+def nick_matcher(nick):
+    """
+    Returns a compiled ``match`` function detecting lines addressed to
+    ``nick``, the addressed text is its only group.
+    """
+    matcher = _nick_matchers.get(nick)
+    if matcher is None:
+        if len(nick) == 1:
+            # support @<plugin> or !<plugin>
+            regex = ur'^{0}(.*)'.format(re.escape(nick))
+        else:
+            # support <nick>: <plugin>
+            regex = ur'^{0}[:\s](.*)'.format(re.escape(nick))
+        matcher = re.compile(regex, re.IGNORECASE).match
+        _nick_matchers[nick] = matcher
+    return matcher
+
+
+def has_top_level_alternation(rule):
+    depth = 0
+    in_class = False
+    escaped = False
+    for char in rule:
+        if escaped:
+            escaped = False
+        elif char == u'\\':
+            escaped = True
+        elif in_class:
+            in_class = char != u']'
+        elif char == u'[':
+            in_class = True
+        elif char == u'(':
+            depth += 1
+        elif char == u')':
+            depth -= 1
+        elif char == u'|' and depth == 0:
+            return True
+    return False
+
+
+def literal_prefix(rule):
+    """
+    Returns ``(prefix, token)`` for a route rule: the lowercased literal
+    text every match starts with, and its first word when the rule pins
+    that word down completely (``''`` otherwise).
+
+    Only ASCII literals are considered, the rules are matched without
+    ``re.UNICODE`` so that keeps ``lower()`` in line with ``re.IGNORECASE``.
+    """
+    if has_top_level_alternation(rule) or VERBOSE_RE.search(rule):
+        return u'', u''
+    for anchor in ANCHORS:
+        if rule.startswith(anchor):
+            rule = rule[len(anchor):]
+            break
+
+    chars = []
+    stop = None
+    i = 0
+    while i < len(rule):
+        char = rule[i]
+        if char == u'\\':
+            escaped = rule[i + 1:i + 2]
+            if not escaped or escaped.isalnum() or ord(escaped) > 127:
+                stop = rule[i:i + 2]
+                break
+            literal, step = escaped, 2
+        elif char in META or ord(char) > 127:
+            stop = char
+            break
+        else:
+            literal, step = char, 1
+
+        following = rule[i + step:i + step + 1]
+        if following in (u'?', u'*', u'{'):
+            # the literal is optional
+            break
+        chars.append(literal)
+        if following == u'+':
+            break
+        i += step
+
+    prefix = u''.join(chars).lower()
+    token = TOKEN_RE.match(prefix)
+    if not token:
+        return prefix, u''
+    token = token.group(0)
+    if len(token) < len(prefix) or stop in WORD_ENDS:
+        return prefix, token
+    return prefix, u''
+
+
+def plugin_routes(plugin):
+    """
+    Introspects a plugin instance for methods decorated with a route rule,
+    yields ``(router name, rule, method)`` tuples.
+    """
+    for key in dir(plugin):
+        if key.startswith('__'):
+            continue
+        try:
+            # the config attr bombs if accessed here because it tries
+            # to access an attribute from the dummyapp
+            attr = getattr(plugin, key)
+        except AttributeError:
+            continue
+        route_rule = getattr(attr, 'route_rule', None)
+        if route_rule:
+            yield route_rule[0], route_rule[1], attr
+
+
+class Route(object):
+    """A compiled route rule pointing at a plugin method"""
+
+    def __init__(self, slug, rule, func, plugin, order=0):
+        self.slug = slug
+        self.rule = rule
+        self.regex = re.compile(rule, re.IGNORECASE)
+        self.func = func
+        self.plugin = plugin
+        self.order = order
+        self.prefix, self.token = literal_prefix(rule)
+
+    def bind(self, func, plugin):
+        """Copy of the route calling ``func`` of a channel's plugin"""
+        route = copy.copy(self)
+        route.func = func
+        route.plugin = plugin
+        return route
+
+    def __repr__(self):
+        return '<Route {0}.{1} {2!r}>'.format(self.slug, self.func.__name__,
+                                             self.rule)
+
+
+class RouteTable(object):
+    """
+    The routes of one router (messages or mentions) for all plugins.
+
+    Routes are bucketed by the first word or, failing that, the first
+    character of their literal prefix. Rules without a usable prefix are
+    tried on every line.
+    """
+
+    def __init__(self):
+        self.routes = []
+        self.by_token = {}
+        self.by_char = {}
+        self.unindexed = []
+        # only this much of a line has to be lowercased for prefix checks
+        self.longest_prefix = 0
+
+    def add(self, slug, rule, func, plugin):
+        return self.add_route(Route(slug, rule, func, plugin,
+                                    order=len(self.routes)))
+
+    def add_route(self, route):
+        self.routes.append(route)
+        if route.token:
+            self.by_token.setdefault(route.token, []).append(route)
+        elif route.prefix:
+            self.by_char.setdefault(route.prefix[0], []).append(route)
+        else:
+            self.unindexed.append(route)
+        self.longest_prefix = max(self.longest_prefix, len(route.prefix))
+        return route
+
+    def slugs(self):
+        return set(route.slug for route in self.routes)
+
+    def select(self, slugs, bind):
+        """
+        A new table with the routes of the ``slugs`` plugins only, each
+        passed through ``bind`` (see ``Route.bind``).
+        """
+        table = RouteTable()
+        for route in self.routes:
+            if route.slug in slugs:
+                table.add_route(bind(route))
+        return table
+
+    def candidates(self, text):
+        """Routes that may match ``text``, in registration order"""
+        head = text[:self.longest_prefix].lower()
+        if not head:
+            return self.unindexed
+        token = TOKEN_RE.match(head)
+        by_token = self.by_token.get(token.group(0), []) if token else []
+        by_char = self.by_char.get(head[0], [])
+        if not (by_token or by_char):
+            return self.unindexed
+        candidates = [route for route in by_token + by_char
+                      if head.startswith(route.prefix)]
+        if self.unindexed or (by_token and by_char):
+            candidates.extend(self.unindexed)
+            candidates.sort(key=lambda route: route.order)
+        return candidates
+
+    def matches(self, text, active_slugs=None):
+        """Yields ``(route, match)`` for the active routes matching text"""
+        for route in self.candidates(text):
+            if active_slugs is None or route.slug in active_slugs:
+                match = route.regex.match(text)
+                if match:
+                    yield route, match
@@ -1,110 +1,136 @@
 # pylint: disable=W0212
-import json
 import logging
+import resource
+import signal
+import socket
+import sys
+import threading
+import time
 from datetime import datetime
 
 from django.utils.timezone import utc
-import re
 import redis
-import botbot_plugins.plugins
 from botbot_plugins.base import PrivateMessage
-from django.core.cache import cache
 from django.conf import settings
 from django.utils.importlib import import_module
 from django_statsd.clients import statsd
 
-from botbot.apps.bots import models as bots_models
-from botbot.apps.plugins.utils import convert_nano_timestamp, log_on_error
-from .plugin import RealPluginMixin
+from botbot.apps.plugins.utils import convert_nano_timestamp
+from . import codec, manifest, snapshot
+from .breaker import BreakerBoard
+from .executor import get_executor
+from .plans import DispatchPlan, real_plugin_class
+from .registry import Registry
+from .routing import RouteTable, nick_matcher, plugin_routes
+from .scheduler import FairScheduler
+from .storage import get_layout
+from .transport import get_transport, QUEUE
 
 
-CACHE_TIMEOUT_2H = 7200
 LOG = logging.getLogger('botbot.plugin_runner')
 
+# Priority lanes of a batch, see PluginRunner.dispatch_batch
+MENTIONS, MESSAGES, FIREHOSE = range(3)
+
+
+def all_plugins():
+    """Yields an instance of every core and botbot_plugins plugin"""
+    for module in manifest.plugin_modules():
+        yield import_module(module).Plugin()
+
+
+def raw_slugs():
+    """Slugs of the plugins reading ``line._raw``, see codec.lean()"""
+    return set(entry['slug'] for entry in manifest.load()
+               if entry['needs_raw'])
+
 
 class Line(object):
     """
     All the methods and data necessary for a plugin to act on a line
+
+    Lines are slotted, there can be thousands of them waiting in the
+    scheduler, and the timestamp is only parsed when something uses it.
     """
+    __slots__ = ('full_text', 'text', 'user', 'is_direct_message',
+                 '_registry', '_chatbot_id', '_channel_name', '_command',
+                 '_raw', '_host', '_received_value', '_received_cache',
+                 '_chatbot_cache', '_channel_cache',
+                 '_active_plugin_state_cache', '_entry_id')
+
     def __init__(self, packet, app):
         self.full_text = packet['Content']
         self.text = packet['Content']
         self.user = packet['User']
 
         # Private attributes not accessible to external plugins
+        self._registry = app.registry
         self._chatbot_id = packet['ChatBotId']
-        self._raw = packet['Raw']
+        self._raw = packet.get('Raw')
         self._channel_name = packet['Channel'].strip()
         self._command = packet['Command']
-        self._is_message = packet['Command'] == 'PRIVMSG'
-        self._host = packet['Host']
-
-        self._received = convert_nano_timestamp(packet['Received'])
+        self._host = packet.get('Host')
+        self._received_value = packet['Received']
+        # id of the queue entry, acknowledged once the line is dispatched
+        self._entry_id = None
 
         self.is_direct_message = self.check_direct_message()
 
+    @property
+    def _is_message(self):
+        return self._command == 'PRIVMSG'
+
+    @property
+    def _received(self):
+        if not hasattr(self, '_received_cache'):
+            self._received_cache = convert_nano_timestamp(
+                self._received_value)
+        return self._received_cache
+
     def is_valid(self):
         if self._chatbot and self._channel:
             return True
         return False
 
+    @property
+    def _lane(self):
+        """Dispatch priority, lower goes first: mentions, messages, rest"""
+        if self._is_message:
+            return MENTIONS if self.is_direct_message else MESSAGES
+        return FIREHOSE
+
     @property
     def _chatbot(self):
-        """Simple caching for ChatBot model"""
+        """ChatBot model, from the runner's registry"""
         if not hasattr(self, '_chatbot_cache'):
-            cache_key = 'chatbot:{0}'.format(self._chatbot_id)
-            chatbot = cache.get(cache_key)
-            if not chatbot:
-                try:
-                    chatbot = bots_models.ChatBot.objects.get(
-                        id=self._chatbot_id)
-                except bots_models.ChatBot.DoesNotExist:
-                    LOG.warn('Chatbot %s does not exist. Line dropped.',
-                             self._chatbot_id)
-                    return None
-                cache.set(cache_key, chatbot, CACHE_TIMEOUT_2H)
-            self._chatbot_cache = chatbot
+            self._chatbot_cache = self._registry.chatbot(self._chatbot_id)
         return self._chatbot_cache
 
     @property
     def _channel(self):
-        """Simple caching for Channel model"""
+        """Channel model, from the runner's registry"""
         if not hasattr(self, '_channel_cache'):
-            cache_key = 'channel:{0}-{1}'.format(self._chatbot_id, self._channel_name)
-            channel = cache.get(cache_key)
-
-            if not channel and self._channel_name.startswith("#"):
-                try:
-                    channel = self._chatbot.channel_set.get(
-                        name=self._channel_name)
-                except self._chatbot.channel_set.model.DoesNotExist:
-                    LOG.warn('Chatbot %s should not be listening to %s. '
-                             'Line dropped.',
-                             self._chatbot_id, self._channel_name)
-                    return None
-                cache.set(cache_key, channel, CACHE_TIMEOUT_2H)
-
-                """
-                The following logging is to help out in sentry. For some
-                channels, we are getting occasional issues with the
-                ``channel_set.get()`` lookup above
-                """
-                LOG.debug(channel)
-                LOG.debug(self._channel_name)
-                LOG.debug(cache_key)
-                LOG.debug("%s", ", ".join(self._chatbot.channel_set.values_list('name', flat=True)))
-
+            channel = None
+            if self._channel_name.startswith("#"):
+                channel = self._registry.channel(self._chatbot_id,
+                                                 self._channel_name)
             self._channel_cache = channel
         return self._channel_cache
 
     @property
-    def _active_plugin_slugs(self):
-        if not hasattr(self, '_active_plugin_slugs_cache'):
+    def _active_plugin_state(self):
+        """``(token, slugs)`` of the channel's active plugins"""
+        if not hasattr(self, '_active_plugin_state_cache'):
             if self._channel:
-                self._active_plugin_slugs_cache = self._channel.active_plugin_slugs
+                self._active_plugin_state_cache = (
+                    self._registry.active_plugin_state(self._channel.pk))
             else:
-                self._active_plugin_slugs_cache = set()
-        return self._active_plugin_slugs_cache
+                self._active_plugin_state_cache = (None, set())
+        return self._active_plugin_state_cache
+
+    @property
+    def _active_plugin_slugs(self):
+        return self._active_plugin_state[1]
 
     def check_direct_message(self):
         """
@@ -112,6 +138,8 @@ class Line(object):
         and return the rest of the message. Otherwise, return False.
         """
 
+        if not self._chatbot:
+            return False
         nick = self._chatbot.nick
 
         # Private message
@@ -122,13 +150,7 @@ class Line(object):
 
             return True
 
-        if len(nick) == 1:
-            # support @<plugin> or !<plugin>
-            regex = ur'^{0}(.*)'.format(re.escape(nick))
-        else:
-            # support <nick>: <plugin>
-            regex = ur'^{0}[:\s](.*)'.format(re.escape(nick))
-        match = re.match(regex, self.full_text, re.IGNORECASE)
+        match = nick_matcher(nick)(self.full_text)
         if match:
             LOG.debug('Direct message detected')
             self.text = match.groups()[0].lstrip()
@@ -145,147 +167,481 @@ class Line(object):
 class PluginRunner(object):
     """
     Registration and routing for plugins
-    Calls to plugins are done via greenlets
+    Calls to plugins are done by an executor, see executor.py
     """
 
-    def __init__(self, use_gevent=False):
+    def __init__(self, use_gevent=False, queue=QUEUE, transport=None,
+                 batch_size=None, batch_latency=None, executor=None):
         if use_gevent:
-            import gevent
-            self.gevent = gevent
+            executor = 'gevent'
         self.bot_bus = redis.StrictRedis.from_url(
             settings.REDIS_PLUGIN_QUEUE_URL)
+        # named after the queue, a shard's worker keeps its name
+        breakers = BreakerBoard(self.bot_bus, name='{0}:{1}'.format(
+            socket.gethostname(), queue))
+        self.executor = get_executor(executor, breakers=breakers,
+                                     after_call=self.send_call_writes)
+        # lines read and waiting for their channel's turn
+        self.scheduler = FairScheduler(settings.PLUGIN_FAIR_QUANTUM)
+        # queue entries read that didn't make a line, see ack()
+        self.done_ids = []
+        self.depth = 0
+        self.transport = get_transport(self.bot_bus, kind=transport,
+                                       queue=queue,
+                                       batch_size=batch_size,
+                                       batch_latency=batch_latency)
         self.storage = redis.StrictRedis.from_url(
             settings.REDIS_PLUGIN_STORAGE_URL)
+        self.storage_layout = get_layout(self.storage)
+        # plugin storage writes of the thread's batch, or of its call off
+        # the dispatch thread
+        self.storage_writes = threading.local()
+        self.dispatch_thread = threading.current_thread()
+        # chatbots, channels and plugin settings
+        self.registry = Registry()
+        # slug -> registered plugin instance or LazyPlugin
+        self.plugins = {}
+        # channel id -> DispatchPlan
+        self.plans = {}
+        # where the warm state is saved on shutdown, see snapshot.py
+        self.snapshot_path = None
+        # plugin hooks writing out buffered work, see flush()
+        self.flushers = []
+        # commands for the bot written by plugins during a batch
+        self.outbox = []
         # plugins that listen to everything coming over the wire
         self.firehose_router = {}
         # plugins that listen to all messages (aka PRIVMSG)
-        self.messages_router = {}
+        self.messages_router = RouteTable()
         # plugins that listen on direct messages (starting with bot nick)
-        self.mentions_router = {}
-
-    def register_all_plugins(self):
-        """Iterate over all plugins and register them with the app"""
-        for core_plugin in ['help', 'logger']:
-            mod = import_module('botbot.apps.plugins.core.{}'.format(core_plugin))
-            plugin = mod.Plugin()
-            self.register(plugin)
-        for mod in botbot_plugins.plugins.__all__:
-            plugin = import_module('botbot_plugins.plugins.' + mod).Plugin()
-            self.register(plugin)
+        self.mentions_router = RouteTable()
+
+    def register_all_plugins(self, lazy=None):
+        """
+        Iterate over all plugins and register them with the app. Lazily,
+        from the plugin manifest, with PLUGIN_LAZY_LOADING.
+        """
+        if lazy is None:
+            lazy = settings.PLUGIN_LAZY_LOADING
+        if lazy:
+            for entry in manifest.load():
+                self.register_lazy(entry)
+        else:
+            for plugin in all_plugins():
+                self.register(plugin)
 
     def register(self, plugin):
         """
         Introspects the Plugin class instance provided for methods
         that need to be registered with the internal app routers.
         """
-        for key in dir(plugin):
-            try:
-                # the config attr bombs if accessed here because it tries
-                # to access an attribute from the dummyapp
-                attr = getattr(plugin, key)
-            except AttributeError:
-                continue
-            if (not key.startswith('__') and
-                    getattr(attr, 'route_rule', None)):
-                LOG.info('Route: %s.%s listens to %s for matches to %s',
-                         plugin.slug, key, attr.route_rule[0],
-                         attr.route_rule[1])
-                getattr(self, attr.route_rule[0] + '_router').setdefault(
-                    plugin.slug, []).append((attr.route_rule[1], attr, plugin))
+        self.plugins[plugin.slug] = plugin
+        if callable(getattr(plugin, 'flush', None)):
+            self.flushers.append(plugin.flush)
+        self.add_routes(plugin, plugin_routes(plugin))
+
+    def register_lazy(self, entry):
+        """Registers a plugin from its manifest entry, without importing it"""
+        plugin = manifest.LazyPlugin(entry)
+        self.plugins[plugin.slug] = plugin
+        if entry['flush']:
+            self.flushers.append(plugin.flush)
+        self.add_routes(plugin, plugin.routes())
+
+    def add_routes(self, plugin, routes):
+        for router, rule, attr in routes:
+            LOG.info('Route: %s.%s listens to %s for matches to %s',
+                     plugin.slug, attr.__name__, router, rule)
+            if router == 'firehose':
+                self.firehose_router.setdefault(plugin.slug, []).append(
+                    (rule, attr, plugin))
+            else:
+                # route rules are compiled and indexed once, here
+                getattr(self, router + '_router').add(plugin.slug, rule,
+                                                      attr, plugin)
+
+    def load_plugin(self, slug):
+        """The registered plugin ``slug``, imported on first use if lazy"""
+        plugin = self.plugins.get(slug)
+        if isinstance(plugin, manifest.LazyPlugin):
+            return plugin.load()
+        return plugin
+
+    def plugin_config(self, channel, slug):
+        """Configuration of an active plugin on a channel"""
+        return self.registry.plugin_config(channel.pk, slug)
 
     def listen(self):
         """Listens for incoming messages on the Redis queue"""
-        while 1:
-            val = None
+        self.registry.subscribe(self.bot_bus)
+        self.executor.breakers.clear()
+        try:
+            while 1:
+                self.listen_once()
+        finally:
+            # lines already read would be lost otherwise
+            lines = self.scheduler.take(self.scheduler.pending)
+            self.dispatch_batch(lines)
+            self.executor.drain()
+            self.send_storage_writes()
+            self.send_outbox()
+            self.flush(force=True)
+            self.ack(lines)
+            self.save_snapshot()
+
+    def ack(self, lines):
+        """
+        Acknowledges the entries of dispatched lines, and of the packets
+        read that didn't make a line. Lines still waiting in the scheduler
+        stay pending, a runner that dies gets them redelivered.
+        """
+        ids, self.done_ids = self.done_ids, []
+        ids.extend(line._entry_id for line in lines)
+        try:
+            self.transport.ack(ids)
+        except Exception:
+            LOG.error("Queue ack failed", exc_info=True)
+
+    def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        try:
+            snapshot.save(self, self.snapshot_path)
+        except Exception:
+            LOG.error("Saving the snapshot failed", exc_info=True)
+
+    def start_registry(self, snapshot_path=None):
+        """
+        Loads the registry, from the runner's snapshot if it has a recent
+        one. Plugins must be registered first, their plans are built.
+        """
+        self.snapshot_path = snapshot_path
+        if snapshot_path:
             try:
-                val = self.bot_bus.blpop('q', 1)
-
-                # Track q length
-                ql = self.bot_bus.llen('q')
-                statsd.gauge(".".join(["plugins", "q"]), ql)
-
-                if val:
-                    _, val = val
-                    LOG.debug('Recieved: %s', val)
-                    line = Line(json.loads(val), self)
-
-                    # Calculate the transport latency between go and the plugins.
-                    delta = datetime.utcnow().replace(tzinfo=utc) - line._received
-                    statsd.timing(".".join(["plugins", "latency"]),
-                                 delta.total_seconds() * 1000)
+                if snapshot.restore(self, snapshot_path):
+                    return
+            except Exception:
+                LOG.error("Restoring the snapshot failed", exc_info=True)
+                self.plans = {}
+        self.registry.load()
 
-                    if line.is_valid():
-                        self.dispatch(line)
+    def listen_once(self):
+        """
+        Reads what's queued, up to PLUGIN_FAIR_MAX_PENDING lines, and
+        dispatches one batch of them
+        """
+        try:
+            self.registry.refresh()
+        except Exception:
+            LOG.error("Registry refresh failed", exc_info=True)
+        if self.scheduler.pending < settings.PLUGIN_FAIR_MAX_PENDING:
+            if not self.read():
+                return
+            # Reads ahead while the queue has a backlog, so a channel
+            # flooding it can't hold up the lines of the others queued
+            # behind, up to PLUGIN_FAIR_MAX_PENDING lines.
+            while (self.depth and self.scheduler.pending <
+                   settings.PLUGIN_FAIR_MAX_PENDING):
+                if not self.read():
+                    break
+
+        lines = self.scheduler.take(self.transport.batch_size)
+        self.track_channel_latency(lines)
+        statsd.gauge(".".join(["plugins", "pending"]), self.scheduler.pending)
+        self.dispatch_batch(lines, self.depth + self.scheduler.pending)
+        self.executor.check()
+        try:
+            self.send_storage_writes()
+        except Exception:
+            LOG.error("Plugin storage writes failed", exc_info=True)
+        try:
+            self.send_outbox()
+        except Exception:
+            LOG.error("Writing responses failed", exc_info=True)
+        self.flush()
+        self.ack(lines)
+
+    def read(self):
+        """
+        Reads a batch off the queue into the scheduler, only waiting for
+        lines when there are none left to dispatch. Returns False when the
+        queue can't be read.
+        """
+        try:
+            packets, self.depth = self.transport.next_batch(
+                block=not self.scheduler.pending)
+        except Exception:
+            LOG.error("Queue read failed", exc_info=True)
+            time.sleep(1)
+            return False
+
+        # Track q length, once per batch
+        statsd.gauge(".".join(["plugins", "q"]), self.depth)
+
+        entry_ids = self.transport.entry_ids or [None] * len(packets)
+        for val, entry_id in zip(packets, entry_ids):
+            try:
+                line = self.decode(val)
             except Exception:
                 LOG.error("Line Dispatch Failed", exc_info=True, extra={
                     "line": val
                 })
+                line = None
+            if line is None:
+                self.done_ids.append(entry_id)
+                continue
+            line._entry_id = entry_id
+            self.scheduler.add(line)
+        return True
+
+    def track_channel_latency(self, lines):
+        """Time the oldest line of each channel spent waiting, per batch"""
+        now = datetime.utcnow().replace(tzinfo=utc)
+        oldest = {}
+        for line in lines:
+            channel_id = line._channel.pk
+            if channel_id not in oldest:
+                oldest[channel_id] = line._received
+        for channel_id, received in oldest.iteritems():
+            statsd.timing(".".join(["plugins", "channels", str(channel_id),
+                                    "latency"]),
+                          (now - received).total_seconds() * 1000)
+
+    def storage_pipeline(self):
+        """
+        Pipeline collecting the plugin storage writes of the batch on the
+        dispatch thread, or of the plugin call on an executor's thread.
+        """
+        writes = getattr(self.storage_writes, 'pipeline', None)
+        if writes is None:
+            writes = self.storage.pipeline(transaction=False)
+            self.storage_writes.pipeline = writes
+        return writes
+
+    def send_storage_writes(self):
+        """Sends the current thread's pending plugin storage writes"""
+        writes = getattr(self.storage_writes, 'pipeline', None)
+        self.storage_writes.pipeline = None
+        if writes is not None:
+            writes.execute()
+
+    def send_call_writes(self):
+        """
+        Called by the executor when a plugin call returns, sends its writes
+        unless it ran on the dispatch thread, where they go with the batch.
+        """
+        if threading.current_thread() is self.dispatch_thread:
+            return
+        try:
+            self.send_storage_writes()
+        except redis.RedisError:
+            LOG.error('Sending plugin storage writes failed', exc_info=True)
+
+    def write(self, commands, buffered=True):
+        """
+        Sends commands to the bot. Buffered commands are held until the end
+        of the batch, unbuffered ones (from greenlets finishing after it)
+        go out right away. Either way a plugin's reply is pushed in one
+        go and its lines arrive together.
+        """
+        if buffered:
+            self.outbox.extend(commands)
+        elif commands:
+            self.bot_bus.lpush('bot', *commands)
+
+    def send_outbox(self):
+        """Pushes the batch's commands, oldest first, in one round trip"""
+        commands, self.outbox = self.outbox, []
+        if commands:
+            self.bot_bus.lpush('bot', *commands)
+
+    def flush(self, force=False):
+        """
+        Lets plugins write out buffered work, e.g. the logger's pending
+        lines. Runs after every batch (at least once a second) and with
+        ``force`` on shutdown.
+        """
+        for flush in self.flushers:
+            try:
+                flush(force=force)
+            except Exception:
+                LOG.error("Plugin flush failed", exc_info=True)
+
+    def process(self, val):
+        """Decodes a raw packet from the queue and dispatches it"""
+        line = self.decode(val)
+        if line is not None:
+            self.dispatch(line)
+
+    def decode(self, val):
+        """A raw packet from the queue as a Line, None if it isn't valid"""
+        LOG.debug('Recieved: %s', val)
+        line = Line(codec.decode(val), self)
+
+        # Calculate the transport latency between go and the plugins.
+        delta = datetime.utcnow().replace(tzinfo=utc) - line._received
+        statsd.timing(".".join(["plugins", "latency"]),
+                      delta.total_seconds() * 1000)
+
+        if line.is_valid():
+            return line
+
+    def overload_level(self, depth):
+        """
+        Lanes to shed, based on the queue depth: above
+        PLUGIN_QUEUE_HIGH_WATERMARK firehose lines only go to essential
+        plugins, above PLUGIN_QUEUE_CRITICAL_WATERMARK messages too.
+        """
+        if depth > settings.PLUGIN_QUEUE_CRITICAL_WATERMARK:
+            return MESSAGES
+        if depth > settings.PLUGIN_QUEUE_HIGH_WATERMARK:
+            return FIREHOSE
+        return None
 
-    def dispatch(self, line):
-        """Given a line, dispatch it to the right plugins & functions."""
+    def dispatch_batch(self, lines, depth=0):
+        """
+        Dispatches a batch of lines, mentions first.
+
+        Plugins marked ``ordered`` (the logger) get every line first, in
+        the order they came in. The other plugins get mentions, then
+        messages, then the rest, so a flood of JOIN and QUIT lines
+        doesn't hold up ``help``. When the queue backs up, lines of the
+        lanes being shed only go to ``essential`` plugins.
+        """
+        for line in lines:
+            self.dispatch_line(line, ordered=True)
+
+        shed_from = self.overload_level(depth)
+        # 0 normally, 1 when shedding firehose lines, 2 messages as well
+        statsd.gauge(".".join(["plugins", "overload"]),
+                     0 if shed_from is None else FIREHOSE + 1 - shed_from)
+        # a line is deferred when a line received after it goes first
+        deferred = 0
+        first_lane = FIREHOSE
+        for line in reversed(lines):
+            if line._lane > first_lane:
+                deferred += 1
+            first_lane = min(first_lane, line._lane)
+        if deferred:
+            statsd.incr(".".join(["plugins", "deferred"]), deferred)
+
+        shed = 0
+        for line in sorted(lines, key=lambda line: line._lane):
+            essential_only = shed_from is not None and line._lane >= shed_from
+            shed += essential_only
+            self.dispatch_line(line, ordered=False,
+                               essential_only=essential_only)
+        if shed:
+            statsd.incr(".".join(["plugins", "shed"]), shed)
+
+    def dispatch_line(self, line, ordered, essential_only=False):
+        try:
+            plan = self.plan_for(line)
+            if ordered:
+                slugs = plan.ordered_slugs
+            elif essential_only:
+                slugs = plan.essential_slugs
+            else:
+                slugs = plan.unordered_slugs
+            if slugs:
+                self.dispatch(line, slugs)
+        except Exception:
+            LOG.error("Line Dispatch Failed", exc_info=True, extra={
+                "line": line._raw
+            })
+
+    def plan_for(self, line):
+        """The dispatch plan of the line's channel, rebuilt when stale"""
+        token, slugs = line._active_plugin_state
+        plan = self.plans.get(line._channel.pk)
+        if plan is None or not plan.is_current(line._channel.fingerprint,
+                                               token):
+            plan = DispatchPlan(self, line, token, slugs)
+            self.plans[line._channel.pk] = plan
+        return plan
+
+    def dispatch(self, line, slugs=None):
+        """
+        Given a line, dispatch it to the right plugins & functions.
+        ``slugs`` limits the plugins called.
+        """
+        plan = self.plan_for(line)
         # This is a pared down version of the `check_for_plugin_route_matches`
         # method for firehose plugins (no regexing or return values)
-        active_firehose_plugins = line._active_plugin_slugs.intersection(
-            self.firehose_router.viewkeys())
-        for plugin_slug in active_firehose_plugins:
-            for _, func, plugin in self.firehose_router[plugin_slug]:
-                # firehose gets everything, no rule matching
-                LOG.info('Match: %s.%s', plugin_slug, func.__name__)
-                with statsd.timer(".".join(["plugins", plugin_slug])):
-                    # FIXME: This will not have correct timing if go back to
-                    # gevent.
-                    channel_plugin = self.setup_plugin_for_channel(
-                        plugin.__class__, line)
-                    new_func = log_on_error(LOG, getattr(channel_plugin,
-                                                         func.__name__))
-                    if hasattr(self, 'gevent'):
-                        self.gevent.Greenlet.spawn(new_func, line)
-                    else:
-                        channel_plugin.respond(new_func(line))
+        for plugin_slug, func, channel_plugin in plan.firehose:
+            if slugs is not None and plugin_slug not in slugs:
+                continue
+            # firehose gets everything, no rule matching
+            LOG.info('Match: %s.%s', plugin_slug, func.__name__)
+            self.executor.submit(plugin_slug, channel_plugin, func, (line,),
+                                 {}, channel_plugin.respond)
 
         # pass line to other routers
         if line._is_message:
-            self.check_for_plugin_route_matches(line, self.messages_router)
+            self.check_for_plugin_route_matches(line, plan.messages, slugs)
 
             if line.is_direct_message:
-                self.check_for_plugin_route_matches(line, self.mentions_router)
+                self.check_for_plugin_route_matches(line, plan.mentions,
+                                                    slugs)
+
+    def warm_up(self, channel_ids):
+        """Builds the dispatch plans of channels ahead of their lines"""
+        for channel_id in channel_ids:
+            key = self.registry.channel_keys.get(channel_id)
+            if key is None:
+                continue
+            chatbot_id, name = key
+            line = Line({
+                'ChatBotId': chatbot_id,
+                'Channel': name,
+                'Command': u'',
+                'Content': u'',
+                'User': u'',
+                'Received': None,
+            }, self)
+            if not line.is_valid():
+                continue
+            try:
+                self.plan_for(line)
+            except Exception:
+                LOG.error("Building the plan of channel %s failed",
+                          channel_id, exc_info=True)
 
     def setup_plugin_for_channel(self, fake_plugin_class, line):
         """Given a dummy plugin class, initialize it for the line's channel"""
-        class RealPlugin(RealPluginMixin, fake_plugin_class):
-            pass
-        plugin = RealPlugin(slug=fake_plugin_class.__module__.split('.')[-1],
-                            channel=line._channel,
-                            chatbot_id=line._chatbot_id,
-                            app=self)
+        plugin = real_plugin_class(fake_plugin_class)(
+            slug=fake_plugin_class.__module__.split('.')[-1],
+            channel=line._channel,
+            chatbot_id=line._chatbot_id,
+            app=self)
         return plugin
 
-    def check_for_plugin_route_matches(self, line, router):
-        """Checks the active plugins' routes and calls functions on matches"""
-        # get the active routes for this channel
-        active_slugs = line._active_plugin_slugs.intersection(router.viewkeys())
-        for plugin_slug in active_slugs:
-            for rule, func, plugin in router[plugin_slug]:
-                match = re.match(rule, line.text, re.IGNORECASE)
-                if match:
-                    LOG.info('Match: %s.%s', plugin_slug, func.__name__)
-                    with statsd.timer(".".join(["plugins", plugin_slug])):
-                        # FIXME: This will not have correct timing if go back to
-                        # gevent.
-                        # Instantiate a plugin specific to this channel
-                        channel_plugin = self.setup_plugin_for_channel(
-                            plugin.__class__, line)
-                        # get the method from the channel-specific plugin
-                        new_func = log_on_error(LOG, getattr(channel_plugin,
-                                                             func.__name__))
-                        if hasattr(self, 'gevent'):
-                            grnlt = self.gevent.Greenlet(new_func, line,
-                                                         **match.groupdict())
-                            grnlt.link_value(channel_plugin.greenlet_respond)
-                            grnlt.start()
-                        else:
-                            channel_plugin.respond(new_func(line,
-                                                            **match.groupdict()))
+    def check_for_plugin_route_matches(self, line, router, slugs=None):
+        """
+        Checks the routes of a channel's plan and calls functions on
+        matches
+        """
+        for route, match in router.matches(line.text, slugs):
+            plugin_slug, func = route.slug, route.func
+            LOG.info('Match: %s.%s', plugin_slug, func.__name__)
+            self.executor.submit(plugin_slug, route.plugin, func, (line,),
+                                 match.groupdict(), route.plugin.respond)
+
+
+def log_startup(start):
+    """Logs the time it took a runner to start and its memory use"""
+    # kilobytes on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    LOG.info('Plugin runner started in %.2fs, max RSS %.1f MB',
+             time.time() - start, rss / 1024.0)
+    statsd.gauge(".".join(["plugins", "startup", "rss"]), rss)
+    statsd.timing(".".join(["plugins", "startup"]),
+                  (time.time() - start) * 1000)
+
+
+def exit_on_sigterm():
+    """Turns SIGTERM into SystemExit so shutdown hooks get to run"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
 
 def start_plugins(*args, **kwargs):
@@ -293,7 +649,17 @@ def start_plugins(*args, **kwargs):
     Used by the management command to start-up plugin listener
     and register the plugins.
     """
-    LOG.info('Starting plugins. Gevent=%s', kwargs['use_gevent'])
+    exit_on_sigterm()
+    workers = kwargs.pop('workers', 1)
+    if workers > 1:
+        from .shards import start_sharded
+        return start_sharded(workers, **kwargs)
+    LOG.info('Starting plugins. Executor=%s',
+             'gevent' if kwargs.get('use_gevent') else
+             kwargs.get('executor') or settings.PLUGIN_EXECUTOR)
+    start = time.time()
     app = PluginRunner(**kwargs)
     app.register_all_plugins()
+    app.start_registry(snapshot.snapshot_path())
+    log_startup(start)
     app.listen()
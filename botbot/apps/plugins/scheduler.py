@@ -0,0 +1,65 @@
+"""
+Fair scheduling of lines between channels.
+
+Lines read from the queue are held in one FIFO per ``(ChatBotId, Channel)``
+and handed to the dispatcher by deficit round robin: each channel with lines
+waiting gets ``quantum`` lines worth of credit per round. A flooded channel
+only ever delays the others by ``quantum`` lines per channel in the
+rotation, while its own lines stay in order. That only holds for the lines
+the scheduler holds: the runner reads ahead while the queue has a backlog,
+up to PLUGIN_FAIR_MAX_PENDING lines, and a line further back than that
+waits for the lines in front of it.
+"""
+from collections import deque
+
+
+class FairScheduler(object):
+
+    def __init__(self, quantum):
+        if quantum < 1:
+            # no credit would ever build up, take() would never return
+            raise ValueError('quantum must be at least 1')
+        self.quantum = quantum
+        # (chatbot id, channel name) -> deque of lines
+        self.queues = {}
+        # keys with lines waiting, in round robin order
+        self.active = deque()
+        # key -> credit left of its current turn
+        self.deficit = {}
+        # key whose turn it is, it may carry over to the next take()
+        self.serving = None
+        self.pending = 0
+
+    def add(self, line):
+        key = (line._chatbot_id, line._channel_name)
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            self.deficit[key] = 0
+            self.active.append(key)
+        queue.append(line)
+        self.pending += 1
+
+    def take(self, count):
+        """Up to ``count`` lines, channels taking turns"""
+        lines = []
+        while self.active and len(lines) < count:
+            key = self.active[0]
+            queue = self.queues[key]
+            if key != self.serving:
+                self.serving = key
+                self.deficit[key] += self.quantum
+            while queue and self.deficit[key] >= 1 and len(lines) < count:
+                lines.append(queue.popleft())
+                self.deficit[key] -= 1
+            if not queue:
+                # idle channels don't bank credit
+                self.active.popleft()
+                del self.queues[key]
+                del self.deficit[key]
+                self.serving = None
+            elif self.deficit[key] < 1:
+                self.active.rotate(-1)
+                self.serving = None
+        self.pending -= len(lines)
+        return lines
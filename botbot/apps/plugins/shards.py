@@ -0,0 +1,209 @@
+"""
+Fans the plugin queue out to a pool of PluginRunner processes.
+
+A dispatcher drains the shared queue and hashes every packet by
+``(ChatBotId, Channel)`` onto one of N sub-queues, each consumed by its own
+worker process. Lines from the same channel stay in order while different
+channels are handled in parallel. Workers share nothing but Redis and
+Postgres, and since the sub-queues live in Redis a worker that dies is
+restarted and carries on with its shard's backlog.
+"""
+import logging
+import multiprocessing
+import time
+import zlib
+
+import redis
+from django.conf import settings
+from django.db import connections
+from django_statsd.clients import statsd
+
+from . import codec
+from .registry import Registry
+from .transport import get_transport, QUEUE
+
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+# Remembers how many shards the last dispatcher used
+SHARD_COUNT_KEY = '{0}:shards'.format(QUEUE)
+
+
+def shard_queue(index):
+    """Name of the sub-queue for a given shard"""
+    return '{0}:{1}'.format(QUEUE, index)
+
+
+def shard_for(packet, workers):
+    """Stable shard index for the packet's (ChatBotId, Channel)"""
+    key = u'{0}:{1}'.format(packet['ChatBotId'], packet['Channel'].strip())
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % workers
+
+
+def run_worker(index, **kwargs):
+    """Entry point of a worker process, consumes a single shard"""
+    from .runner import PluginRunner, exit_on_sigterm, log_startup
+    from .snapshot import snapshot_path
+    exit_on_sigterm()
+    LOG.info('Starting plugin worker %s', index)
+    start = time.time()
+    # Sub-queues are always plain lists fed by the dispatcher
+    app = PluginRunner(queue=shard_queue(index), transport='list', **kwargs)
+    app.register_all_plugins()
+    app.start_registry(snapshot_path(index))
+    log_startup(start)
+    app.listen()
+
+
+class ShardDispatcher(object):
+    """
+    Reads the bot's queue and routes every packet to its shard's sub-queue.
+
+    Packets are passed on as they came unless they are to be re-encoded in
+    PLUGIN_CODEC, or PLUGIN_CODEC_LEAN drops their ``Raw`` field for
+    channels without an active plugin needing it.
+    """
+
+    def __init__(self, workers, transport=None, batch_size=None,
+                 batch_latency=None, codec_kind=None, lean=None):
+        self.workers = workers
+        self.bot_bus = redis.StrictRedis.from_url(
+            settings.REDIS_PLUGIN_QUEUE_URL)
+        self.transport = get_transport(self.bot_bus, kind=transport,
+                                       batch_size=batch_size,
+                                       batch_latency=batch_latency)
+        self.codec = codec_kind or settings.PLUGIN_CODEC
+        self.lean = settings.PLUGIN_CODEC_LEAN if lean is None else lean
+        self.registry = None
+        if self.lean:
+            from .runner import raw_slugs
+            self.raw_slugs = raw_slugs()
+            self.registry = Registry()
+            self.registry.load()
+            self.registry.subscribe(self.bot_bus)
+
+    def needs_raw(self, packet):
+        """Whether an active plugin of the packet's channel reads Raw"""
+        channel = self.registry.channel(packet['ChatBotId'],
+                                        packet['Channel'].strip())
+        if channel is None:
+            # private message or unknown channel, Raw isn't logged
+            return False
+        _, slugs = self.registry.active_plugin_state(channel.pk)
+        return bool(slugs & self.raw_slugs)
+
+    def encode(self, packet, val):
+        """The packet as it goes to a shard"""
+        if self.lean and not self.needs_raw(packet):
+            return codec.encode(codec.lean(packet), self.codec)
+        if self.codec != 'json':
+            return codec.encode(packet, self.codec)
+        return val
+
+    def reclaim_stale_shards(self):
+        """
+        Moves lines left in sub-queues of a previous, larger pool back to
+        the head of the main queue, in order, so they get re-sharded.
+        """
+        previous = int(self.bot_bus.get(SHARD_COUNT_KEY) or 0)
+        for index in range(self.workers, previous):
+            moved = 0
+            while self.bot_bus.rpoplpush(shard_queue(index), QUEUE):
+                moved += 1
+            if moved:
+                LOG.info('Moved %s lines from stale shard %s', moved, index)
+        self.bot_bus.set(SHARD_COUNT_KEY, self.workers)
+
+    def route(self, packets):
+        """Pushes a batch of raw packets to their sub-queues in one trip"""
+        shards = {}
+        for val in packets:
+            try:
+                packet = codec.decode(val)
+                index = shard_for(packet, self.workers)
+                val = self.encode(packet, val)
+            except Exception:
+                LOG.error("Line Routing Failed", exc_info=True, extra={
+                    "line": val
+                })
+                continue
+            shards.setdefault(index, []).append(val)
+
+        pipe = self.bot_bus.pipeline(transaction=False)
+        for index, vals in shards.iteritems():
+            pipe.rpush(shard_queue(index), *vals)
+        pipe.execute()
+
+    def dispatch_once(self):
+        if self.registry is not None:
+            self.registry.refresh()
+        packets, depth = self.transport.next_batch()
+        statsd.gauge(".".join(["plugins", "q"]), depth)
+        if packets:
+            self.route(packets)
+        self.transport.ack()
+
+
+class Supervisor(object):
+    """Keeps one process per shard alive"""
+
+    def __init__(self, workers, worker_kwargs):
+        self.workers = workers
+        self.worker_kwargs = worker_kwargs
+        self.processes = {}
+
+    def spawn(self, index):
+        # Children must not inherit the parent's database connections
+        connections.close_all()
+        process = multiprocessing.Process(
+            target=run_worker, args=(index,), kwargs=self.worker_kwargs,
+            name='plugins-{0}'.format(index))
+        process.daemon = True
+        process.start()
+        self.processes[index] = process
+
+    def check(self):
+        """Restarts any worker that has died"""
+        for index in range(self.workers):
+            process = self.processes.get(index)
+            if process is None or not process.is_alive():
+                if process is not None:
+                    LOG.error('Plugin worker %s died (exit code %s), '
+                              'restarting', index, process.exitcode)
+                    statsd.incr(".".join(["plugins", "worker_restarts"]))
+                self.spawn(index)
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(5)
+
+
+def start_sharded(workers, transport=None, batch_size=None,
+                  batch_latency=None, **kwargs):
+    """
+    Runs the dispatcher in this process and supervises ``workers`` plugin
+    runner processes.
+    """
+    LOG.info('Starting plugins with %s workers. Executor=%s', workers,
+             'gevent' if kwargs.get('use_gevent') else
+             kwargs.get('executor') or settings.PLUGIN_EXECUTOR)
+    dispatcher = ShardDispatcher(workers, transport=transport,
+                                 batch_size=batch_size,
+                                 batch_latency=batch_latency)
+    dispatcher.reclaim_stale_shards()
+
+    kwargs.update(batch_size=batch_size, batch_latency=batch_latency)
+    supervisor = Supervisor(workers, kwargs)
+    try:
+        while 1:
+            supervisor.check()
+            try:
+                dispatcher.dispatch_once()
+            except Exception:
+                LOG.error("Queue read failed", exc_info=True)
+                time.sleep(1)
+    finally:
+        supervisor.stop()
@@ -0,0 +1,84 @@
+"""
+Warm restarts of the plugin runner.
+
+When it shuts down, a runner saves its registry (chatbots, channels, active
+plugins and their configuration) and the channels it has dispatch plans
+for to PLUGIN_SNAPSHOT, a file per worker. A runner starting less than
+PLUGIN_SNAPSHOT_MAX_AGE seconds later starts from it rather than from
+the database. It then catches up with what changed in between: chatbots
+are reloaded, along with the channels whose fingerprint changed and the
+channels invalidated since the snapshot (publish_invalidation keeps a log
+of them). The dispatch plans of the channels the runner was serving are
+built before it reads the queue, so their first lines don't wait on it.
+"""
+import cPickle as pickle
+import logging
+import os
+import time
+
+from django.conf import settings
+
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+# Changes when what save() writes does
+VERSION = 1
+
+# Invalidations this many seconds older than the snapshot are replayed too,
+# the clocks of the web servers and the runner may disagree a little
+CLOCK_SKEW = 60
+
+
+def snapshot_path(shard=None):
+    """PLUGIN_SNAPSHOT, or the file of a worker of a sharded runner"""
+    if not settings.PLUGIN_SNAPSHOT or shard is None:
+        return settings.PLUGIN_SNAPSHOT
+    return '{0}.{1}'.format(settings.PLUGIN_SNAPSHOT, shard)
+
+
+def save(app, path):
+    """Writes the runner's warm state to ``path``"""
+    start = time.time()
+    state = {
+        'version': VERSION,
+        'taken': start,
+        'registry': app.registry.dump(),
+        'plans': list(app.plans),
+    }
+    # written aside and renamed so a runner never reads half of it
+    temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as snapshot:
+        pickle.dump(state, snapshot, pickle.HIGHEST_PROTOCOL)
+    os.rename(temporary, path)
+    LOG.info('Saved a snapshot of %s channels in %.2fs',
+             len(state['registry']['channels']), time.time() - start)
+
+
+def restore(app, path):
+    """
+    Starts the runner from the snapshot at ``path`` if there is a recent
+    one, returns whether it did.
+    """
+    start = time.time()
+    try:
+        with open(path, 'rb') as snapshot:
+            state = pickle.load(snapshot)
+    except (IOError, EOFError):
+        return False
+    except Exception:
+        # e.g. a model changed since it was taken
+        LOG.warn('Could not read the snapshot at %s', path, exc_info=True)
+        return False
+    if state.get('version') != VERSION:
+        return False
+    age = start - state['taken']
+    if age > settings.PLUGIN_SNAPSHOT_MAX_AGE:
+        LOG.info('Snapshot taken %.0fs ago is too old', age)
+        return False
+
+    app.registry.restore(state['registry'])
+    app.registry.revalidate(app.bot_bus, state['taken'] - CLOCK_SKEW)
+    app.warm_up(state['plans'])
+    LOG.info('Restored a snapshot taken %.0fs ago in %.2fs, %s plans built',
+             age, time.time() - start, len(app.plans))
+    return True
@@ -0,0 +1,232 @@
+"""
+Layouts of the plugin storage in Redis, chosen with PLUGIN_STORAGE_LAYOUT.
+
+``keys``, the original layout, stores every value under its own key
+``<chatbot>:<channel>:<slug>:<key>``.
+
+``hash`` keeps all values of a plugin on a channel (a namespace) as the
+fields of a single hash ``plugins:<chatbot>:<channel>:<slug>``. Small
+hashes are stored compactly by Redis, so that is a fraction of the memory
+of as many string keys. Namespaces can be capped to
+PLUGIN_STORAGE_MAX_FIELDS values and expire after
+PLUGIN_STORAGE_NAMESPACE_TTL seconds without writes. Hash fields can't
+expire on their own, the expiry of values stored with a ``ttl`` is kept in
+a sorted set ``<hash>:ttl``: expired values read as missing and are
+removed by the next write to the namespace.
+
+The scripts need Redis 5 or later (HSCAN in a script that writes).
+"""
+import time
+
+from django.conf import settings
+
+
+# Removes expired fields, enforces the cap and refreshes the namespace
+# expiry. ARGV[1..4] are now, ttl, cap and namespace ttl, ``written`` holds
+# the fields the script wrote.
+HOUSEKEEPING = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+for i = 1, #expired do
+    if not written[expired[i]] then
+        redis.call('HDEL', KEYS[1], expired[i])
+    end
+    redis.call('ZREM', KEYS[2], expired[i])
+end
+if cap > 0 then
+    local excess = redis.call('HLEN', KEYS[1]) - cap
+    if excess > 0 then
+        -- values closest to expiring go first, then any others
+        local doomed = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+        for i = 1, #doomed do
+            if not written[doomed[i]] then
+                redis.call('HDEL', KEYS[1], doomed[i])
+                redis.call('ZREM', KEYS[2], doomed[i])
+                excess = excess - 1
+            end
+        end
+        local cursor = '0'
+        while excess > 0 do
+            local reply = redis.call('HSCAN', KEYS[1], cursor,
+                                     'COUNT', excess + 10)
+            cursor = reply[1]
+            for i = 1, #reply[2], 2 do
+                local field = reply[2][i]
+                if excess > 0 and not written[field] then
+                    redis.call('HDEL', KEYS[1], field)
+                    excess = excess - 1
+                end
+            end
+            if cursor == '0' then
+                break
+            end
+        end
+    end
+end
+if idle > 0 then
+    redis.call('EXPIRE', KEYS[1], idle)
+    redis.call('EXPIRE', KEYS[2], idle)
+end
+"""
+
+HEADER = """
+local now = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[2])
+local cap = tonumber(ARGV[3])
+local idle = tonumber(ARGV[4])
+local written = {}
+"""
+
+# ARGV[5..] are field, value pairs
+SET_SCRIPT = HEADER + """
+for i = 5, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    if ttl > 0 then
+        redis.call('ZADD', KEYS[2], now + ttl, ARGV[i])
+    else
+        redis.call('ZREM', KEYS[2], ARGV[i])
+    end
+    written[ARGV[i]] = true
+end
+""" + HOUSEKEEPING
+
+# ARGV[5] is the field, ARGV[6] the amount
+INCR_SCRIPT = HEADER + """
+local field = ARGV[5]
+local expires = redis.call('ZSCORE', KEYS[2], field)
+if expires and tonumber(expires) <= now then
+    redis.call('HDEL', KEYS[1], field)
+end
+local value = redis.call('HINCRBY', KEYS[1], field, ARGV[6])
+if ttl > 0 then
+    redis.call('ZADD', KEYS[2], now + ttl, field)
+else
+    redis.call('ZREM', KEYS[2], field)
+end
+written[field] = true
+""" + HOUSEKEEPING + """
+return value
+"""
+
+# ARGV[1] is now, ARGV[2..] the fields. Read only, so it runs on replicas.
+GET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local values = redis.call('HMGET', KEYS[1], unpack(ARGV, 2))
+for i = 2, #ARGV do
+    local expires = redis.call('ZSCORE', KEYS[2], ARGV[i])
+    if expires and tonumber(expires) <= now then
+        values[i - 1] = false
+    end
+end
+return values
+"""
+
+
+class KeyLayout(object):
+    """One Redis string per value"""
+    name = 'keys'
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def key(self, namespace, key):
+        chatbot_id, channel_id, slug = namespace
+        return u'{0}:{1}:{2}:{3}'.format(chatbot_id, channel_id, slug,
+                                         key.strip())
+
+    def set_many(self, client, namespace, mapping, ttl=None):
+        """Queues the writes on ``client``, a connection or pipeline"""
+        for key, value in mapping.iteritems():
+            client.set(self.key(namespace, key), value, ex=ttl)
+
+    def get_many(self, namespace, keys):
+        return self.connection.mget([self.key(namespace, key)
+                                     for key in keys])
+
+    def incr(self, namespace, key, amount=1, ttl=None):
+        ukey = self.key(namespace, key)
+        if ttl is None:
+            return self.connection.incr(ukey, amount)
+        pipe = self.connection.pipeline()
+        pipe.incr(ukey, amount)
+        pipe.expire(ukey, ttl)
+        return pipe.execute()[0]
+
+    def delete(self, namespace, key):
+        return self.connection.delete(self.key(namespace, key)) == 1
+
+
+class HashLayout(object):
+    """One Redis hash per plugin and channel"""
+    name = 'hash'
+
+    def __init__(self, connection, max_fields=None, namespace_ttl=None):
+        self.connection = connection
+        if max_fields is None:
+            max_fields = settings.PLUGIN_STORAGE_MAX_FIELDS
+        self.max_fields = max_fields
+        if namespace_ttl is None:
+            namespace_ttl = settings.PLUGIN_STORAGE_NAMESPACE_TTL
+        self.namespace_ttl = namespace_ttl
+        self.set_script = connection.register_script(SET_SCRIPT)
+        self.incr_script = connection.register_script(INCR_SCRIPT)
+        self.get_script = connection.register_script(GET_SCRIPT)
+
+    def keys(self, namespace):
+        """The hash of a namespace and the sorted set of its expiries"""
+        chatbot_id, channel_id, slug = namespace
+        name = u'plugins:{0}:{1}:{2}'.format(chatbot_id, channel_id, slug)
+        return [name, name + u':ttl']
+
+    def args(self, ttl):
+        return [time.time(), ttl or 0, self.max_fields, self.namespace_ttl]
+
+    def set_many(self, client, namespace, mapping, ttl=None):
+        """Queues the writes on ``client``, a connection or pipeline"""
+        if not mapping:
+            return
+        args = self.args(ttl)
+        for key, value in mapping.iteritems():
+            args.extend([key.strip(), value])
+        self.set_script(keys=self.keys(namespace), args=args, client=client)
+
+    def get_many(self, namespace, keys):
+        return self.get_script(keys=self.keys(namespace),
+                               args=[time.time()] + [key.strip()
+                                                     for key in keys])
+
+    def incr(self, namespace, key, amount=1, ttl=None):
+        return self.incr_script(keys=self.keys(namespace),
+                                args=self.args(ttl) + [key.strip(), amount])
+
+    def delete(self, namespace, key):
+        name, expiries = self.keys(namespace)
+        pipe = self.connection.pipeline()
+        pipe.hdel(name, key.strip())
+        pipe.zrem(expiries, key.strip())
+        return pipe.execute()[0] == 1
+
+    def import_many(self, client, namespace, items):
+        """
+        Queues ``(key, value, ttl)`` items on ``client`` without
+        overwriting values already in the hash, for migrations.
+        """
+        name, expiries = self.keys(namespace)
+        now = time.time()
+        for key, value, ttl in items:
+            client.hsetnx(name, key.strip(), value)
+            if ttl:
+                client.zadd(expiries, now + ttl, key.strip())
+        if self.namespace_ttl:
+            client.expire(name, self.namespace_ttl)
+            client.expire(expiries, self.namespace_ttl)
+
+
+LAYOUTS = {
+    'keys': KeyLayout,
+    'hash': HashLayout,
+}
+
+
+def get_layout(connection, kind=None):
+    """Layout named ``kind``, defaults to the PLUGIN_STORAGE_LAYOUT setting"""
+    return LAYOUTS[kind or settings.PLUGIN_STORAGE_LAYOUT](connection)
@@ -1,9 +1,28 @@
  # -*- coding: utf-8 -*-
+import BaseHTTPServer
+import SocketServer
 import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
 
+import redis
+from django.db import IntegrityError, transaction
 from django.utils.timezone import utc
 from django.test import TestCase
-from . import utils
+from botbot.apps.bots.models import ChatBot, Channel, UserCount
+from botbot.apps.logs.models import Log
+from django.test.utils import override_settings
+from . import (backfill, breaker, codec, decorators, executor, httpclient,
+               loadtest, manifest, models, plans, registry, routing, runner,
+               scheduler, shards, snapshot, storage, transport, utils)
+from .core import logger, occupancy
+from .management.commands import migrate_plugin_storage
+from .models import ActivePlugin, Plugin
 
 
 class UtilsTestCase(TestCase):
@@ -19,4 +38,1722 @@ class UtilsTestCase(TestCase):
         py_date = utils.convert_nano_timestamp(timestamp)
         self.assertEqual(py_date,
                          datetime.datetime(2014, 1, 27, 16, 35, 
-                                           53, 123400, tzinfo=utc))
\ No newline at end of file
+                                           53, 123400, tzinfo=utc))
+
+    def test_timestamp_variants(self):
+        self.assertEqual(utils.convert_nano_timestamp('2014-01-27T16:35:53Z'),
+                         datetime.datetime(2014, 1, 27, 16, 35, 53,
+                                           tzinfo=utc))
+        self.assertEqual(
+            utils.convert_nano_timestamp('2014-01-27T18:35:53.5+02:00'),
+            datetime.datetime(2014, 1, 27, 16, 35, 53, 500000, tzinfo=utc))
+        self.assertRaises(ValueError, utils.convert_nano_timestamp,
+                          '2014-01-27 16:35:53')
+
+    def test_ttl_cache(self):
+        cache = utils.TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # b is the least recently used
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('d', 4, ttl=0.05)
+        time.sleep(0.1)
+        self.assertEqual(cache.get('d', 'gone'), 'gone')
+
+
+@unittest.skipUnless(os.environ.get('BOTBOT_BENCHMARKS'),
+                     'set BOTBOT_BENCHMARKS=1 to run benchmarks')
+class LineBenchmarkTestCase(TestCase):
+    def test_line(self):
+        from . import benchmarks
+        # the numbers are reported by ``manage.py bench_plugins line``
+        results = benchmarks.bench_line(iterations=500)
+        self.assertLess(results['slotted, bytes per line'],
+                        results['legacy, bytes per line'])
+        self.assertGreater(results['slotted, timestamp used'],
+                           results['legacy, timestamp used'])
+
+
+class ShardsTestCase(TestCase):
+    def packet(self, chatbot_id, channel):
+        return {'ChatBotId': chatbot_id, 'Channel': channel}
+
+    def test_same_channel_same_shard(self):
+        self.assertEqual(shards.shard_for(self.packet(1, u'#django'), 8),
+                         shards.shard_for(self.packet(1, u'#django '), 8))
+
+    def test_shards_in_range(self):
+        for i in range(50):
+            packet = self.packet(i % 3, u'#chan{0}'.format(i))
+            self.assertIn(shards.shard_for(packet, 4), range(4))
+
+    def test_spreads_channels(self):
+        used = set(shards.shard_for(self.packet(1, u'#chan{0}'.format(i)), 4)
+                   for i in range(50))
+        self.assertEqual(used, set(range(4)))
+
+
+
+class ListBus(object):
+    """A Redis list, with DRAIN_SCRIPT run the way Redis would"""
+    def __init__(self, packets=()):
+        self.packets = list(packets)
+        self.drains = []
+        self.blpops = 0
+
+    def register_script(self, script):
+        return self.drain
+
+    def drain(self, keys, args):
+        count = int(args[0])
+        self.drains.append(count)
+        taken = self.packets[:count] if count > 0 else []
+        del self.packets[:len(taken)]
+        return [taken, len(self.packets)]
+
+    def blpop(self, key, timeout):
+        self.blpops += 1
+        if not self.packets:
+            return None
+        return key, self.packets.pop(0)
+
+    def llen(self, key):
+        return len(self.packets)
+
+
+class ListTransportTestCase(TestCase):
+    def test_drains_a_batch(self):
+        bus = ListBus(range(5))
+        queue = transport.ListTransport(bus, batch_size=3, batch_latency=0)
+        self.assertEqual(queue.next_batch(), ([0, 1, 2], 2))
+        self.assertEqual(queue.next_batch(), ([3, 4], 0))
+        self.assertEqual(bus.blpops, 0)
+
+    def test_blocks_on_an_empty_queue(self):
+        bus = ListBus()
+        queue = transport.ListTransport(bus, batch_size=3, batch_latency=0)
+        self.assertEqual(queue.next_batch(), ([], 0))
+        self.assertEqual(bus.blpops, 1)
+        self.assertEqual(queue.next_batch(block=False), ([], 0))
+        self.assertEqual(bus.blpops, 1)
+
+    def test_fills_the_batch_after_blocking(self):
+        bus = ListBus()
+        queue = transport.ListTransport(bus, batch_size=3, batch_latency=0)
+        # nothing to drain, then lines arrive during the blocking pop
+        original = bus.blpop
+
+        def blpop(key, timeout):
+            bus.packets.extend(range(5))
+            return original(key, timeout)
+        bus.blpop = blpop
+        self.assertEqual(queue.next_batch(), ([0, 1, 2], 2))
+        # the depth is sampled by the second drain
+        self.assertEqual(bus.drains, [3, 2])
+
+    def test_batch_of_one(self):
+        bus = ListBus()
+        queue = transport.ListTransport(bus, batch_size=1, batch_latency=0)
+        original = bus.blpop
+
+        def blpop(key, timeout):
+            bus.packets.extend(range(3))
+            return original(key, timeout)
+        bus.blpop = blpop
+        self.assertEqual(queue.next_batch(), ([0], 2))
+        # no drain of the whole queue
+        self.assertEqual(bus.drains, [1])
+        self.assertEqual(bus.packets, [1, 2])
+
+    def test_batch_size_is_validated(self):
+        with self.assertRaises(ValueError):
+            transport.ListTransport(ListBus(), batch_size=-1)
+
+
+class StreamBus(object):
+    """Replies to the stream commands, records them all"""
+    def __init__(self, **replies):
+        # command -> replies, handed out in turn
+        self.replies = replies
+        self.commands = []
+
+    def execute_command(self, *args):
+        self.commands.append(args)
+        replies = self.replies.get(args[0])
+        if not replies:
+            # the lease is free
+            return {'XPENDING': [], 'XINFO': [], 'EVAL': 1}.get(args[0])
+        reply = replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def sent(self, command):
+        return [args for args in self.commands if args[0] == command]
+
+
+@override_settings(PLUGIN_STREAM_CLAIM_IDLE=60000, PLUGIN_STREAM_MAXLEN=1000,
+                   PLUGIN_BATCH_LATENCY=0)
+class StreamTransportTestCase(TestCase):
+    def stream(self, bus):
+        return transport.StreamTransport(bus, batch_size=10, group='plugins',
+                                         consumer='me')
+
+    def entries(self, *ids):
+        return [['q:stream', [[entry_id, ['packet', 'p' + entry_id]]
+                              for entry_id in ids]]]
+
+    def test_group_already_exists(self):
+        bus = StreamBus(XGROUP=[redis.ResponseError(
+            'BUSYGROUP Consumer Group name already exists')])
+        self.stream(bus)
+        self.assertEqual(bus.sent('XGROUP'), [
+            ('XGROUP', 'CREATE', 'q:stream', 'plugins', '0', 'MKSTREAM')])
+        bus = StreamBus(XGROUP=[redis.ResponseError('WRONGTYPE')])
+        with self.assertRaises(redis.ResponseError):
+            self.stream(bus)
+
+    def test_reads_entries(self):
+        bus = StreamBus(XREADGROUP=[self.entries('1-0', '2-0')],
+                        XINFO=[[['name', 'plugins', 'pending', 2,
+                                 'lag', 5]]])
+        queue = self.stream(bus)
+        self.assertEqual(queue.next_batch(), (['p1-0', 'p2-0'], 5))
+        self.assertEqual(queue.entry_ids, ['1-0', '2-0'])
+        self.assertEqual(bus.sent('XREADGROUP')[0], (
+            'XREADGROUP', 'GROUP', 'plugins', 'me', 'COUNT', 10,
+            'BLOCK', 1000, 'STREAMS', 'q:stream', '>'))
+
+    def test_depth_without_lag(self):
+        bus = StreamBus(XREADGROUP=[self.entries('1-0')],
+                        XINFO=[[['name', 'other', 'pending', 9],
+                                ['name', 'plugins', 'pending', 4]]])
+        self.assertEqual(self.stream(bus).next_batch(), (['p1-0'], 4))
+
+    def test_trimmed_entries_are_acked(self):
+        bus = StreamBus(XREADGROUP=[[['q:stream', [['1-0', None],
+                                                   ['2-0', ['packet', 'p']]
+                                                   ]]]])
+        queue = self.stream(bus)
+        self.assertEqual(queue.next_batch()[0], ['p'])
+        self.assertEqual(queue.entry_ids, ['2-0'])
+        queue.ack([])
+        self.assertEqual(bus.sent('XACK'),
+                         [('XACK', 'q:stream', 'plugins', '1-0')])
+
+    def test_claims_entries_of_previous_consumers(self):
+        bus = StreamBus(
+            XPENDING=[[['1-0', 'dead', 90000, 1], ['2-0', 'me', 90000, 1],
+                       ['3-0', 'dead', 10, 1]]],
+            XCLAIM=[[['1-0', ['packet', 'p1-0']],
+                     ['3-0', ['packet', 'p3-0']]]])
+        queue = self.stream(bus)
+        self.assertEqual(queue.next_batch()[0], ['p1-0', 'p3-0'])
+        self.assertEqual(bus.sent('XCLAIM'), [
+            ('XCLAIM', 'q:stream', 'plugins', 'me', 0, '1-0', '3-0')])
+        self.assertEqual(bus.sent('XREADGROUP'), [])
+        # none left, new entries are read
+        queue.next_batch(block=False)
+        self.assertEqual(len(bus.sent('XPENDING')), 2)
+        self.assertEqual(len(bus.sent('XREADGROUP')), 1)
+        queue.next_batch(block=False)
+        self.assertEqual(len(bus.sent('XPENDING')), 2)
+
+    def test_one_consumer_at_a_time(self):
+        bus = StreamBus(EVAL=[0, 0, 1],
+                        XREADGROUP=[self.entries('1-0')])
+        queue = self.stream(bus)
+        # another consumer holds the lease
+        self.assertEqual(queue.next_batch(block=False), ([], 0))
+        self.assertEqual(bus.sent('EVAL')[0][2:], (
+            1, 'q:stream:plugins:consumer', 'me', 60000))
+        self.assertEqual(queue.next_batch(block=False), ([], 0))
+        self.assertEqual(bus.sent('XREADGROUP'), [])
+        # it expired
+        self.assertEqual(queue.next_batch(block=False)[0], ['p1-0'])
+        # renewed now and then, not on every read
+        queue.next_batch(block=False)
+        self.assertEqual(len(bus.sent('EVAL')), 3)
+
+    def test_acks_in_one_command_and_trims(self):
+        groups = [['name', 'plugins', 'pending', 2,
+                   'last-delivered-id', '900-0'],
+                  ['name', 'recorder', 'pending', 0,
+                   'last-delivered-id', '950-0']]
+        # the first ones are for the claim and the depth of next_batch
+        bus = StreamBus(XREADGROUP=[self.entries('1-0', '2-0', '3-0')],
+                        XLEN=[5000], XINFO=[groups, groups],
+                        XPENDING=[[], [2, '10-1', '12-0', [['me', 2]]]])
+        queue = self.stream(bus)
+        queue.next_batch()
+        queue.ack(['1-0', '3-0'])
+        self.assertEqual(bus.sent('XACK'),
+                         [('XACK', 'q:stream', 'plugins', '1-0', '3-0')])
+        queue.ack()
+        self.assertEqual(bus.sent('XACK')[1],
+                         ('XACK', 'q:stream', 'plugins', '2-0'))
+        for _ in range(98):
+            queue.ack(['x'])
+        # behind the oldest entry still pending
+        self.assertEqual(bus.sent('XTRIM'),
+                         [('XTRIM', 'q:stream', 'MINID', '~', '10-1')])
+
+    def test_trim_keeps_unread_entries(self):
+        bus = StreamBus(XLEN=[5000, 10],
+                        XINFO=[[['name', 'plugins', 'pending', 0,
+                                 'last-delivered-id', '900-0'],
+                                ['name', 'behind', 'pending', 0,
+                                 'last-delivered-id', '99-5']]])
+        queue = self.stream(bus)
+        queue.trim()
+        self.assertEqual(bus.sent('XTRIM'),
+                         [('XTRIM', 'q:stream', 'MINID', '~', '99-5')])
+        # not over maxlen
+        queue.trim()
+        self.assertEqual(len(bus.sent('XTRIM')), 1)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+            server.clients.add(self.client_address)
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+        body = self.path
+        self.send_response(404 if body.startswith('/missing') else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubHandler)
+        self.lock = threading.Lock()
+        self.requests = self.active = self.peak = 0
+        self.clients = set()
+        self.delay = 0
+
+
+class HttpClientTestCase(TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.client = httpclient.HttpClient(timeout=5, pool_size=4,
+                                            host_concurrency=2,
+                                            cache_size=10, cache_ttl=60)
+
+    def test_keep_alive(self):
+        for i in range(3):
+            response = self.client.get(self.url + '/{0}'.format(i), ttl=0)
+            self.assertEqual(response.text, '/{0}'.format(i))
+        self.assertEqual(self.server.requests, 3)
+        # a single connection
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_cache(self):
+        for _ in range(2):
+            response = self.client.get(self.url + '/a', params={'q': 1})
+            self.assertEqual(response.text, '/a?q=1')
+        self.assertEqual(self.server.requests, 1)
+        self.client.get(self.url + '/a', params={'q': 2})
+        self.assertEqual(self.server.requests, 2)
+
+    def test_errors_not_cached(self):
+        for _ in range(2):
+            response = self.client.get(self.url + '/missing')
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_cache_expires(self):
+        self.client.get(self.url + '/a', ttl=0.05)
+        time.sleep(0.1)
+        self.client.get(self.url + '/a')
+        self.assertEqual(self.server.requests, 2)
+
+    def test_host_concurrency(self):
+        self.server.delay = 0.05
+        threads = [threading.Thread(target=self.client.get,
+                                    args=(self.url + '/{0}'.format(i),))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.requests, 6)
+        self.assertLessEqual(self.server.peak, 2)
+
+
+class CodecTestCase(TestCase):
+    packet = {'ChatBotId': 1, 'Channel': u'#botbot', 'Content': u'h\xe9llo',
+              'Raw': u':someone PRIVMSG #botbot :h\xe9llo'}
+
+    def test_json(self):
+        self.assertEqual(codec.decode(codec.encode(self.packet, 'json')),
+                         self.packet)
+
+    def test_unknown_version(self):
+        self.assertRaises(ValueError, codec.decode, '\x07garbage')
+
+    def test_lean(self):
+        lean = codec.lean(self.packet)
+        self.assertNotIn('Raw', lean)
+        self.assertEqual(lean['Content'], self.packet['Content'])
+
+    @unittest.skipIf(codec.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        data = codec.encode(self.packet, 'msgpack')
+        self.assertEqual(data[:1], codec.BINARY_V1)
+        self.assertEqual(codec.decode(data), self.packet)
+
+
+class RoutingTestCase(TestCase):
+    def test_literal_prefix(self):
+        self.assertEqual(routing.literal_prefix(ur'^help$'),
+                         (u'help', u'help'))
+        self.assertEqual(routing.literal_prefix(ur'^Help (?P<command>.*)'),
+                         (u'help ', u'help'))
+        self.assertEqual(routing.literal_prefix(ur'^hi'), (u'hi', u''))
+        self.assertEqual(routing.literal_prefix(ur'^pings?'), (u'ping', u''))
+        self.assertEqual(routing.literal_prefix(ur'^!motivate\s'),
+                         (u'!motivate', u''))
+        self.assertEqual(routing.literal_prefix(ur'(.*)'), (u'', u''))
+        self.assertEqual(routing.literal_prefix(ur'^help|^info'), (u'', u''))
+        self.assertEqual(routing.literal_prefix(ur'^(?x) a b'), (u'', u''))
+
+    def test_table_matches(self):
+        table = routing.RouteTable()
+        rules = [ur'^help$', ur'^help (?P<command>.*)', ur'^hi',
+                 ur'.*django', ur'^!m']
+        for i, rule in enumerate(rules):
+            table.add('plugin{0}'.format(i), rule, lambda line: None, None)
+        active = set('plugin{0}'.format(i) for i in range(len(rules)))
+
+        def matched(text):
+            return [route.rule for route, _ in table.matches(text, active)]
+
+        self.assertEqual(matched(u'HELP'), [rules[0]])
+        self.assertEqual(matched(u'help django'), [rules[1], rules[3]])
+        self.assertEqual(matched(u'history'), [rules[2]])
+        self.assertEqual(matched(u'!motivate'), [rules[4]])
+        self.assertEqual(matched(u'nothing here'), [])
+        self.assertEqual(
+            [route.rule for route, _ in table.matches(u'help', set())], [])
+
+    def test_nick_matcher(self):
+        match = routing.nick_matcher(u'botbot')(u'BotBot: help')
+        self.assertEqual(match.groups()[0], u' help')
+        self.assertIsNone(routing.nick_matcher(u'botbot')(u'botbots'))
+        self.assertTrue(routing.nick_matcher(u'!')(u'!help'))
+
+
+class EchoPlugin(object):
+    config_class = None
+    slug = 'echo'
+
+    def echo(self, line, text):
+        return text
+    echo.route_rule = ('messages', ur'^echo (?P<text>.*)')
+
+    def everything(self, line):
+        pass
+    everything.route_rule = ('firehose', ur'(.*)')
+
+
+class StubChannel(object):
+    pk = 1
+    name = u'#test'
+    fingerprint = 'a'
+
+
+class StubApp(object):
+    def __init__(self):
+        self.plugins = {'echo': EchoPlugin()}
+        self.firehose_router = {'echo': [(ur'(.*)', EchoPlugin.everything,
+                                          self.plugins['echo'])]}
+        self.messages_router = routing.RouteTable()
+        self.messages_router.add('echo', EchoPlugin.echo.route_rule[1],
+                                 EchoPlugin.echo, self.plugins['echo'])
+        self.mentions_router = routing.RouteTable()
+        self.written = []
+
+    def plugin_config(self, channel, slug):
+        return {}
+
+    def load_plugin(self, slug):
+        return self.plugins.get(slug)
+
+    def write(self, commands, buffered=True):
+        self.written.append(commands)
+
+    def setup_plugin_for_channel(self, fake_plugin_class, line):
+        return plans.real_plugin_class(fake_plugin_class)(
+            slug='echo', channel=line._channel, chatbot_id=1, app=self)
+
+
+class StubLine(object):
+    _channel = StubChannel()
+    _chatbot_id = 1
+
+
+class DispatchPlanTestCase(TestCase):
+    def test_plan_binds_channel_plugins(self):
+        plan = plans.DispatchPlan(StubApp(), StubLine(), 'token', {'echo'})
+        plugin = plan.plugins['echo']
+        self.assertEqual(plugin.channel_id, 1)
+        self.assertEqual([(slug, p) for slug, _, p in plan.firehose],
+                         [('echo', plugin)])
+        [(route, match)] = list(plan.messages.matches(u'echo hi'))
+        self.assertIs(route.plugin, plugin)
+        self.assertEqual(route.func(StubLine(), **match.groupdict()), u'hi')
+
+    def test_plan_skips_inactive_plugins(self):
+        plan = plans.DispatchPlan(StubApp(), StubLine(), 'token', set())
+        self.assertEqual(plan.firehose, [])
+        self.assertEqual(list(plan.messages.matches(u'echo hi')), [])
+
+    def test_real_plugin_class_is_cached(self):
+        self.assertIs(plans.real_plugin_class(EchoPlugin),
+                      plans.real_plugin_class(EchoPlugin))
+
+    def test_is_current(self):
+        plan = plans.DispatchPlan(StubApp(), StubLine(), 'token', set())
+        self.assertTrue(plan.is_current('a', 'token'))
+        self.assertFalse(plan.is_current('b', 'token'))
+        self.assertFalse(plan.is_current('a', 'other'))
+
+
+class ManifestTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_describe(self):
+        entry = manifest.describe(EchoPlugin(), 'tests.echo')
+        self.assertEqual(entry['slug'], 'echo')
+        self.assertEqual(sorted(entry['routes']), [
+            ('firehose', ur'(.*)', 'everything'),
+            ('messages', ur'^echo (?P<text>.*)', 'echo')])
+        self.assertFalse(entry['flush'])
+        self.assertFalse(entry['ordered'])
+
+    def test_cached(self):
+        path = os.path.join(self.tmp, 'manifest.json')
+        entries = manifest.load(path)
+        self.assertTrue(os.path.exists(path))
+        self.assertIn('logger', [entry['slug'] for entry in entries])
+        self.assertEqual(manifest.load(path), entries)
+
+    def test_lazy_registration(self):
+        path = os.path.join(self.tmp, 'manifest.json')
+        app = runner.PluginRunner(executor='inline')
+        with override_settings(PLUGIN_MANIFEST=path):
+            app.register_all_plugins(lazy=True)
+        help_plugin = app.plugins['help']
+        self.assertIsNone(help_plugin.instance)
+        self.assertEqual(
+            [route.func.__name__ for route, _
+             in app.mentions_router.matches(u'help', set(['help']))],
+            ['respond_to_help'])
+        plugin = app.load_plugin('help')
+        self.assertEqual(plugin.__class__.__module__,
+                         'botbot.apps.plugins.core.help')
+        self.assertIs(app.load_plugin('help'), plugin)
+
+
+class RespondTestCase(TestCase):
+    def test_reply_written_in_one_go(self):
+        app = StubApp()
+        plugin = app.setup_plugin_for_channel(EchoPlugin, StubLine())
+        plugin.respond(u'one\ntwo')
+        plugin.respond(u'')
+        self.assertEqual(app.written, [[u'WRITE 1 #test one',
+                                        u'WRITE 1 #test two']])
+
+
+class Responses(object):
+    def __init__(self):
+        self.results = []
+        self.done = threading.Event()
+
+    def respond(self, msg, buffered=True):
+        self.results.append((msg, buffered))
+        self.done.set()
+
+    def wait_for(self, count, timeout=1):
+        deadline = time.time() + timeout
+        while len(self.results) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return len(self.results) >= count
+
+
+class OrderedPlugin(object):
+    ordered = True
+
+
+class LimitedPlugin(object):
+    max_concurrency = 1
+    call_timeout = 0.1
+
+
+class ExecutorTestCase(TestCase):
+    def test_ordered_runs_inline(self):
+        pool = executor.ThreadExecutor(size=1)
+        responses = Responses()
+        pool.submit('logger', OrderedPlugin(), lambda line: line, ('a',), {},
+                    responses.respond)
+        self.assertEqual(responses.results, [('a', True)])
+
+    def test_thread_call(self):
+        pool = executor.ThreadExecutor(size=1)
+        responses = Responses()
+        pool.submit('echo', EchoPlugin(), lambda text: text, (),
+                    {'text': 'a'}, responses.respond)
+        self.assertTrue(responses.done.wait(1))
+        self.assertEqual(responses.results, [('a', False)])
+
+    def test_calls_over_limit_wait(self):
+        pool = executor.ThreadExecutor(size=2)
+        release = threading.Event()
+        responses = Responses()
+        self.assertTrue(pool.submit('slow', LimitedPlugin(), release.wait,
+                                    (0.05,), {}, responses.respond))
+        # over the plugin's limit, runs once the first call returns
+        self.assertTrue(pool.submit('slow', LimitedPlugin(), lambda: 'a',
+                                    (), {}, responses.respond))
+        self.assertEqual(pool.in_flight(), 2)
+        self.assertTrue(responses.wait_for(2))
+        self.assertEqual(responses.results, [(False, False), ('a', False)])
+        self.assertEqual(pool.in_flight(), 0)
+
+    @override_settings(PLUGIN_MAX_WAITING=0)
+    def test_hung_call(self):
+        pool = executor.ThreadExecutor(size=1)
+        release = threading.Event()
+        responses = Responses()
+        self.assertTrue(pool.submit('slow', LimitedPlugin(), release.wait,
+                                    (), {}, responses.respond))
+        # blocks until the first call is found hung, then waits behind it
+        self.assertTrue(pool.submit('slow', LimitedPlugin(), lambda: 'a',
+                                    (), {}, responses.respond))
+        # rejected while every call the plugin may have is hung
+        self.assertFalse(pool.submit('slow', LimitedPlugin(), lambda: 'a',
+                                     (), {}, responses.respond))
+        # the hung worker was replaced, other plugins still get called
+        pool.submit('echo', EchoPlugin(), lambda: 'b', (), {},
+                    responses.respond)
+        self.assertTrue(responses.done.wait(1))
+        self.assertEqual(responses.results, [('b', False)])
+        # the hung call returned, the one waiting takes its slot
+        release.set()
+        self.assertTrue(responses.wait_for(2))
+        self.assertEqual(responses.results, [('b', False), ('a', False)])
+
+
+class CooperativePlugin(object):
+    @decorators.cooperative
+    def fetch(self, line):
+        return line
+    fetch.route_rule = ('messages', ur'^fetch')
+
+
+class MemoPlugin(object):
+    slug = 'memo'
+
+    def __init__(self):
+        self.calls = 0
+
+    @decorators.memoize()
+    def answer(self, line, question):
+        self.calls += 1
+        return u'{0}?'.format(question)
+    answer.route_rule = ('mentions', ur'^ask (?P<question>.*)')
+
+
+class MemoLine(object):
+    def __init__(self, token='token', channel=StubChannel()):
+        self._channel = channel
+        self._active_plugin_state = (token, set(['help', 'memo']))
+        self._active_plugin_slugs = self._active_plugin_state[1]
+
+
+class DecoratorsTestCase(TestCase):
+    def setUp(self):
+        decorators.memo_cache().clear()
+
+    def test_cooperative_survives_binding(self):
+        func = utils.log_on_error(None, CooperativePlugin().fetch)
+        self.assertTrue(func.cooperative)
+        self.assertEqual(func.route_rule[0], 'messages')
+
+    def test_memoize(self):
+        plugin = MemoPlugin()
+        self.assertEqual(plugin.answer(MemoLine(), question=u'why'), u'why?')
+        self.assertEqual(plugin.answer(MemoLine(), question=u' why '),
+                         u'why?')
+        self.assertEqual(plugin.calls, 1)
+        plugin.answer(MemoLine(), question=u'how')
+        self.assertEqual(plugin.calls, 2)
+        self.assertEqual(MemoPlugin.answer.route_rule[0], 'mentions')
+
+    def test_memoize_invalidation(self):
+        plugin = MemoPlugin()
+        plugin.answer(MemoLine(), question=u'why')
+        # the channel's plugin settings changed
+        plugin.answer(MemoLine(token='new'), question=u'why')
+        self.assertEqual(plugin.calls, 2)
+
+    def test_help_without_queries(self):
+        from .core import help
+        plugin = help.Plugin()
+        plugin.slug = 'help'
+        with self.assertNumQueries(0):
+            for _ in range(2):
+                self.assertEqual(
+                    plugin.respond_to_plugin_help(MemoLine(),
+                                                  command=u'nope'),
+                    'Sorry, that plugin is not available.')
+
+
+class FailingPlugin(object):
+    channel_id = 1
+
+    def fail(self, line):
+        raise ValueError(line)
+
+
+class BreakerTestCase(TestCase):
+    def board(self, **kwargs):
+        options = dict(window=60, min_calls=3, error_rate=0.5, slow_call=1,
+                       cooldown=60)
+        options.update(kwargs)
+        return breaker.BreakerBoard(**options)
+
+    def test_opens_on_errors(self):
+        board = self.board()
+        board.record('echo', 1, False, 0)
+        board.record('echo', 1, True, 0)
+        self.assertTrue(board.allow('echo', 1))
+        board.record('echo', 1, True, 0)
+        self.assertFalse(board.allow('echo', 1))
+        # per channel
+        self.assertTrue(board.allow('echo', 2))
+
+    def test_slow_calls_fail(self):
+        board = self.board()
+        for _ in range(3):
+            board.record('echo', 1, False, 2)
+        self.assertFalse(board.allow('echo', 1))
+
+    def test_half_open(self):
+        board = self.board(cooldown=0.05)
+        for _ in range(3):
+            board.record('echo', 1, True, 0)
+        self.assertFalse(board.allow('echo', 1))
+        time.sleep(0.1)
+        # a single probe
+        self.assertTrue(board.allow('echo', 1))
+        self.assertFalse(board.allow('echo', 1))
+        board.record('echo', 1, False, 0)
+        self.assertTrue(board.allow('echo', 1))
+        self.assertTrue(board.allow('echo', 1))
+
+    def test_failed_probe_reopens(self):
+        board = self.board(cooldown=0.05)
+        for _ in range(3):
+            board.record('echo', 1, True, 0)
+        time.sleep(0.1)
+        self.assertTrue(board.allow('echo', 1))
+        board.record('echo', 1, True, 0)
+        self.assertFalse(board.allow('echo', 1))
+
+    def test_executor_skips_calls(self):
+        pool = executor.InlineExecutor(breakers=self.board())
+        plugin = FailingPlugin()
+        responses = Responses()
+        for _ in range(3):
+            self.assertTrue(pool.submit('fail', plugin, plugin.fail, ('a',),
+                                        {}, responses.respond))
+        self.assertFalse(pool.submit('fail', plugin, plugin.fail, ('a',), {},
+                                     responses.respond))
+        self.assertEqual(pool.in_flight(), 0)
+
+
+class BreakerBus(object):
+    """Just enough of StrictRedis for the status of breakers"""
+    def __init__(self):
+        self.statuses = {}
+
+    def hset(self, key, field, value):
+        self.statuses[field] = value
+
+    def hget(self, key, field):
+        return self.statuses.get(field)
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.statuses.pop(field, None)
+
+    def hscan_iter(self, key):
+        return self.statuses.items()
+
+    def eval(self, script, numkeys, key, field, runner):
+        # CLOSE_SCRIPT
+        value = self.statuses.get(field)
+        if value and json.loads(value)['runner'] == runner:
+            del self.statuses[field]
+
+
+class BreakerStatusTestCase(TestCase):
+    def setUp(self):
+        self.bus = BreakerBus()
+        breaker._status_bus = self.bus
+        self.addCleanup(setattr, breaker, '_status_bus', None)
+
+    def board(self, name):
+        return breaker.BreakerBoard(self.bus, window=60, min_calls=2,
+                                    error_rate=0.5, slow_call=1, cooldown=60,
+                                    name=name)
+
+    def open(self, board):
+        for _ in range(2):
+            board.record('echo', 1, True, 0)
+
+    def test_expires_with_the_cooldown(self):
+        self.open(self.board('a'))
+        self.assertEqual(breaker.status('echo', 1)[0], breaker.OPEN)
+        value = json.loads(self.bus.statuses['echo:1'])
+        value['until'] = time.time() - 1
+        self.bus.statuses['echo:1'] = json.dumps(value)
+        self.assertEqual(breaker.status('echo', 1), (breaker.CLOSED, None))
+
+    def test_closing_keeps_other_runners_status(self):
+        self.open(self.board('a'))
+        closed = breaker.Breaker(window=60, min_calls=2, error_rate=0.5,
+                                 slow_call=1, cooldown=60)
+        self.board('b').changed('echo', 1, closed)
+        self.assertEqual(breaker.status('echo', 1)[0], breaker.OPEN)
+        self.board('a').changed('echo', 1, closed)
+        self.assertEqual(breaker.status('echo', 1)[0], breaker.CLOSED)
+
+    def test_clear_on_startup(self):
+        self.open(self.board('a'))
+        board = self.board('b')
+        for slug in ('mine', 'expired'):
+            for _ in range(2):
+                board.record(slug, 1, True, 0)
+        value = json.loads(self.bus.statuses['expired:1'])
+        value['until'] = time.time() - 1
+        self.bus.statuses['expired:1'] = json.dumps(value)
+        # b restarted
+        self.board('b').clear()
+        self.assertEqual(self.bus.statuses.keys(), ['echo:1'])
+
+
+class LaneLine(object):
+    def __init__(self, name, lane):
+        self.name = name
+        self._lane = lane
+
+
+@override_settings(PLUGIN_QUEUE_HIGH_WATERMARK=10,
+                   PLUGIN_QUEUE_CRITICAL_WATERMARK=100)
+class DispatchBatchTestCase(TestCase):
+    def setUp(self):
+        self.app = runner.PluginRunner(executor='inline')
+        self.calls = []
+        self.app.dispatch_line = (
+            lambda line, ordered, essential_only=False:
+            self.calls.append((line.name, ordered, essential_only)))
+        self.lines = [LaneLine('join', runner.FIREHOSE),
+                      LaneLine('hello', runner.MESSAGES),
+                      LaneLine('help', runner.MENTIONS)]
+
+    def test_mentions_first(self):
+        self.app.dispatch_batch(self.lines, depth=0)
+        self.assertEqual(self.calls, [
+            # ordered plugins see the lines as they came
+            ('join', True, False), ('hello', True, False),
+            ('help', True, False),
+            ('help', False, False), ('hello', False, False),
+            ('join', False, False)])
+
+    def test_shedding(self):
+        self.app.dispatch_batch(self.lines, depth=50)
+        self.assertEqual(self.calls[3:], [('help', False, False),
+                                          ('hello', False, False),
+                                          ('join', False, True)])
+        self.calls = []
+        self.app.dispatch_batch(self.lines, depth=500)
+        self.assertEqual(self.calls[3:], [('help', False, False),
+                                          ('hello', False, True),
+                                          ('join', False, True)])
+
+
+class BatchTransport(object):
+    def __init__(self, batches):
+        self.batches = batches
+
+    def next_batch(self):
+        return self.batches.pop(0), 0
+
+    def ack(self):
+        pass
+
+
+class BotBus(object):
+    def __init__(self):
+        self.pushed = []
+
+    def lpush(self, key, *values):
+        self.pushed.extend(values)
+
+
+class LoadTestTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_record_and_read(self):
+        path = os.path.join(self.tmp, 'bus.jsonl.gz')
+        forwarded = []
+        transport = BatchTransport([['{"n": 1}', 'garbage'],
+                                    ['{"n": 2}', '{"n": 3}']])
+        self.assertEqual(loadtest.record(transport, path, count=2,
+                                         forward=forwarded.extend), 3)
+        self.assertEqual(len(forwarded), 4)
+        items = list(loadtest.read_recording(path))
+        self.assertEqual([packet for _, packet in items],
+                         [{'n': 1}, {'n': 2}, {'n': 3}])
+        self.assertEqual(items[0][0], 0)
+
+    def test_synthetic_mix(self):
+        items = list(loadtest.synthetic_packets(
+            u'botbot', [u'#a', u'#b'], 1000, messages=0.5, mentions=0.5))
+        self.assertEqual(len(items), 1000)
+        offsets = [offset for offset, _ in items]
+        self.assertEqual(offsets, sorted(offsets))
+        messages = [packet for _, packet in items
+                    if packet['Command'] == u'PRIVMSG']
+        self.assertTrue(400 < len(messages) < 600)
+        mentions = [packet for packet in messages
+                    if packet['Content'].startswith(u'botbot: ')]
+        self.assertTrue(0.4 < len(mentions) / float(len(messages)) < 0.6)
+        # the same seed makes the same traffic
+        self.assertEqual(items[:10], list(loadtest.synthetic_packets(
+            u'botbot', [u'#a', u'#b'], 10, messages=0.5, mentions=0.5))[:10])
+
+    def test_replay_batches(self):
+        items = [(i * 10.0, {'n': i}) for i in range(7)]
+        transport = loadtest.ReplayTransport(items, speed=0, batch_size=3)
+        sizes = []
+        while not transport.exhausted:
+            sizes.append(len(transport.next_batch()[0]))
+        self.assertEqual(sizes, [3, 3, 1])
+        self.assertEqual(len(transport.due), 7)
+
+    def test_replay(self):
+        channels = [u'#a', u'#b', u'#c']
+        app = loadtest.ReplayRunner(
+            BotBus(), loadtest.ReplayTransport(
+                loadtest.synthetic_packets(u'botbot', channels, 200),
+                speed=0, batch_size=50),
+            loadtest.SyntheticRegistry(u'botbot', channels, ['echo']),
+            executor='inline')
+        app.registry.load()
+        app.register(EchoPlugin())
+        results = app.replay()
+        self.assertEqual(results['lines'], 200)
+        self.assertEqual(results['plugin echo calls'], 200)
+        self.assertLessEqual(results['latency p50 ms'],
+                             results['latency p99 ms'])
+
+    def test_percentile(self):
+        values = range(100)
+        self.assertEqual(loadtest.percentile(values, 0.5), 50)
+        self.assertEqual(loadtest.percentile(values, 0.99), 99)
+        self.assertEqual(loadtest.percentile([], 0.5), 0)
+
+
+class StreamStub(object):
+    """Hands out one batch of packets with entry ids"""
+    batch_size = 2
+
+    def __init__(self, items):
+        self.items = items
+        self.entry_ids = []
+        self.acked = []
+
+    def next_batch(self, block=True):
+        self.entry_ids = [entry_id for entry_id, _ in self.items]
+        packets = [packet for _, packet in self.items]
+        self.items = []
+        return packets, 0
+
+    def ack(self, ids=None):
+        self.acked.append(list(ids))
+
+
+class AckTestCase(TestCase):
+    def setUp(self):
+        self.app = runner.PluginRunner(executor='inline')
+        self.app.registry = loadtest.SyntheticRegistry(u'botbot', [u'#a'],
+                                                       ['echo'])
+        self.app.registry.load()
+        self.app.register(EchoPlugin())
+        packets = [codec.encode(packet, 'json') for _, packet in
+                   loadtest.synthetic_packets(u'botbot', [u'#a'], 4)]
+        self.app.transport = StreamStub([('1-0', packets[0]),
+                                         ('2-0', 'garbage'),
+                                         ('3-0', packets[1]),
+                                         ('4-0', packets[2]),
+                                         ('5-0', packets[3])])
+
+    def test_only_dispatched_lines_are_acked(self):
+        self.app.listen_once()
+        # the garbage right away, the two lines dispatched, not the rest
+        self.assertEqual(self.app.transport.acked, [['2-0', '1-0', '3-0']])
+        self.assertEqual(self.app.scheduler.pending, 2)
+        self.app.listen_once()
+        self.assertEqual(self.app.transport.acked[1], ['4-0', '5-0'])
+
+
+class RecordingPlugin(EchoPlugin):
+    seen = []
+
+    def everything(self, line):
+        self.seen.append(line.text)
+    everything.route_rule = ('firehose', ur'(.*)')
+
+
+class BacklogTransport(object):
+    """A list queue with a backlog, read a batch at a time"""
+    entry_ids = None
+
+    def __init__(self, packets, batch_size):
+        self.packets = packets
+        self.batch_size = batch_size
+
+    def next_batch(self, block=True):
+        batch = self.packets[:self.batch_size]
+        del self.packets[:self.batch_size]
+        return batch, len(self.packets)
+
+    def ack(self, ids=None):
+        pass
+
+
+class FairDispatchTestCase(TestCase):
+    @override_settings(PLUGIN_FAIR_MAX_PENDING=1000)
+    def test_backlog_does_not_delay_other_channels(self):
+        app = runner.PluginRunner(executor='inline')
+        app.registry = loadtest.SyntheticRegistry(u'botbot',
+                                                  [u'#flood', u'#quiet'],
+                                                  ['echo'])
+        app.registry.load()
+        app.register(RecordingPlugin())
+        app.scheduler = scheduler.FairScheduler(quantum=5)
+        packets = []
+        for i, (_, packet) in enumerate(loadtest.synthetic_packets(
+                u'botbot', [u'#flood'], 500, messages=1, mentions=0)):
+            packet['Content'] = u'flood {0}'.format(i)
+            packets.append(codec.encode(packet, 'json'))
+        packet['Channel'] = u'#quiet'
+        packet['Content'] = u'quiet'
+        packets.append(codec.encode(packet, 'json'))
+        app.transport = BacklogTransport(packets, batch_size=10)
+        RecordingPlugin.seen = []
+        app.listen_once()
+        # behind 500 lines in the queue, out in the first batch
+        self.assertEqual(RecordingPlugin.seen,
+                         [u'flood {0}'.format(i) for i in range(5)] +
+                         [u'quiet'] +
+                         [u'flood {0}'.format(i) for i in range(5, 9)])
+        self.assertEqual(app.scheduler.pending, 491)
+
+
+class FailingRecordingPlugin(RecordingPlugin):
+    def everything(self, line):
+        super(FailingRecordingPlugin, self).everything(line)
+        raise ValueError(line.text)
+    everything.route_rule = ('firehose', ur'(.*)')
+
+
+class CheckpointBus(object):
+    """Just enough of StrictRedis for backfill checkpoints"""
+    def __init__(self):
+        self.hashes = {}
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(str(field))
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[str(field)] = str(value)
+
+    def hsetnx(self, key, field, value):
+        if self.hget(key, field) is None:
+            self.hset(key, field, value)
+
+
+class BackfillTestCase(TestCase):
+    def setUp(self):
+        self.chatbot = ChatBot.objects.create(server='testserver',
+                                              nick='botbot')
+        self.channel = Channel.objects.create(chatbot=self.chatbot,
+                                              name='#test', slug='test')
+        plugin = Plugin.objects.create(name='Echo', slug='echo')
+        ActivePlugin.objects.create(plugin=plugin, channel=self.channel)
+        start = datetime.datetime(2015, 1, 1, tzinfo=utc)
+        for i in range(7):
+            # two lines a second, so batches end mid-second
+            Log.objects.create(
+                channel=self.channel, bot=self.chatbot, command='PRIVMSG',
+                nick='nick', text=u'echo {0}'.format(i),
+                timestamp=start + datetime.timedelta(seconds=i // 2))
+        RecordingPlugin.seen = []
+        self.app = backfill.BackfillRunner(['echo'], executor='inline')
+        self.app.register(RecordingPlugin())
+        self.bus = CheckpointBus()
+        self.backfill = backfill.Backfill(self.app, 'echo', self.bus,
+                                          batch_size=3)
+        self.until = datetime.datetime(2016, 1, 1, tzinfo=utc)
+
+    def test_replays_in_order_without_replies(self):
+        self.assertEqual(self.backfill.run(self.channel.pk, self.until), 7)
+        self.assertEqual(RecordingPlugin.seen,
+                         [u'echo {0}'.format(i) for i in range(7)])
+        self.assertEqual(self.app.dropped_replies, 7)
+        self.assertEqual(self.app.outbox, [])
+        self.assertEqual(self.backfill.position(self.channel.pk),
+                         backfill.DONE)
+
+    def test_batches_resume_after_position(self):
+        batches = list(self.backfill.batches(self.channel, None, self.until))
+        self.assertEqual([len(rows) for rows in batches], [3, 3, 1])
+        last = batches[0][-1]
+        self.backfill.save_position(self.channel.pk, (last[1], last[0]))
+        self.assertEqual(self.backfill.run(self.channel.pk, self.until), 4)
+        self.assertEqual(RecordingPlugin.seen,
+                         [u'echo {0}'.format(i) for i in range(3, 7)])
+        # a finished channel isn't replayed again
+        self.assertEqual(self.backfill.run(self.channel.pk, self.until), 0)
+
+    @override_settings(PLUGIN_BREAKER_MIN_CALLS=2)
+    def test_failing_plugin_gets_every_line(self):
+        app = backfill.BackfillRunner(['echo'], executor='inline')
+        app.register(FailingRecordingPlugin())
+        self.backfill.runner = app
+        self.assertEqual(self.backfill.run(self.channel.pk, self.until), 7)
+        self.assertEqual(RecordingPlugin.seen,
+                         [u'echo {0}'.format(i) for i in range(7)])
+        self.assertEqual(self.backfill.position(self.channel.pk),
+                         backfill.DONE)
+
+    def test_rejected_calls_are_retried(self):
+        pool = self.app.executor
+        submit = pool.submit
+
+        def hung_on_4(slug, plugin, func, args, kwargs, callback):
+            if args[0].text == u'echo 4':
+                pool.rejected += 1
+                return False
+            return submit(slug, plugin, func, args, kwargs, callback)
+        pool.submit = hung_on_4
+        self.assertIsNone(self.backfill.run(self.channel.pk, self.until))
+        # not checkpointed past the batch of the rejected call
+        self.assertEqual(self.backfill.position(self.channel.pk)[1],
+                         Log.objects.get(text=u'echo 2').pk)
+
+    def test_until_is_kept(self):
+        self.assertEqual(self.backfill.until(self.until), self.until)
+        later = self.until + datetime.timedelta(days=1)
+        self.assertEqual(self.backfill.until(later), self.until)
+        start = datetime.datetime(2015, 1, 1, 0, 0, 2, tzinfo=utc)
+        self.assertEqual(self.backfill.run(self.channel.pk, start), 4)
+
+
+class ChannelLine(object):
+    def __init__(self, channel, text):
+        self._chatbot_id = 1
+        self._channel_name = channel
+        self.text = text
+
+
+class FairSchedulerTestCase(TestCase):
+    def test_round_robin(self):
+        fair = scheduler.FairScheduler(quantum=2)
+        for i in range(6):
+            fair.add(ChannelLine('#flood', i))
+        fair.add(ChannelLine('#quiet', 'a'))
+        taken = [(line._channel_name, line.text) for line in fair.take(10)]
+        self.assertEqual(taken, [('#flood', 0), ('#flood', 1),
+                                 ('#quiet', 'a'),
+                                 ('#flood', 2), ('#flood', 3),
+                                 ('#flood', 4), ('#flood', 5)])
+        self.assertEqual(fair.pending, 0)
+
+    def test_turn_carries_over(self):
+        fair = scheduler.FairScheduler(quantum=2)
+        for i in range(3):
+            fair.add(ChannelLine('#flood', i))
+        fair.add(ChannelLine('#quiet', 'a'))
+        self.assertEqual([line.text for line in fair.take(1)], [0])
+        # the rest of #flood's turn, then #quiet's
+        self.assertEqual([line.text for line in fair.take(2)], [1, 'a'])
+        self.assertEqual(fair.pending, 1)
+
+    def test_quantum_is_validated(self):
+        with self.assertRaises(ValueError):
+            scheduler.FairScheduler(quantum=0)
+
+
+class MemoryStorage(object):
+    """Just enough of StrictRedis for plugin storage"""
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+
+    def set(self, key, value, ex=None):
+        self.round_trips += 1
+        self.data[key] = str(value)
+
+    def get(self, key):
+        self.round_trips += 1
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self.round_trips += 1
+        return [self.data.get(key) for key in keys]
+
+    def incr(self, key, amount=1):
+        self.round_trips += 1
+        self.data[key] = str(int(self.data.get(key, 0)) + amount)
+        return int(self.data[key])
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def register_script(self, script):
+        return None
+
+
+class MemoryPipeline(object):
+    def __init__(self, storage):
+        self.storage = storage
+        self.commands = []
+
+    def set(self, key, value, ex=None):
+        self.commands.append((key, value))
+
+    def execute(self):
+        self.storage.round_trips += 1
+        for key, value in self.commands:
+            self.storage.data[key] = str(value)
+
+
+class StorageTestCase(TestCase):
+    def setUp(self):
+        self.app = runner.PluginRunner(executor='inline')
+        self.app.storage = MemoryStorage()
+        self.app.storage_layout = storage.KeyLayout(self.app.storage)
+        self.plugin = self.app.setup_plugin_for_channel(EchoPlugin,
+                                                        StubLine())
+
+    def test_writes_are_pipelined(self):
+        self.plugin.store('a', 1)
+        self.plugin.store_many({'b': 2, 'c': u'\xe9'.encode('utf-8')})
+        self.assertEqual(self.app.storage.round_trips, 0)
+        # reads see the batch's writes
+        self.assertEqual(self.plugin.retrieve_many(['a', 'c', 'd']),
+                         {'a': u'1', 'c': u'\xe9', 'd': None})
+        self.assertEqual(self.app.storage.round_trips, 2)
+
+    def test_writes_off_the_dispatch_thread(self):
+        app = runner.PluginRunner(executor='thread')
+        app.storage = MemoryStorage()
+        app.storage_layout = storage.KeyLayout(app.storage)
+        plugin = app.setup_plugin_for_channel(EchoPlugin, StubLine())
+        responses = Responses()
+
+        def call():
+            plugin.store('a', 1)
+            plugin.store('b', 2)
+        app.executor.submit('echo', plugin, call, (), {}, responses.respond)
+        self.assertTrue(responses.done.wait(1))
+        # sent in one go when the call returned
+        self.assertEqual(app.storage.round_trips, 1)
+        self.assertEqual(sorted(app.storage.data.values()), ['1', '2'])
+
+    def test_incr(self):
+        self.assertEqual(self.plugin.incr('karma'), 1)
+        self.assertEqual(self.plugin.incr('karma', 2), 3)
+        self.assertEqual(self.plugin.retrieve('karma'), u'3')
+
+
+class HashLayoutTestCase(TestCase):
+    def test_parse_key(self):
+        self.assertEqual(migrate_plugin_storage.parse_key(u'1:2:karma:a:b'),
+                         ((1, 2, u'karma'), u'a:b'))
+        self.assertIsNone(migrate_plugin_storage.parse_key(u'q:shards'))
+        self.assertIsNone(
+            migrate_plugin_storage.parse_key(u'plugins:1:2:karma'))
+
+    def test_namespace_keys(self):
+        layout = storage.HashLayout(MemoryStorage(), max_fields=0,
+                                    namespace_ttl=0)
+        self.assertEqual(layout.keys((1, 2, u'karma')),
+                         [u'plugins:1:2:karma', u'plugins:1:2:karma:ttl'])
+
+
+# Redis the storage scripts are tested against, its database is left alone
+# but for the keys of chatbot 0
+TEST_REDIS_URL = os.environ.get('BOTBOT_TEST_REDIS_URL',
+                                'redis://localhost:6379/15')
+
+
+class RedisHashLayoutTestCase(TestCase):
+    namespace = (0, 1, u'karma')
+
+    def setUp(self):
+        self.connection = redis.StrictRedis.from_url(TEST_REDIS_URL)
+        try:
+            self.connection.ping()
+        except redis.ConnectionError:
+            self.skipTest('no Redis at {0}'.format(TEST_REDIS_URL))
+        self.layout = self.hash_layout()
+        self.name, self.expiries = self.layout.keys(self.namespace)
+        self.clean()
+        self.addCleanup(self.clean)
+
+    def clean(self):
+        self.connection.delete(self.name, self.expiries)
+
+    def hash_layout(self, max_fields=0, namespace_ttl=0):
+        return storage.HashLayout(self.connection, max_fields=max_fields,
+                                  namespace_ttl=namespace_ttl)
+
+    def expire(self, key):
+        """Makes a value stored with a ttl expired"""
+        self.connection.zadd(self.expiries, time.time() - 1, key)
+
+    def test_set_and_get(self):
+        self.layout.set_many(self.connection, self.namespace,
+                             {'a': 1, ' b ': u'\xe9'.encode('utf-8')})
+        self.assertEqual(self.layout.get_many(self.namespace, ['a', 'b', 'c']),
+                         ['1', u'\xe9'.encode('utf-8'), None])
+        self.assertTrue(self.layout.delete(self.namespace, 'a'))
+        self.assertFalse(self.layout.delete(self.namespace, 'a'))
+
+    def test_ttl_masks_expired_values(self):
+        self.layout.set_many(self.connection, self.namespace,
+                             {'a': 1, 'b': 2}, ttl=60)
+        self.assertEqual(self.connection.zcard(self.expiries), 2)
+        self.expire('a')
+        self.assertEqual(self.layout.get_many(self.namespace, ['a', 'b']),
+                         [None, '2'])
+        # still there until the next write cleans it up
+        self.assertTrue(self.connection.hexists(self.name, 'a'))
+        self.layout.set_many(self.connection, self.namespace, {'c': 3})
+        self.assertFalse(self.connection.hexists(self.name, 'a'))
+        self.assertEqual(self.connection.zrange(self.expiries, 0, -1), ['b'])
+        # stored without a ttl, it doesn't expire anymore
+        self.layout.set_many(self.connection, self.namespace, {'b': 4})
+        self.assertEqual(self.connection.zcard(self.expiries), 0)
+
+    def test_incr(self):
+        self.assertEqual(self.layout.incr(self.namespace, 'k'), 1)
+        self.assertEqual(self.layout.incr(self.namespace, 'k', 2, ttl=60), 3)
+        self.expire('k')
+        # an expired counter starts over
+        self.assertEqual(self.layout.incr(self.namespace, 'k', ttl=60), 1)
+        self.assertEqual(self.layout.get_many(self.namespace, ['k']), ['1'])
+
+    def test_cap_evicts_closest_to_expiring_first(self):
+        layout = self.hash_layout(max_fields=3)
+        layout.set_many(self.connection, self.namespace, {'late': 1}, ttl=600)
+        layout.set_many(self.connection, self.namespace, {'soon': 1}, ttl=60)
+        layout.set_many(self.connection, self.namespace, {'a': 1, 'b': 1})
+        self.assertEqual(sorted(self.connection.hkeys(self.name)),
+                         ['a', 'b', 'late'])
+        layout.set_many(self.connection, self.namespace, {'c': 1})
+        self.assertEqual(sorted(self.connection.hkeys(self.name)),
+                         ['a', 'b', 'c'])
+        # then any value but the ones written
+        layout.set_many(self.connection, self.namespace, {'d': 1, 'e': 1})
+        keys = self.connection.hkeys(self.name)
+        self.assertEqual(len(keys), 3)
+        self.assertTrue(set(['d', 'e']) <= set(keys))
+
+    def test_namespace_ttl(self):
+        layout = self.hash_layout(namespace_ttl=600)
+        layout.set_many(self.connection, self.namespace, {'a': 1}, ttl=60)
+        self.assertGreater(self.connection.ttl(self.name), 0)
+        self.assertGreater(self.connection.ttl(self.expiries), 0)
+
+    def test_import_many_keeps_existing_values(self):
+        self.layout.set_many(self.connection, self.namespace, {'a': 'new'})
+        pipe = self.connection.pipeline(transaction=False)
+        self.layout.import_many(pipe, self.namespace,
+                                [('a', 'old', None), ('b', 'old', 60)])
+        pipe.execute()
+        self.assertEqual(self.layout.get_many(self.namespace, ['a', 'b']),
+                         ['new', 'old'])
+        self.assertEqual(self.connection.zrange(self.expiries, 0, -1), ['b'])
+
+    def test_memory(self):
+        from . import benchmarks
+        with self.settings(REDIS_PLUGIN_STORAGE_URL=TEST_REDIS_URL):
+            results = benchmarks.bench_storage_memory(iterations=20)
+        self.assertLess(results['hash bytes'], results['keys bytes'])
+
+
+class RegistryTestCase(TestCase):
+    def setUp(self):
+        self.chatbot = ChatBot.objects.create(server='testserver',
+                                              nick='botbot')
+        self.channel = Channel.objects.create(chatbot=self.chatbot,
+                                              name='#test', slug='test')
+        self.plugin = Plugin.objects.create(name='Logger', slug='logger')
+        ActivePlugin.objects.create(plugin=self.plugin, channel=self.channel,
+                                    configuration={'ignore_prefix': '!'})
+        self.registry = registry.Registry()
+        self.registry.load()
+
+    def test_lookups_are_free(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.registry.chatbot(self.chatbot.pk),
+                             self.chatbot)
+            channel = self.registry.channel(self.chatbot.pk, '#test')
+            self.assertEqual(channel, self.channel)
+            self.assertEqual(channel.chatbot.nick, 'botbot')
+            _, slugs = self.registry.active_plugin_state(channel.pk)
+            self.assertEqual(slugs, set(['logger']))
+            self.assertEqual(
+                self.registry.plugin_config(channel.pk, 'logger'),
+                {'ignore_prefix': '!'})
+
+    def test_misses_are_cached(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.registry.channel(self.chatbot.pk, '#nope'))
+            self.assertIsNone(self.registry.channel(self.chatbot.pk, '#nope'))
+
+    def test_new_channel_is_found(self):
+        channel = Channel.objects.create(chatbot=self.chatbot, name='#new',
+                                         slug='new')
+        self.assertEqual(self.registry.channel(self.chatbot.pk, '#new'),
+                         channel)
+
+    def test_invalidation_changes_token(self):
+        token, _ = self.registry.active_plugin_state(self.channel.pk)
+        ActivePlugin.objects.all().delete()
+        self.registry.invalidate('channel:{0}'.format(self.channel.pk))
+        new_token, slugs = self.registry.active_plugin_state(self.channel.pk)
+        self.assertNotEqual(token, new_token)
+        self.assertEqual(slugs, set())
+
+    def test_delete_publishes_invalidation(self):
+        published = []
+        self.addCleanup(setattr, models, 'publish_invalidation',
+                        models.publish_invalidation)
+        models.publish_invalidation = lambda kind, pk: published.append(
+            '{0}:{1}'.format(kind, pk))
+        ActivePlugin.objects.filter(channel=self.channel).delete()
+        self.assertEqual(published, ['channel:{0}'.format(self.channel.pk)])
+        for message in published:
+            self.registry.invalidate(message)
+        _, slugs = self.registry.active_plugin_state(self.channel.pk)
+        self.assertEqual(slugs, set())
+
+    def test_invalidations_wait_for_the_request(self):
+        sent = []
+        self.addCleanup(setattr, utils, 'send_invalidations',
+                        utils.send_invalidations)
+        utils.send_invalidations = sent.extend
+        # what the request_started and request_finished signals call
+        utils.start_request()
+        self.channel.save()
+        ActivePlugin.objects.filter(channel=self.channel).delete()
+        self.assertEqual(sent, [])
+        utils.finish_request()
+        self.assertEqual(sent, ['channel:{0}'.format(self.channel.pk)])
+        # outside of a request
+        self.chatbot.save()
+        self.assertEqual(sent[1:], ['chatbot:{0}'.format(self.chatbot.pk)])
+
+    def test_invalidation_of_renamed_channel(self):
+        Channel.objects.filter(pk=self.channel.pk).update(name='#renamed')
+        self.registry.invalidate('channel:{0}'.format(self.channel.pk))
+        self.assertEqual(self.registry.channel(self.chatbot.pk, '#renamed'),
+                         self.channel)
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.registry.channel(self.chatbot.pk, '#test'))
+
+
+class OccupancyBus(object):
+    """Just enough of StrictRedis for the occupancy plugin"""
+    def __init__(self):
+        self.hashes = {}
+        self.sets = {}
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[str(field)] = value
+
+    def hdel(self, key, field):
+        self.hashes.get(key, {}).pop(str(field), None)
+
+    def smembers(self, key):
+        return self.sets.get(key, set())
+
+    def sadd(self, key, *values):
+        self.sets.setdefault(key, set()).update(values)
+
+    def delete(self, key):
+        self.sets.pop(key, None)
+
+    def expire(self, key, seconds):
+        pass
+
+
+class IrcLine(object):
+    _chatbot = ChatBot(nick='botbot')
+
+    def __init__(self, command, user=u'', text=u'', raw=None):
+        self._command = command
+        self._channel = StubChannel()
+        self.user = user
+        self.text = text
+        self._raw = raw
+
+
+class OccupancyTestCase(TestCase):
+    def setUp(self):
+        self.bus = OccupancyBus()
+        self.occupancy = self.tracker()
+
+    def tracker(self):
+        tracker = occupancy.Occupancy()
+        tracker.connection = self.bus
+        return tracker
+
+    def see(self, *lines):
+        for line in lines:
+            self.occupancy.see(line)
+
+    def published(self):
+        value = self.bus.hashes[utils.OCCUPANCY_KEY].get('1')
+        return value and int(value.split()[0])
+
+    def test_follows_the_channel(self):
+        self.see(IrcLine(u'JOIN', u'botbot'),
+                 IrcLine(u'353', text=u'@botbot +Alice bob'),
+                 IrcLine(u'353', text=u'carol'),
+                 IrcLine(u'366'))
+        self.assertEqual(self.occupancy.members[1],
+                         set([u'botbot', u'alice', u'bob', u'carol']))
+        self.see(IrcLine(u'JOIN', u'dave'),
+                 IrcLine(u'PART', u'bob'),
+                 IrcLine(u'NICK', u'Carol', u'carol_'),
+                 IrcLine(u'KICK', u'botbot', u'spam',
+                         u':botbot!b@h KICK #test dave :spam'),
+                 IrcLine(u'PRIVMSG', u'alice', u'hello'))
+        self.assertEqual(self.occupancy.members[1],
+                         set([u'botbot', u'alice', u'carol_']))
+        self.occupancy.flush()
+        self.assertEqual(self.published(), 3)
+
+    def test_restart_restores_nicks(self):
+        self.see(IrcLine(u'JOIN', u'botbot'),
+                 IrcLine(u'353', text=u'botbot alice'),
+                 IrcLine(u'366'))
+        self.occupancy.flush(force=True)
+        self.occupancy = self.tracker()
+        self.see(IrcLine(u'JOIN', u'bob'))
+        self.assertEqual(self.occupancy.members[1],
+                         set([u'botbot', u'alice', u'bob']))
+
+    def test_not_counted_without_names(self):
+        self.see(IrcLine(u'JOIN', u'alice'))
+        self.assertNotIn(1, self.occupancy.members)
+
+    def test_bot_leaving_stops_counting(self):
+        self.see(IrcLine(u'JOIN', u'botbot'),
+                 IrcLine(u'353', text=u'botbot alice'),
+                 IrcLine(u'366'))
+        self.occupancy.flush()
+        self.see(IrcLine(u'PART', u'botbot'))
+        self.occupancy.flush()
+        self.assertIsNone(self.published())
+        self.assertEqual(self.bus.sets, {})
+
+
+@override_settings(LOGGER_BATCH_SIZE=100)
+class LogBufferTestCase(TestCase):
+    def setUp(self):
+        self.chatbot = ChatBot.objects.create(server='testserver',
+                                              nick='botbot')
+        self.channel = Channel.objects.create(chatbot=self.chatbot,
+                                              name='#test', slug='test')
+
+    def log(self, nick, text):
+        return Log(bot=self.chatbot, channel=self.channel, nick=nick,
+                   text=text, command='PRIVMSG',
+                   timestamp=datetime.datetime(2015, 1, 1, tzinfo=utc))
+
+    def test_batch(self):
+        buf = logger.LogBuffer()
+        buf.add(self.log(u'a', u'one'))
+        buf.add(self.log(u'b', u'two'))
+        buf.flush()
+        self.assertEqual(list(Log.objects.order_by('id').values_list(
+            'text', flat=True)), [u'one', u'two'])
+
+    def test_bad_line_only_loses_itself(self):
+        buf = logger.LogBuffer()
+        buf.add(self.log(u'a', u'one'))
+        # too long for the column, the batch's INSERT fails
+        buf.add(self.log(u'a' * 300, u'two'))
+        buf.add(self.log(u'b', u'three'))
+        buf.flush()
+        self.assertEqual(list(Log.objects.order_by('id').values_list(
+            'text', flat=True)), [u'one', u'three'])
+        self.assertEqual(buf.logs, [])
+
+
+class UserCountTestCase(TestCase):
+    def setUp(self):
+        self.chatbot = ChatBot.objects.create(server='testserver',
+                                              nick='botbot')
+        self.channel = Channel.objects.create(chatbot=self.chatbot,
+                                              name='#test', slug='test')
+
+    def test_save_counts(self):
+        when = datetime.datetime(2015, 1, 1, 3, 30)
+        occupancy.save_counts({self.channel.pk: 5}, when)
+        occupancy.save_counts({self.channel.pk: 6},
+                              when + datetime.timedelta(hours=1))
+        counts = UserCount.objects.get(channel=self.channel).counts
+        self.assertEqual(len(counts), 24)
+        self.assertEqual(counts[3:5], [5, 6])
+        self.assertIsNone(counts[0])
+
+    def test_one_count_per_day(self):
+        today = datetime.date.today()
+        UserCount.objects.create(channel=self.channel, dt=today, counts=[])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UserCount.objects.create(channel=self.channel, dt=today,
+                                     counts=[])
+        occupancy.save_counts({self.channel.pk: 3}, datetime.datetime.now())
+        self.assertEqual(
+            UserCount.objects.filter(channel=self.channel).count(), 1)
+
+    @override_settings(REDIS_PLUGIN_STORAGE_URL=None)
+    def test_current_size_of_the_hour(self):
+        self.assertIsNone(self.channel.current_size())
+        occupancy.save_counts({self.channel.pk: 7}, datetime.datetime.now())
+        self.assertEqual(self.channel.current_size(), 7)
+
+
+class InvalidationLog(object):
+    def __init__(self, messages=()):
+        self.messages = list(messages)
+
+    def zrangebyscore(self, key, low, high):
+        return self.messages
+
+
+class SnapshotTestCase(TestCase):
+    def setUp(self):
+        self.chatbot = ChatBot.objects.create(server='testserver',
+                                              nick='botbot')
+        self.channel = Channel.objects.create(chatbot=self.chatbot,
+                                              name='#test', slug='test')
+        self.other = Channel.objects.create(chatbot=self.chatbot,
+                                            name='#other', slug='other')
+        self.plugin = Plugin.objects.create(name='Echo', slug='echo')
+        for channel in (self.channel, self.other):
+            ActivePlugin.objects.create(plugin=self.plugin, channel=channel)
+        self.app = self.runner()
+        self.app.registry.load()
+        self.app.warm_up([self.channel.pk])
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'snapshot')
+        snapshot.save(self.app, self.path)
+
+    def runner(self, invalidations=()):
+        app = runner.PluginRunner(executor='inline')
+        app.bot_bus = InvalidationLog(invalidations)
+        app.register(EchoPlugin())
+        return app
+
+    def test_warm_restart(self):
+        app = self.runner()
+        with self.assertNumQueries(2):
+            self.assertTrue(snapshot.restore(app, self.path))
+        self.assertEqual(list(app.plans), [self.channel.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(app.registry.channel(self.chatbot.pk, '#other'),
+                             self.other)
+            self.assertEqual(
+                app.registry.active_plugin_state(self.other.pk)[1],
+                set(['echo']))
+
+    def test_changes_are_caught_up(self):
+        # no invalidation for an update, the fingerprint tells
+        Channel.objects.filter(pk=self.channel.pk).update(
+            name='#renamed', fingerprint='changed')
+        # an invalidation published while no runner was listening
+        ActivePlugin.objects.filter(channel=self.other).delete()
+        app = self.runner(['channel:{0}'.format(self.other.pk)])
+        self.assertTrue(snapshot.restore(app, self.path))
+        self.assertEqual(app.registry.channel(self.chatbot.pk, '#renamed'),
+                         self.channel)
+        self.assertEqual(app.registry.active_plugin_state(self.other.pk)[1],
+                         set())
+
+    @override_settings(PLUGIN_SNAPSHOT_MAX_AGE=0)
+    def test_old_snapshot_is_ignored(self):
+        app = self.runner()
+        app.start_registry(self.path)
+        self.assertEqual(app.plans, {})
+        self.assertEqual(app.registry.channel(self.chatbot.pk, '#test'),
+                         self.channel)
+
+    def test_shutdown_saves_a_snapshot(self):
+        path = os.path.join(self.tmp, 'next')
+        self.app.snapshot_path = path
+        self.app.save_snapshot()
+        self.assertTrue(snapshot.restore(self.runner(), path))
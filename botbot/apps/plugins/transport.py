@@ -0,0 +1,317 @@
+import logging
+import os
+import socket
+import time
+
+import redis
+from django.conf import settings
+from django_statsd.clients import statsd
+
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+# The list the bot pushes incoming packets onto
+QUEUE = 'q'
+
+# Pops up to ARGV[1] packets off the head of the queue in a single round
+# trip and reports how many are left behind.
+DRAIN_SCRIPT = """
+local packets = {}
+local count = tonumber(ARGV[1])
+if count > 0 then
+    packets = redis.call('LRANGE', KEYS[1], 0, count - 1)
+    if #packets > 0 then
+        redis.call('LTRIM', KEYS[1], #packets, -1)
+    end
+end
+return {packets, redis.call('LLEN', KEYS[1])}
+"""
+
+# Takes or renews the lease KEYS[1] for consumer ARGV[1], for ARGV[2] ms.
+# Returns 1 when the consumer holds it.
+LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2], 'NX') then
+    return 1
+end
+return 0
+"""
+
+
+class ListTransport(object):
+    """
+    The plugin bus as a plain Redis list, consumed in batches.
+
+    This is the default: the bot RPUSHes packets and reads are destructive,
+    so a runner that crashes mid-batch loses the rest of that batch.
+    """
+
+    def __init__(self, connection, queue=QUEUE, batch_size=None,
+                 batch_latency=None):
+        self.connection = connection
+        self.queue = queue
+        self.drain = connection.register_script(DRAIN_SCRIPT)
+        # max packets pulled off the queue per round trip
+        self.batch_size = batch_size or settings.PLUGIN_BATCH_SIZE
+        if self.batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        # ms to let a batch fill up after waking from an empty queue
+        if batch_latency is None:
+            batch_latency = settings.PLUGIN_BATCH_LATENCY
+        self.batch_latency = batch_latency
+
+    def next_batch(self, block=True):
+        """
+        Returns a list of raw packets and the remaining queue depth.
+
+        Drains up to ``batch_size`` packets per round trip and only falls
+        back to a blocking pop when the queue is empty (and ``block``).
+        """
+        packets, depth = self.drain(keys=[self.queue], args=[self.batch_size])
+        if packets or not block:
+            return packets, depth
+
+        val = self.connection.blpop(self.queue, 1)
+        if not val:
+            return [], 0
+        if self.batch_size == 1:
+            return [val[1]], self.connection.llen(self.queue)
+        if self.batch_latency:
+            time.sleep(self.batch_latency / 1000.0)
+        # Pick up whatever arrived in the meantime, this also samples the
+        # queue depth for the batch.
+        more, depth = self.drain(keys=[self.queue],
+                                 args=[self.batch_size - 1])
+        return [val[1]] + more, depth
+
+    # lists have no entry ids, see StreamTransport.entry_ids
+    entry_ids = None
+
+    def ack(self, ids=None):
+        """Lines are removed from the list as they are read"""
+
+
+class StreamTransport(object):
+    """
+    The plugin bus as a Redis Stream read through a consumer group.
+
+    The bot XADDs packets to ``<queue>:stream`` with the JSON packet in a
+    ``packet`` field. Entries are only acknowledged once their lines have
+    been dispatched (see ``entry_ids``), so a runner that dies mid-batch
+    loses nothing.
+
+    A group has a single consumer at a time: entries split between
+    consumers would reach a channel's plugins out of order, and the
+    logger and occupancy plugins need every line of a channel. Consumers
+    take a lease on the group, renewed as they read, and the others
+    stand by until it expires, ``PLUGIN_STREAM_CLAIM_IDLE`` ms after its
+    holder stopped. The consumer that takes over claims the entries its
+    predecessor left pending, and dispatches them before new ones. To
+    spread the load use a sharded runner (see shards.py), its dispatcher
+    is the group's consumer.
+    """
+    field = 'packet'
+
+    def __init__(self, connection, queue=QUEUE, batch_size=None,
+                 batch_latency=None, group=None, consumer=None):
+        self.connection = connection
+        self.stream = '{0}:stream'.format(queue)
+        self.group = group or settings.PLUGIN_STREAM_GROUP
+        self.lease = '{0}:{1}:consumer'.format(self.stream, self.group)
+        self.consumer = consumer or '{0}:{1}'.format(socket.gethostname(),
+                                                     os.getpid())
+        self.batch_size = batch_size or settings.PLUGIN_BATCH_SIZE
+        if batch_latency is None:
+            batch_latency = settings.PLUGIN_BATCH_LATENCY
+        self.batch_latency = batch_latency
+        self.maxlen = settings.PLUGIN_STREAM_MAXLEN
+        self.lease_ttl = settings.PLUGIN_STREAM_CLAIM_IDLE
+        # ids of the packets the last next_batch returned, in order
+        self.entry_ids = []
+        # ids handed out and not acknowledged yet
+        self.outstanding = set()
+        # ids to acknowledge with the next ack, e.g. trimmed entries
+        self.unacked = []
+        self.leased = False
+        # time the lease is due for renewal
+        self.renew_at = 0
+        # whether entries left by a previous consumer may remain
+        self.reclaiming = False
+        self.batches = 0
+        self.create_group()
+
+    def create_group(self):
+        try:
+            self.connection.execute_command(
+                'XGROUP', 'CREATE', self.stream, self.group, '0', 'MKSTREAM')
+        except redis.ResponseError as exc:
+            # BUSYGROUP, another runner got there first
+            if 'BUSYGROUP' not in str(exc):
+                raise
+
+    def _packets(self, entries):
+        """Keeps track of the ids and returns the packet payloads"""
+        packets = []
+        for entry_id, fields in entries or []:
+            # Entries trimmed while pending come back without fields
+            if not fields:
+                self.unacked.append(entry_id)
+                continue
+            fields = dict(zip(fields[::2], fields[1::2]))
+            packets.append(fields[self.field])
+            self.entry_ids.append(entry_id)
+            self.outstanding.add(entry_id)
+        return packets
+
+    def _read(self, count, block=None):
+        args = ['XREADGROUP', 'GROUP', self.group, self.consumer,
+                'COUNT', count]
+        if block is not None:
+            args.extend(['BLOCK', block])
+        args.extend(['STREAMS', self.stream, '>'])
+        reply = self.connection.execute_command(*args)
+        if not reply:
+            return []
+        return self._packets(reply[0][1])
+
+    def hold_lease(self):
+        """Takes or renews the group's lease, returns whether it's held"""
+        now = time.time()
+        if self.leased and now < self.renew_at:
+            return True
+        held = self.connection.execute_command(
+            'EVAL', LEASE_SCRIPT, 1, self.lease, self.consumer,
+            self.lease_ttl)
+        if not held:
+            if self.leased:
+                LOG.error('Lost the lease on %s to another consumer',
+                          self.stream)
+            self.leased = False
+            return False
+        if not self.leased:
+            LOG.info('Consuming %s as %s', self.stream, self.consumer)
+            self.leased = True
+            self.reclaiming = True
+        # renewed well before it expires
+        self.renew_at = now + self.lease_ttl / 3000.0
+        return True
+
+    def claim(self):
+        """
+        Takes over the entries left pending by previous consumers of the
+        group, i.e. consumers that died mid-batch.
+        """
+        pending = self.connection.execute_command(
+            'XPENDING', self.stream, self.group, '-', '+', self.batch_size)
+        stale = [entry_id for entry_id, consumer, _, _ in pending
+                 if consumer != self.consumer]
+        if not stale:
+            return []
+        LOG.info('Claiming %s stale entries from %s', len(stale), self.stream)
+        statsd.incr(".".join(["plugins", "claimed"]), len(stale))
+        return self._packets(self.connection.execute_command(
+            'XCLAIM', self.stream, self.group, self.consumer, 0, *stale))
+
+    def depth(self):
+        """Entries not delivered to the group yet (pending on old Redis)"""
+        for info in self.connection.execute_command('XINFO', 'GROUPS',
+                                                    self.stream):
+            info = dict(zip(info[::2], info[1::2]))
+            if info['name'] == self.group:
+                lag = info.get('lag')
+                return lag if lag is not None else info['pending']
+        return 0
+
+    def next_batch(self, block=True):
+        """
+        Returns a list of raw packets and the remaining queue depth.
+
+        Nothing is read while another consumer holds the group's lease.
+        Reclaimed entries from dead consumers go first, then new entries
+        read in batches of up to ``batch_size``.
+        """
+        self.entry_ids = []
+        if not self.hold_lease():
+            if block:
+                # standing by
+                time.sleep(1)
+            return [], 0
+        if self.reclaiming:
+            packets = self.claim()
+            if packets:
+                return packets, self.depth()
+            self.reclaiming = False
+
+        packets = self._read(self.batch_size, block=1000 if block else None)
+        if (packets and self.batch_latency and
+                len(packets) < self.batch_size):
+            time.sleep(self.batch_latency / 1000.0)
+            packets.extend(self._read(self.batch_size - len(packets)))
+        return packets, self.depth() if packets else 0
+
+    def ack(self, ids=None):
+        """
+        Acknowledges the entries ``ids`` (every entry handed out by
+        default) once they have been dispatched, and trims the stream every
+        100 acks.
+        """
+        if ids is None:
+            ids = list(self.outstanding)
+        self.outstanding.difference_update(ids)
+        ids = self.unacked + [entry_id for entry_id in ids if entry_id]
+        self.unacked = []
+        if not ids:
+            return
+        self.connection.execute_command('XACK', self.stream, self.group,
+                                        *ids)
+        self.batches += 1
+        if self.maxlen and self.batches % 100 == 0:
+            try:
+                self.trim()
+            except redis.ResponseError:
+                # MINID needs Redis 6.2
+                LOG.warn('Could not trim %s', self.stream, exc_info=True)
+
+    def trim(self):
+        """
+        Once the stream holds more than ``maxlen`` entries, drops those
+        every group is done with: the entries older than the oldest one a
+        group has pending or hasn't read yet.
+        """
+        length = self.connection.execute_command('XLEN', self.stream)
+        if length <= self.maxlen:
+            return
+        oldest = None
+        for info in self.connection.execute_command('XINFO', 'GROUPS',
+                                                    self.stream):
+            info = dict(zip(info[::2], info[1::2]))
+            if info['pending']:
+                # count, smallest id, greatest id, consumers
+                entry_id = self.connection.execute_command(
+                    'XPENDING', self.stream, info['name'])[1]
+            else:
+                entry_id = info['last-delivered-id']
+            if oldest is None or stream_id(entry_id) < stream_id(oldest):
+                oldest = entry_id
+        if oldest is not None:
+            self.connection.execute_command('XTRIM', self.stream, 'MINID',
+                                            '~', oldest)
+
+
+def stream_id(entry_id):
+    """``'<ms>-<seq>'`` as a tuple that sorts like the stream does"""
+    return tuple(int(part) for part in entry_id.split('-'))
+
+
+TRANSPORTS = {
+    'list': ListTransport,
+    'stream': StreamTransport,
+}
+
+
+def get_transport(connection, kind=None, **kwargs):
+    """Transport configured by ``PLUGIN_TRANSPORT`` unless ``kind`` is given"""
+    return TRANSPORTS[kind or settings.PLUGIN_TRANSPORT](connection, **kwargs)
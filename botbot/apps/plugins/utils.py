@@ -1,11 +1,35 @@
 import datetime
+import logging
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import transaction
 from django.template import Template, Context
 from django.template.defaultfilters import urlize
 from django.utils.timezone import utc
 
 import markdown
+import redis
+
+LOG = logging.getLogger(__name__)
+
+# Redis pub/sub channel the plugin runners' registries listen on
+INVALIDATION_CHANNEL = 'plugins:invalidate'
+# Sorted set of the invalidations published in the last INVALIDATION_LOG_TTL
+# seconds, by time, for runners starting from a snapshot (see snapshot.py)
+INVALIDATION_LOG = 'plugins:invalidations'
+INVALIDATION_LOG_TTL = 24 * 60 * 60
+# Redis hash of channel id -> '<users> <unix time>', see core.occupancy
+OCCUPANCY_KEY = 'plugins:occupancy'
+
+_invalidation_bus = None
+_occupancy_bus = None
+# invalidations of the thread's request, published once it's committed
+_request = threading.local()
 
 def plugin_docs_as_html(plugin, channel):
     tmpl = Template(plugin.user_docs)
@@ -20,17 +44,32 @@ def convert_nano_timestamp(nano_timestamp):
     """
     Takes a time string created by the bot (in Go using nanoseconds)
     and makes it a Python datetime using microseconds
+
+    RFC 3339 is parsed by hand, this runs for every line and ``strptime``
+    is a lot slower. Go leaves out trailing zeros of the fraction, or the
+    whole fraction, and a ``+hh:mm`` offset instead of ``Z`` is allowed.
     """
-    # convert nanoseconds to microseconds
-    # http://stackoverflow.com/a/10612166/116042
-    rfc3339, nano_part = nano_timestamp.split('.')
-    micro = nano_part[:-1] # strip trailing "Z"
-    if len(nano_part) > 6: # trim to max size Python allows
-        micro = micro[:6]
-    rfc3339micro = ''.join([rfc3339, '.', micro, 'Z'])
-    micro_timestamp = datetime.datetime.strptime(
-        rfc3339micro, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=utc)
-    return micro_timestamp
+    value = nano_timestamp
+    if value[-1:] in ('Z', 'z'):
+        fraction, offset = value[19:-1], None
+    else:
+        fraction, offset = value[19:-6], value[-6:]
+    if (len(value) < 20 or value[4] != '-' or value[7] != '-' or
+            value[10] not in 'Tt' or value[13] != ':' or value[16] != ':' or
+            (fraction and fraction[0] != '.') or
+            (offset and (offset[0] not in '+-' or offset[3] != ':'))):
+        raise ValueError('Not an RFC 3339 timestamp: {0!r}'.format(value))
+    # nanoseconds to microseconds, Python can't go smaller
+    micro = int(fraction[1:7].ljust(6, '0')) if fraction else 0
+    timestamp = datetime.datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19]), micro,
+        tzinfo=utc)
+    if offset:
+        delta = datetime.timedelta(hours=int(offset[1:3]),
+                                   minutes=int(offset[4:6]))
+        timestamp += -delta if offset[0] == '+' else delta
+    return timestamp
 
 
 def log_on_error(Log, method):
@@ -41,3 +80,123 @@ def log_on_error(Log, method):
         except Exception:
             Log.error("Plugin failed [%s]", method.__name__, exc_info=True)
     return wrap
+
+
+def publish_invalidation(kind, pk):
+    """
+    Tells the plugin runners a ``chatbot`` or ``channel`` (including its
+    active plugins) changed and should be reloaded.
+
+    Runners reload from the database right away, so the change has to be
+    committed first. Within the transaction of a request (ATOMIC_REQUESTS)
+    the invalidation is held until the request is finished. Elsewhere it
+    is published right away, call it after committing.
+    """
+    message = '{0}:{1}'.format(kind, pk)
+    pending = getattr(_request, 'invalidations', None)
+    if pending is not None and transaction.get_connection().in_atomic_block:
+        if message not in pending:
+            pending.append(message)
+        return
+    send_invalidations([message])
+
+
+def send_invalidations(messages):
+    global _invalidation_bus
+    if not settings.REDIS_PLUGIN_QUEUE_URL or not messages:
+        return
+    if _invalidation_bus is None:
+        _invalidation_bus = redis.StrictRedis.from_url(
+            settings.REDIS_PLUGIN_QUEUE_URL)
+    now = time.time()
+    try:
+        pipe = _invalidation_bus.pipeline(transaction=False)
+        for message in messages:
+            pipe.zadd(INVALIDATION_LOG, now, message)
+            pipe.publish(INVALIDATION_CHANNEL, message)
+        pipe.zremrangebyscore(INVALIDATION_LOG, 0, now - INVALIDATION_LOG_TTL)
+        pipe.execute()
+    except redis.RedisError:
+        # Runners reload everything periodically, don't fail the save
+        LOG.warn('Could not publish invalidations %s', messages,
+                 exc_info=True)
+
+
+def start_request(**kwargs):
+    _request.invalidations = []
+
+
+def finish_request(**kwargs):
+    """Publishes the invalidations of the request, committed by now"""
+    pending = getattr(_request, 'invalidations', None)
+    _request.invalidations = None
+    if pending:
+        send_invalidations(pending)
+
+
+request_started.connect(start_request, dispatch_uid='plugins_invalidations')
+request_finished.connect(finish_request,
+                         dispatch_uid='plugins_invalidations')
+
+
+def current_occupancy(channel_id):
+    """
+    Users in a channel as last counted by the occupancy plugin, None if it
+    isn't counting them or hasn't for three OCCUPANCY_INTERVALs.
+    """
+    global _occupancy_bus
+    if not settings.REDIS_PLUGIN_STORAGE_URL:
+        return None
+    if _occupancy_bus is None:
+        _occupancy_bus = redis.StrictRedis.from_url(
+            settings.REDIS_PLUGIN_STORAGE_URL)
+    try:
+        value = _occupancy_bus.hget(OCCUPANCY_KEY, channel_id)
+    except redis.RedisError:
+        LOG.warn('Could not read the occupancy of channel %s', channel_id,
+                 exc_info=True)
+        return None
+    if not value:
+        return None
+    users, counted = value.split()
+    if time.time() - float(counted) > 3 * settings.OCCUPANCY_INTERVAL:
+        return None
+    return int(users)
+
+
+class TTLCache(object):
+    """
+    Cache of at most ``maxsize`` entries, each expiring ``ttl`` seconds
+    after it was set. The least recently used entry makes room for new
+    ones. Safe to share between threads.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expires, value), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                return default
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (ttl or self.ttl)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
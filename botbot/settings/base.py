@@ -272,8 +272,124 @@ if EXCLUDE_NICKS == ['']:
 
 REDIS_PLUGIN_QUEUE_URL = os.environ.get('REDIS_PLUGIN_QUEUE_URL')
 REDIS_PLUGIN_STORAGE_URL = os.environ.get('REDIS_PLUGIN_STORAGE_URL')
+# How the plugin runner reads packets from REDIS_PLUGIN_QUEUE_URL: 'list'
+# (the bot RPUSHes to `q`) or 'stream' (the bot XADDs to `q:stream`, read
+# through a consumer group by one runner at a time, runners on other hosts
+# stand by to take over, see transport.py).
+PLUGIN_TRANSPORT = os.environ.get('PLUGIN_TRANSPORT', 'list')
+PLUGIN_STREAM_GROUP = os.environ.get('PLUGIN_STREAM_GROUP', 'plugins')
+# Entries in the stream above which it's trimmed, down to the oldest entry
+# a consumer group hasn't acknowledged
+PLUGIN_STREAM_MAXLEN = int(os.environ.get('PLUGIN_STREAM_MAXLEN', 100000))
+# A stream consumer that hasn't renewed its lease on the group for this long
+# (ms) is taken over by a standby one, which claims the entries it held
+PLUGIN_STREAM_CLAIM_IDLE = int(os.environ.get('PLUGIN_STREAM_CLAIM_IDLE',
+                                              60000))
+
+# Max packets the plugin runner drains from the queue per round trip, and how
+# long (ms) it lets a batch fill up after waking from an empty queue.
+PLUGIN_BATCH_SIZE = int(os.environ.get('PLUGIN_BATCH_SIZE', 100))
+PLUGIN_BATCH_LATENCY = int(os.environ.get('PLUGIN_BATCH_LATENCY', 0))
+# The plugin runner keeps chatbots, channels and plugin settings in memory.
+# Seconds between full reloads (changes are pushed in between), and how long
+# a lookup for something that does not exist is remembered.
+PLUGIN_REGISTRY_REFRESH = int(os.environ.get('PLUGIN_REGISTRY_REFRESH', 3600))
+PLUGIN_REGISTRY_NEGATIVE_TTL = int(os.environ.get(
+    'PLUGIN_REGISTRY_NEGATIVE_TTL', 300))
+# The plugin runner saves its registry and the channels it had dispatch
+# plans for to PLUGIN_SNAPSHOT when it stops (a file per worker), and starts
+# from it when it is less than PLUGIN_SNAPSHOT_MAX_AGE seconds old. Empty to
+# always start from the database.
+PLUGIN_SNAPSHOT = os.environ.get(
+    'PLUGIN_SNAPSHOT', os.path.join(VAR_ROOT, 'plugin_snapshot.pickle'))
+PLUGIN_SNAPSHOT_MAX_AGE = int(os.environ.get('PLUGIN_SNAPSHOT_MAX_AGE', 600))
+# How plugins are called: 'inline', 'thread' or 'gevent' (see executor.py).
+# 'inline' enforces no timeouts, a plugin call that hangs hangs the runner.
+# Plugin storage writes are batched per batch of lines on the dispatch
+# thread and per call on the pool's threads.
+PLUGIN_EXECUTOR = os.environ.get('PLUGIN_EXECUTOR', 'thread')
+# Threads or greenlets calling plugins, calls one plugin may have running
+# at once and seconds a call may take
+PLUGIN_POOL_SIZE = int(os.environ.get('PLUGIN_POOL_SIZE', 16))
+PLUGIN_CONCURRENCY = int(os.environ.get('PLUGIN_CONCURRENCY', 4))
+PLUGIN_TIMEOUT = float(os.environ.get('PLUGIN_TIMEOUT', 10))
+# Calls of a plugin waiting for one of its PLUGIN_CONCURRENCY slots above
+# which the runner stops dispatching until one starts
+PLUGIN_MAX_WAITING = int(os.environ.get('PLUGIN_MAX_WAITING', 1000))
+# Encoding of packets written by the plugin runners ('json' or 'msgpack',
+# which needs msgpack installed), and whether the dispatcher of sharded
+# runners drops the Raw field for channels with no plugin needing it
+PLUGIN_CODEC = os.environ.get('PLUGIN_CODEC', 'json')
+PLUGIN_CODEC_LEAN = ast.literal_eval(os.environ.get('PLUGIN_CODEC_LEAN',
+                                                    'False'))
+# Circuit breakers stop calling a plugin on a channel for
+# PLUGIN_BREAKER_COOLDOWN seconds once PLUGIN_BREAKER_ERROR_RATE of at least
+# PLUGIN_BREAKER_MIN_CALLS calls in PLUGIN_BREAKER_WINDOW seconds failed,
+# raising or taking over PLUGIN_BREAKER_SLOW_CALL seconds (see breaker.py)
+PLUGIN_BREAKER_WINDOW = int(os.environ.get('PLUGIN_BREAKER_WINDOW', 60))
+PLUGIN_BREAKER_MIN_CALLS = int(os.environ.get('PLUGIN_BREAKER_MIN_CALLS', 5))
+PLUGIN_BREAKER_ERROR_RATE = float(os.environ.get('PLUGIN_BREAKER_ERROR_RATE',
+                                                 0.5))
+PLUGIN_BREAKER_SLOW_CALL = float(os.environ.get('PLUGIN_BREAKER_SLOW_CALL', 5))
+PLUGIN_BREAKER_COOLDOWN = int(os.environ.get('PLUGIN_BREAKER_COOLDOWN', 60))
+# HTTP client of the plugins: seconds before a call times out, connections
+# kept alive per host, calls to a host at once, and successful GETs cached
+# (how many, and for how many seconds by default)
+PLUGIN_HTTP_TIMEOUT = float(os.environ.get('PLUGIN_HTTP_TIMEOUT', 5))
+PLUGIN_HTTP_POOL_SIZE = int(os.environ.get('PLUGIN_HTTP_POOL_SIZE', 10))
+PLUGIN_HTTP_HOST_CONCURRENCY = int(os.environ.get(
+    'PLUGIN_HTTP_HOST_CONCURRENCY', 4))
+PLUGIN_HTTP_CACHE_SIZE = int(os.environ.get('PLUGIN_HTTP_CACHE_SIZE', 1000))
+PLUGIN_HTTP_CACHE_TTL = int(os.environ.get('PLUGIN_HTTP_CACHE_TTL', 60))
+# Replies of handlers decorated with @memoize are kept this many seconds by
+# default, up to PLUGIN_MEMOIZE_SIZE of them per plugin runner
+PLUGIN_MEMOIZE_TTL = int(os.environ.get('PLUGIN_MEMOIZE_TTL', 300))
+PLUGIN_MEMOIZE_SIZE = int(os.environ.get('PLUGIN_MEMOIZE_SIZE', 10000))
+# Plugins are registered from a manifest cached in PLUGIN_MANIFEST and only
+# imported once a channel using them sends a line. False imports them all
+# at startup.
+PLUGIN_LAZY_LOADING = ast.literal_eval(os.environ.get('PLUGIN_LAZY_LOADING',
+                                                      'True'))
+PLUGIN_MANIFEST = os.environ.get('PLUGIN_MANIFEST',
+                                 os.path.join(VAR_ROOT, 'plugin_manifest.json'))
+# Lines a channel gets dispatched per turn when several channels have lines
+# waiting, and most lines read off the queue and waiting for their turn. The
+# runner reads ahead up to that many lines while the queue has a backlog,
+# one flooded channel only delays the others' lines within that window.
+PLUGIN_FAIR_QUANTUM = int(os.environ.get('PLUGIN_FAIR_QUANTUM', 10))
+PLUGIN_FAIR_MAX_PENDING = int(os.environ.get('PLUGIN_FAIR_MAX_PENDING',
+                                             10000))
+# Queue depths above which firehose lines, and then messages too, are only
+# passed to essential plugins (mentions and the logger always get through)
+PLUGIN_QUEUE_HIGH_WATERMARK = int(os.environ.get(
+    'PLUGIN_QUEUE_HIGH_WATERMARK', 5000))
+PLUGIN_QUEUE_CRITICAL_WATERMARK = int(os.environ.get(
+    'PLUGIN_QUEUE_CRITICAL_WATERMARK', 20000))
+# Plugin storage layout: 'keys', a Redis key per value, or 'hash', a hash
+# per plugin and channel of at most PLUGIN_STORAGE_MAX_FIELDS values (0 for
+# no cap) expiring PLUGIN_STORAGE_NAMESPACE_TTL seconds after the last write
+# (0 for never). Switch with `manage.py migrate_plugin_storage`.
+PLUGIN_STORAGE_LAYOUT = os.environ.get('PLUGIN_STORAGE_LAYOUT', 'keys')
+PLUGIN_STORAGE_MAX_FIELDS = int(os.environ.get('PLUGIN_STORAGE_MAX_FIELDS',
+                                               10000))
+PLUGIN_STORAGE_NAMESPACE_TTL = int(os.environ.get(
+    'PLUGIN_STORAGE_NAMESPACE_TTL', 0))
+# The logger plugin writes lines in batches of up to this many lines, at
+# least every LOGGER_BATCH_INTERVAL ms. 1 saves every line as it comes.
+LOGGER_BATCH_SIZE = int(os.environ.get('LOGGER_BATCH_SIZE', 1))
+LOGGER_BATCH_INTERVAL = int(os.environ.get('LOGGER_BATCH_INTERVAL', 500))
+# The occupancy plugin publishes the channels whose number of users
+# changed after every batch, and saves every channel's count to its hourly
+# UserCount every OCCUPANCY_INTERVAL seconds.
+OCCUPANCY_INTERVAL = int(os.environ.get('OCCUPANCY_INTERVAL', 300))
 
 PUSH_STREAM_URL = os.environ.get('PUSH_STREAM_URL', None)
+# Seconds to wait on Nginx, and to stop pushing for after it failed
+PUSH_STREAM_TIMEOUT = float(os.environ.get('PUSH_STREAM_TIMEOUT', 2))
+PUSH_STREAM_BACKOFF = int(os.environ.get('PUSH_STREAM_BACKOFF', 10))
+# Logs waiting to be pushed, more are dropped; and most sent in one go
+PUSH_STREAM_QUEUE_SIZE = int(os.environ.get('PUSH_STREAM_QUEUE_SIZE', 10000))
+PUSH_STREAM_BATCH_SIZE = int(os.environ.get('PUSH_STREAM_BATCH_SIZE', 200))
 
 # ==============================================================================
 # Third party app settings
@@ -1,14 +1,29 @@
 #!/usr/bin/env python
+import os
 import sys
 
+
+def uses_gevent(argv):
+    """Whether run_plugins is going to run plugins on gevent"""
+    if 'run_plugins' not in argv:
+        return False
+    if '--with-gevent' in argv:
+        return True
+    executor = os.environ.get('PLUGIN_EXECUTOR')
+    for index, arg in enumerate(argv):
+        if arg == '--executor' and index + 1 < len(argv):
+            executor = argv[index + 1]
+        elif arg.startswith('--executor='):
+            executor = arg.split('=', 1)[1]
+    return executor == 'gevent'
+
+
 if __name__ == "__main__":
-    if (len(sys.argv) > 1 and
-            'run_plugins' in sys.argv and '--with-gevent' in sys.argv):
+    if uses_gevent(sys.argv[1:]):
         # import gevent as soon as possible
         from gevent import monkey; monkey.patch_all()
         from psycogreen.gevent import patch_psycopg; patch_psycopg()
 
-    import os
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "botbot.settings")
 
     from django.core.management import execute_from_command_line